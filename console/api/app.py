@@ -16,22 +16,23 @@ from console.libs.validation import (
     RegisterSchema, CreateAppArgsSchema, UserSchema, RollbackSchema, SecretArgsSchema, ConfigMapArgsSchema,
     ScaleSchema, DeploySchema, ClusterArgSchema, OptionalClusterArgSchema, ABTestingSchema,
     ClusterCanarySchema, SpecsArgsSchema, AppYamlArgsSchema, PaginationSchema, PodLogArgsSchema,
-    PodEntryArgsSchema, AppCanaryWeightArgSchema,
+    PodEntryArgsSchema, AppCanaryWeightArgSchema, RolloutArgsSchema,
 )
 
 from console.libs.utils import (
-    logger, make_canary_appname, bearychat_sendmsg, make_app_redis_key,
+    logger, make_canary_appname, make_app_redis_key,
     make_errmsg,
 )
 from console.libs.view import create_api_blueprint, DEFAULT_RETURN_VALUE, user_require
 from console.models import App, Release, SpecVersion, User, OPLog, OPType, AppYaml
 from console.libs.k8s import KubeApi, KubeError
 from console.libs.k8s import ApiException
+from console.libs.taskoutput import append_task_output
+from console.libs.notify import notify_bearychat
 from console.config import (
-    DEFAULT_REGISTRY, DEFAULT_APP_NS, BEARYCHAT_CHANNEL,
-    TASK_PUBSUB_CHANNEL, TASK_PUBSUB_EOF,
+    DEFAULT_REGISTRY, DEFAULT_APP_NS, BEARYCHAT_CHANNEL, DEPLOY_ROLLOUT_TIMEOUT,
 )
-from console.ext import rds
+from console.ext import rds, db
 
 bp = create_api_blueprint('app', __name__, 'app')
 
@@ -166,6 +167,84 @@ def _get_canary_info(appname, cluster):
     return info
 
 
+def check_deploy_args(appname, app_yaml, release, cluster, args):
+    """
+    check if the release can be deployed to the cluster, abort if it can't.
+    it only talks to kubernetes, so it's safe to run in a separate greenlet.
+    :return: the specs to deploy
+    """
+    ns = DEFAULT_APP_NS
+    canary_info = _get_canary_info(appname, cluster)
+    if canary_info['status']:
+        abort(403, "please delete canary release before you deploy a new release")
+
+    with handle_k8s_error("Error when get deployment"):
+        # the replicas are written back, so don't read from the informer cache
+        k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True,
+                                                           namespace=ns, live=True)
+
+    specs = app_yaml.specs
+    fix_app_spec(specs, appname, release.tag)
+
+    # update specs from release
+    replicas = args.get('replicas')
+    cpus = args.get('cpus')
+    memories = args.get('memories')
+
+    # sometimes user may forget fo update replicas value after a scale operation,
+    # so we never scale down the deployments
+    if not replicas:
+        replicas = specs.service.replicas
+        if k8s_deployment is not None and k8s_deployment.spec.replicas > replicas:
+            replicas = k8s_deployment.spec.replicas
+    try:
+        specs = _update_specs(specs, cpus, memories, replicas)
+    except IndexError:
+        abort(403, "cpus or memories' index is larger than the number of containers")
+
+    if release.build_status is False:
+        abort(403, "please build release first")
+    # check secret and configmap
+    secret_keys = get_spec_secret_keys(specs)
+    if len(secret_keys) > 0:
+        try:
+            secret_data = KubeApi.instance().get_secret(appname, cluster_name=cluster, namespace=ns)
+        except ApiException as e:
+            if e.status == 404:
+                abort(403, "please set secret for app {}".format(appname))
+            else:
+                raise e
+        diff_keys = set(secret_keys) - set(secret_data.keys())
+        if len(diff_keys) > 0:
+            abort(403, "%s are not in secret, please set it first" % str(diff_keys))
+
+    configmap_keys = get_spec_configmap_keys(specs)
+    if len(configmap_keys) > 0:
+        try:
+            cm_data = KubeApi.instance().get_config_map(appname, cluster_name=cluster, namespace=ns)
+        except ApiException as e:
+            if e.status == 404:
+                abort(403, "please set configmap for app {}".format(appname))
+            else:
+                raise e
+        diff_keys = set(configmap_keys) - set(cm_data.keys())
+        if len(diff_keys) > 0:
+            abort(403, "%s are not in configmap" % str(diff_keys))
+    return specs
+
+
+def deploy_specs(specs, tag, cluster):
+    try:
+        KubeApi.instance().deploy_app(specs, tag, cluster_name=cluster, namespace=DEFAULT_APP_NS)
+    except KubeError as e:
+        abort(403, "Deploy Error: {}".format(str(e)))
+    except ApiException as e:
+        abort(e.status, "Error when deploy app: {}".format(str(e)))
+    except Exception as e:
+        logger.exception("kubernetes error ")
+        abort(500, 'kubernetes error: {}'.format(str(e)))
+
+
 @bp.route('/')
 @use_args(PaginationSchema())
 @user_require(False)
@@ -296,7 +375,8 @@ def rollback_app(args, appname):
             abort(403, "Please delete canary release before rollback app")
 
         with handle_k8s_error("failed to get kubernetes deployment of app {}".format(appname)):
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, namespace=ns)
+            # the resource version and renew id are used to update the deployment
+            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, namespace=ns, live=True)
 
         version = k8s_deployment.metadata.resource_version
         release_tag = k8s_deployment.metadata.annotations['release_tag']
@@ -421,7 +501,7 @@ def delete_app(appname):
     )
 
     msg = 'Warning: App **{}** has been deleted by **{}**.'.format(appname, g.user.nickname)
-    bearychat_sendmsg(BEARYCHAT_CHANNEL, msg)
+    notify_bearychat(BEARYCHAT_CHANNEL, msg)
     return DEFAULT_RETURN_VALUE
 
 
@@ -636,6 +716,56 @@ def get_app_k8s_deployment(args, appname):
         return KubeApi.instance().get_deployment(name, cluster_name=cluster, namespace=ns)
 
 
+@bp.route('/<appname>/rollout')
+@use_args(RolloutArgsSchema())
+@user_require(False)
+def wait_app_rollout(args, appname):
+    """
+    Wait until the deployment of the specified app is rolled out, failed or timeout
+    ---
+    parameters:
+      - name: appname
+        in: path
+        type: string
+        required: true
+      - name: cluster
+        in: query
+        type: string
+        required: true
+      - name: canary
+        in: query
+        type: boolean
+      - name: timeout
+        in: query
+        type: integer
+        description: seconds to wait, at most DEPLOY_ROLLOUT_TIMEOUT(the default)
+    responses:
+      200:
+        description: rollout status, `timeout` is true if the rollout isn't finished in time
+        examples:
+          application/json: {
+            "name": "hello",
+            "replicas": 2,
+            "updated_replicas": 2,
+            "available_replicas": 2,
+            "done": true,
+            "failed": false,
+            "timeout": false,
+            "msg": "deployment hello successfully rolled out"
+          }
+    """
+    cluster = args['cluster']
+    timeout = args.get('timeout', DEPLOY_ROLLOUT_TIMEOUT)
+    get_app_raw(appname)
+    name = "{}-canary".format(appname) if args['canary'] else appname
+    ns = DEFAULT_APP_NS
+
+    # this request may pend long time, don't hold the db connection
+    db.session.remove()
+    with handle_k8s_error("Error when wait rollout of deployment {}".format(name)):
+        return KubeApi.instance().wait_rollout(name, cluster_name=cluster, namespace=ns, timeout=timeout)
+
+
 @bp.route('/<appname>/ingress')
 @use_args(ClusterArgSchema())
 @user_require(False)
@@ -1289,7 +1419,8 @@ def scale_app(args, appname):
 
     with lock_app(appname):
         with handle_k8s_error("Error when get deployment"):
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, namespace=ns)
+            # the resource version and renew id are used to update the deployment
+            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, namespace=ns, live=True)
 
         release_tag = k8s_deployment.metadata.annotations['release_tag']
         version = k8s_deployment.metadata.resource_version
@@ -1387,7 +1518,6 @@ def deploy_app(args, appname):
     cluster = args['cluster']
     tag = args["tag"]
     app_yaml_name = args['app_yaml_name']
-    ns = DEFAULT_APP_NS
 
     app = App.get_by_name(appname)
     if not app:
@@ -1401,64 +1531,11 @@ def deploy_app(args, appname):
         abort(404, "AppYaml {} doesn't exist.".format(app_yaml_name))
 
     with lock_app(appname):
-
-        canary_info = _get_canary_info(appname, cluster)
-        if canary_info['status']:
-            abort(403, "please delete canary release before you deploy a new release")
         release = app.get_release_by_tag(tag)
         if not release:
             abort(404, 'release {} not found.'.format(tag))
 
-        with handle_k8s_error("Error when get deployment"):
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True, namespace=ns)
-
-        specs = app_yaml.specs
-        fix_app_spec(specs, appname, tag)
-
-        # update specs from release
-        replicas = args.get('replicas')
-        cpus = args.get('cpus')
-        memories = args.get('memories')
-
-        # sometimes user may forget fo update replicas value after a scale operation,
-        # so we never scale down the deployments
-        if not replicas:
-            replicas = specs.service.replicas
-            if k8s_deployment is not None and k8s_deployment.spec.replicas > replicas:
-                replicas = k8s_deployment.spec.replicas
-        try:
-            specs = _update_specs(specs, cpus, memories, replicas)
-        except IndexError:
-            abort(403, "cpus or memories' index is larger than the number of containers")
-
-        if release.build_status is False:
-            abort(403, "please build release first")
-        # check secret and configmap
-        secret_keys = get_spec_secret_keys(specs)
-        if len(secret_keys) > 0:
-            try:
-                secret_data = KubeApi.instance().get_secret(appname, cluster_name=cluster, namespace=ns)
-            except ApiException as e:
-                if e.status == 404:
-                    abort(403, "please set secret for app {}".format(appname))
-                else:
-                    raise e
-            diff_keys = set(secret_keys) - set(secret_data.keys())
-            if len(diff_keys) > 0:
-                abort(403, "%s are not in secret, please set it first" % str(diff_keys))
-
-        configmap_keys = get_spec_configmap_keys(specs)
-        if len(configmap_keys) > 0:
-            try:
-                cm_data = KubeApi.instance().get_config_map(appname, cluster_name=cluster, namespace=ns)
-            except ApiException as e:
-                if e.status == 404:
-                    abort(403, "please set configmap for app {}".format(appname))
-                else:
-                    raise e
-            diff_keys = set(configmap_keys) - set(cm_data.keys())
-            if len(diff_keys) > 0:
-                abort(403, "%s are not in configmap" % str(diff_keys))
+        specs = check_deploy_args(appname, app_yaml, release, cluster, args)
 
         try:
             SpecVersion.create(app, tag, specs)
@@ -1466,15 +1543,7 @@ def deploy_app(args, appname):
             logger.exception("can't create spec version")
             abort(500, "internal server error")
 
-        try:
-            KubeApi.instance().deploy_app(specs, release.tag, cluster_name=cluster, namespace=ns)
-        except KubeError as e:
-            abort(403, "Deploy Error: {}".format(str(e)))
-        except ApiException as e:
-            abort(e.status, "Error when deploy app: {}".format(str(e)))
-        except Exception as e:
-            logger.exception("kubernetes error ")
-            abort(500, 'kubernetes error: {}'.format(str(e)))
+        deploy_specs(specs, release.tag, cluster)
 
         OPLog.create(
             user_id=g.user.id,
@@ -1527,7 +1596,7 @@ def undeploy_app(args, appname):
             )
 
     msg = 'Warning: App **{}**\'s deployment in cluster **{}** has been deleted by **{}**.'.format(appname, cluster, g.user.nickname)
-    bearychat_sendmsg(BEARYCHAT_CHANNEL, msg)
+    notify_bearychat(BEARYCHAT_CHANNEL, msg)
     return DEFAULT_RETURN_VALUE
 
 
@@ -1929,15 +1998,10 @@ def kill_build_task(appname):
             abort(404, "build task is not running")
         if isinstance(build_task_id, bytes):
             build_task_id = build_task_id.decode('utf8')
-        from console.app import celery
-        # logger.debug("++++++++", build_task_id, celery.control)
-        celery.control.revoke(build_task_id, terminate=True)
-
-        # notify build greenlet to exit
-        channel_name = TASK_PUBSUB_CHANNEL.format(task_id=build_task_id)
-        failure_msg = make_errmsg('terminate by user', jsonize=True)
-        rds.publish(channel_name, failure_msg)
-        rds.publish(channel_name, TASK_PUBSUB_EOF.format(task_id=build_task_id))
+        from console.libs.buildqueue import cancel_build
+        # notify build greenlet to exit, the output is finished when the build is cancelled
+        append_task_output(build_task_id, make_errmsg('terminate by user', jsonize=True))
+        cancel_build(build_task_id, app)
     finally:
         rds.hdel(app_redis_key, "build-task-id")
     return DEFAULT_RETURN_VALUE
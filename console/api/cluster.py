@@ -1,5 +1,6 @@
 from console.libs.view import create_api_blueprint, user_require
 from console.libs.k8s import KubeApi
+from console.libs.watcher import get_watcher_status, make_watcher_shards
 
 bp = create_api_blueprint('cluster', __name__, 'cluster')
 
@@ -24,3 +25,55 @@ def list_cluster():
             ]
     """
     return KubeApi.instance().cluster_names
+
+
+@bp.route('/stats')
+@user_require(False)
+def get_cluster_stats():
+    """
+    Get the time spent on loading kubeconfig and the clients of every used cluster
+    ---
+    responses:
+      200:
+        description: load stats
+        schema:
+          type: object
+        examples:
+          application/json: {
+            "kubeconfig_load_seconds": 0.012,
+            "clusters": {
+              "cluster1": {"client_load_seconds": 0.035}
+            }
+          }
+    """
+    return KubeApi.instance().stats
+
+
+@bp.route('/watcher')
+@user_require(False)
+def get_pods_watcher_status():
+    """
+    Get the replicas of the pods watcher, the shards owned by them and the events/sec of every shard
+    ---
+    responses:
+      200:
+        description: watcher status, the owner of a shard is null if no replica watches it
+        schema:
+          type: object
+        examples:
+          application/json: {
+            "replicas": {
+              "host1-12-3fa8c1": {
+                "shards": ["cluster1"],
+                "events_per_sec": {"cluster1": 12.5},
+                "updated": 1546398245.12
+              }
+            },
+            "shards": {
+              "cluster1": "host1-12-3fa8c1",
+              "cluster2": null
+            }
+          }
+    """
+    shard_ids = sorted(make_watcher_shards(KubeApi.instance().cluster_names).keys())
+    return get_watcher_status(shard_ids)
@@ -1,7 +1,7 @@
 import os
 import yaml
-from flask import abort, g
-import time
+import itertools
+from flask import abort, g, request, Response
 import shlex
 
 from marshmallow import ValidationError
@@ -10,13 +10,15 @@ from webargs.flaskparser import use_args
 
 from kaelib.spec import load_job_specs
 
-from console.libs.validation import JobArgsSchema
+from console.libs.validation import JobArgsSchema, JobLogArgsSchema
 from console.libs.view import create_api_blueprint, DEFAULT_RETURN_VALUE, user_require
 from console.models import Job
 from console.libs.k8s import KubeApi, ApiException
 from console.libs.cloner import Cloner
-from console.config import JOBS_ROOT_DIR, DEFAULT_JOB_NS
+from console.libs.joblog import get_job_log_path, get_log_size, find_tail_offset, iter_log_range, slice_chunks
+from console.config import JOBS_ROOT_DIR, DEFAULT_JOB_NS, JOB_LOG_MAX_READ_SIZE
 from console.libs.utils import logger
+from console.tasks import restart_job as restart_job_task
 from .util import handle_k8s_err
 
 bp = create_api_blueprint('job', __name__, 'job')
@@ -184,39 +186,20 @@ def restart_job(jobname):
         required: true
     responses:
       200:
-        description: error message
-        schema:
-          $ref: '#/definitions/Error'
+        description: id of the restart task, use it to follow the progress with the websocket api
         examples:
           application/json:
             error: null
+            task_id: 8b5e2ee4-07e1-4e3c-9f0c-6bd4b7b1a3c2
     """
     job = Job.get_by_name(jobname)
     if not job:
         abort(404, "job {} not found".format(jobname))
 
     job.inc_version()
-
-    with handle_k8s_err("Error when delete job"):
-        KubeApi.instance().delete_job(jobname, ignore_404=True, namespace=DEFAULT_JOB_NS)
-    specs = job.specs
-    # FIXME: need to wait the old job to be deleted
-    while True:
-        try:
-            KubeApi.instance().get_job(jobname, namespace=DEFAULT_JOB_NS)
-        except ApiException as e:
-            if e.status == 404:
-                break
-            else:
-                logger.exception("kubernetes error")
-                abort(500, "kubernetes error")
-        except:
-            logger.exception("kubernetes error")
-            abort(500, "kubernetes error")
-        time.sleep(2)
-    with handle_k8s_err("Error when create job"):
-        KubeApi.instance().create_job(specs, namespace=DEFAULT_JOB_NS)
-    return DEFAULT_RETURN_VALUE
+    # the old job is deleted and recreated in background
+    async_result = restart_job_task.delay(jobname)
+    return {'error': None, 'task_id': async_result.task_id}
 
 
 @bp.route('/<jobname>/log')
@@ -250,3 +233,111 @@ def get_job_log(jobname):
         abort(e.status, "Error when get job log: {}".format(str(e)))
     except Exception as e:
         abort(500, "Error when get job log: {}".format(str(e)))
+
+
+def _log_response(chunks, status=200, headers=None):
+    headers = dict(headers or {})
+    headers['Accept-Ranges'] = 'bytes'
+    return Response(chunks, status=status, headers=headers, mimetype='text/plain')
+
+
+def _archived_log_response(log_path, tail=None):
+    size = get_log_size(log_path)
+    if tail is not None:
+        start = max(find_tail_offset(log_path, tail), size - JOB_LOG_MAX_READ_SIZE)
+        headers = {'X-Log-Offset': str(start), 'X-Log-Size': str(size)}
+        return _log_response(iter_log_range(log_path, start, size), headers=headers)
+
+    if request.range is None:
+        return _log_response(iter_log_range(log_path, 0, size), headers={'X-Log-Size': str(size)})
+    rng = request.range.range_for_length(size)
+    if rng is None:
+        return _log_response([], status=416, headers={'Content-Range': 'bytes */{}'.format(size)})
+    start, end = rng[0], min(rng[1], rng[0] + JOB_LOG_MAX_READ_SIZE)
+    headers = {'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, size)}
+    return _log_response(iter_log_range(log_path, start, end), status=206, headers=headers)
+
+
+def _prefetch(chunks):
+    # the log is requested from kubernetes when the first chunk is read,
+    # read it here so the errors are returned before the response is started.
+    try:
+        first = next(chunks, b'')
+    except ApiException as e:
+        abort(e.status, "Error when get job log: {}".format(str(e)))
+    return itertools.chain([first], chunks)
+
+
+def _live_log_response(podname, tail=None):
+    kube = KubeApi.instance()
+    if tail is not None:
+        chunks = kube.stream_pod_log(podname, namespace=DEFAULT_JOB_NS, tail_lines=tail,
+                                     limit_bytes=JOB_LOG_MAX_READ_SIZE)
+        return _log_response(_prefetch(chunks))
+
+    if request.range is None:
+        return _log_response(_prefetch(kube.stream_pod_log(podname, namespace=DEFAULT_JOB_NS)))
+    # the size of the live log is unknown, so only `bytes=<start>-[<end>]` is supported
+    ranges = request.range.ranges
+    if len(ranges) != 1 or ranges[0][0] < 0:
+        return _log_response([], status=416, headers={'Content-Range': 'bytes */*'})
+    start, end = ranges[0]
+    end = min(end, start + JOB_LOG_MAX_READ_SIZE) if end is not None else start + JOB_LOG_MAX_READ_SIZE
+    chunks = kube.stream_pod_log(podname, namespace=DEFAULT_JOB_NS, limit_bytes=end)
+    headers = {'Content-Range': 'bytes {}-{}/*'.format(start, end - 1)}
+    return _log_response(slice_chunks(_prefetch(chunks), start, end), status=206, headers=headers)
+
+
+@bp.route('/<jobname>/log/raw')
+@use_args(JobLogArgsSchema())
+@user_require(False)
+def get_job_log_raw(args, jobname):
+    """
+    read the job log as plain text, the log is streamed and never loaded as a whole.
+    the archived log of `version` is read if it's specified, otherwise the log of the running pod
+    (or the archived log of the current version if the pod is gone).
+    supports HTTP Range header(a single range), or `tail` to read the last N lines,
+    the offset of the returned lines is in the `X-Log-Offset` header, so the UI can page backwards with Range.
+    at most `JOB_LOG_MAX_READ_SIZE` bytes are returned for ranged and tail reads.
+    ---
+    parameters:
+      - name: jobname
+        in: path
+        type: string
+        required: true
+      - name: version
+        in: query
+        type: integer
+      - name: tail
+        in: query
+        type: integer
+    responses:
+      200:
+        description: the whole log or the last N lines
+      206:
+        description: the requested byte range
+      416:
+        description: the range is not satisfiable
+    """
+    job = Job.get_by_name(name=jobname)
+    if not job:
+        abort(404, "job {} not found".format(jobname))
+    tail = args.get('tail')
+
+    if 'version' in args:
+        log_path = get_job_log_path(jobname, args['version'])
+        if log_path is None:
+            abort(404, "log of job {} version {} not found".format(jobname, args['version']))
+        return _archived_log_response(log_path, tail)
+
+    try:
+        pods = KubeApi.instance().get_job_pods(jobname, namespace=DEFAULT_JOB_NS)
+    except ApiException as e:
+        abort(e.status, "Error when get job log: {}".format(str(e)))
+    if pods.items:
+        return _live_log_response(pods.items[0].metadata.name, tail)
+
+    log_path = get_job_log_path(jobname, job.version)
+    if log_path is None:
+        abort(404, "no log, please retry")
+    return _archived_log_response(log_path, tail)
@@ -7,26 +7,35 @@ from flask import g, current_app, request, url_for
 from json.decoder import JSONDecodeError
 from marshmallow import ValidationError
 import gevent
+import gevent.pool
+from werkzeug.exceptions import HTTPException
 from geventwebsocket.exceptions import WebSocketError
 from urllib3.exceptions import ProtocolError
 import redis_lock
 
 from console.libs.utils import (
-    logger, make_app_watcher_channel_name, make_msg, make_errmsg, send_email, bearychat_sendmsg,
+    logger, make_app_watcher_channel_name, make_msg, make_errmsg,
     make_app_redis_key,
 )
 from console.libs.jsonutils import VersatileEncoder
-from console.libs.k8s import KubeApi, ApiException
+from console.libs.notify import notify_email, notify_bearychat
+from console.libs.publisher import project_pod
+from console.libs.pubsub import get_pubsub_hub, SubscriptionOverflow
+from console.libs.taskoutput import iter_task_output
+from console.libs.k8s import KubeApi, KubeError, ApiException
 from console.libs.validation import (
-    build_args_schema, cluster_canary_schema, pod_entry_schema
+    build_args_schema, cluster_canary_schema, pod_entry_schema, batch_deploy_schema,
+    rollout_args_schema, job_restart_args_schema,
 )
 from console.libs.view import create_api_blueprint
-from console.models import App, Job, User, get_current_user
-from console.tasks import celery_task_stream_response, build_image
+from console.models import App, Job, User, SpecVersion, OPLog, OPType, AppYaml, get_current_user
+from console.api.app import lock_app, check_deploy_args, deploy_specs
+from console.libs.buildqueue import submit_build, cancel_build, get_build_position, get_fairness_key
 from console.ext import rds, db
 from console.config import (
     DEFAULT_APP_NS, DEFAULT_JOB_NS, WS_HEARTBEAT_TIMEOUT, FAKE_USER,
-    BEARYCHAT_CHANNEL, APP_BUILD_TIMEOUT,
+    BEARYCHAT_CHANNEL, APP_BUILD_TIMEOUT, BATCH_DEPLOY_CONCURRENCY, DEPLOY_ROLLOUT_TIMEOUT,
+    JOB_DELETE_TIMEOUT, JOB_RESTART_QUEUE_TIMEOUT, WATCHER_COMPACT_EVENTS, BUILD_QUEUE_POLL_INTERVAL,
 )
 
 ws = create_api_blueprint('ws', __name__, url_prefix='ws', jsonize=False, handle_http_error=False)
@@ -75,6 +84,51 @@ def ignore_socket_dead(f):
     return _inner
 
 
+def with_output_id(content, output_id):
+    """
+    add the entry id of the task output to the message,
+    the client can resume from it with `last_id` after reconnecting.
+    """
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if not isinstance(data, dict):
+        return content
+    data['output_id'] = output_id
+    # keep the framing of the message, e.g. the trailing newline added by `make_msg`
+    return json.dumps(data) + content[len(content.rstrip('\n')):]
+
+
+def check_compact_pod_event(content, versions, cluster, namespace):
+    """
+    the patch of a compact pod event is generated against the last projection published by the watcher,
+    if the client doesn't have that version(e.g. it connected in the middle of a rolling update),
+    send the full projection of the pod instead.
+    :param versions: pod name -> resource version the client has
+    :return: the message to send, None if nothing should be sent
+    """
+    data = json.loads(content)
+    if 'patch' not in data:
+        meta = data['object']['metadata']
+        if data['action'] == 'DELETED':
+            versions.pop(meta['name'], None)
+        else:
+            versions[meta['name']] = meta['resource_version']
+        return content
+
+    name = data['name']
+    if versions.get(name) == data['base_version']:
+        versions[name] = data['resource_version']
+        return content
+
+    pod = KubeApi.instance().get_pod(name, cluster_name=cluster, namespace=namespace, ignore_404=True)
+    if pod is None:
+        return None
+    versions[name] = pod.metadata.resource_version
+    return json.dumps({'object': project_pod(pod), 'action': 'MODIFIED'}, cls=VersatileEncoder)
+
+
 @ws.route('/app/<appname>/pods/events')
 @ignore_socket_dead
 @ws_user_require(False)
@@ -114,16 +168,21 @@ def get_app_pods_events(socket, appname):
     # otherwise we may get error like `sqlalchemy.exc.TimeoutError: QueuePool limit of size 50 overflow 10 reached, connection timed out`
     with session_removed():
         pod_list = KubeApi.instance().get_app_pods(name, cluster_name=cluster, namespace=ns)
-        pods = pod_list.to_dict()
-        for item in pods['items']:
+        # pod name -> resource version sent to client, only used for compact events
+        versions = {}
+        for pod in pod_list.items:
+            if WATCHER_COMPACT_EVENTS:
+                versions[pod.metadata.name] = pod.metadata.resource_version
+                item = project_pod(pod)
+            else:
+                item = pod.to_dict()
             data = {
                 'object': item,
                 'action': "ADDED",
             }
             socket.send(json.dumps(data, cls=VersatileEncoder))
 
-        pubsub = rds.pubsub()
-        pubsub.subscribe(channel)
+        sub = get_pubsub_hub().subscribe([channel])
         need_exit = False
 
         def check_client_socket():
@@ -157,29 +216,84 @@ def get_app_pods_events(socket, appname):
         try:
 
             while need_exit is False:
-                resp = pubsub.get_message(timeout=30)
+                resp = sub.get(timeout=30)
                 if resp is None:
                     continue
 
-                if resp['type'] == 'message':
-                    raw_content = resp['data']
-                    # omit the initial message where resp['data'] is 1L
-                    if not isinstance(raw_content, (bytes, str)):
+                content = resp[1]
+                if isinstance(content, bytes):
+                    content = content.decode('utf-8')
+                if WATCHER_COMPACT_EVENTS:
+                    content = check_compact_pod_event(content, versions, cluster, ns)
+                    if content is None:
                         continue
-                    content = raw_content
-                    if isinstance(content, bytes):
-                        content = content.decode('utf-8')
-                    socket.send(content)
-                    socket_active_ts = time.time()
+                socket.send(content)
+                socket_active_ts = time.time()
+        except SubscriptionOverflow:
+            # some events are dropped, the client should reconnect to get the full pod list
+            socket.send(make_errmsg('too many pod events, please reconnect', jsonize=True))
         finally:
-            # need close the connection created by PUB/SUB,
-            # otherwise it will cause too many redis connections
-            pubsub.unsubscribe()
-            pubsub.close()
+            sub.close()
             need_exit = True
     logger.info("ws connection closed")
 
 
+@ws.route('/app/<appname>/rollout/events')
+@ignore_socket_dead
+@ws_user_require(False)
+def get_app_rollout_events(socket, appname):
+    """
+    stream the rollout status of the app's deployment until it is finished, failed or timeout
+    ---
+    responses:
+      200:
+        description: multiple stream messages
+        schema:
+          $ref: '#/definitions/StreamMessage'
+    """
+    payload = None
+    while True:
+        message = socket.receive()
+        if message is None:
+            return
+        try:
+            payload = rollout_args_schema.loads(message)
+            break
+        except ValidationError as e:
+            socket.send(json.dumps(e.messages))
+        except JSONDecodeError as e:
+            socket.send(json.dumps({'error': str(e)}))
+
+    args = payload.data
+    cluster = args['cluster']
+    timeout = args.get('timeout', DEPLOY_ROLLOUT_TIMEOUT)
+    name = "{}-canary".format(appname) if args['canary'] else appname
+    ns = DEFAULT_APP_NS
+
+    app = App.get_by_name(appname)
+    if not app:
+        socket.send(make_errmsg('app {} not found'.format(appname), jsonize=True))
+        return
+
+    if not g.user.granted_to_app(app):
+        socket.send(make_errmsg('You\'re not granted to this app, ask administrators for permission', jsonize=True))
+        return
+
+    status = None
+    with session_removed():
+        try:
+            for status in KubeApi.instance().watch_rollout(name, cluster_name=cluster, namespace=ns, timeout=timeout):
+                socket.send(make_msg("Rolling", raw_data=status, success=not status['failed'],
+                                     msg=status['msg'], jsonize=True))
+        except (ApiException, KubeError) as e:
+            socket.send(make_errmsg("Error when watch rollout status: {}".format(str(e)), jsonize=True))
+            return
+    if status is not None and status['done']:
+        socket.send(make_msg("Finished", raw_data=status, msg=status['msg'], jsonize=True))
+    elif status is not None and not status['failed']:
+        socket.send(make_errmsg("deployment {} isn't rolled out in {} seconds".format(name, timeout), jsonize=True))
+
+
 @ws.route('/app/<appname>/build')
 @ignore_socket_dead
 @ws_user_require(False)
@@ -192,6 +306,9 @@ def build_app(socket, appname):
         properties:
           tag:
             type: object
+          last_id:
+            type: string
+            description: when attaching to a running build, only send the output after this `output_id`
 
     parameters:
       - name: appname
@@ -220,9 +337,11 @@ def build_app(socket, appname):
     client_closed = False
 
     phase = ""
+    # the messages of the images built concurrently are interleaved
+    image = None
 
     def handle_msg(ss):
-        nonlocal phase
+        nonlocal phase, image
         try:
             m = json.loads(ss)
         except:
@@ -230,9 +349,12 @@ def build_app(socket, appname):
         if m['success'] is False:
             total_msg.append(m['error'])
             return False
-        if phase != m['phase']:
-            phase = m['phase']
-            total_msg.append("***** PHASE {}".format(m['phase']))
+        if phase != m['phase'] or image != m.get('image'):
+            phase, image = m['phase'], m.get('image')
+            if image:
+                total_msg.append("***** PHASE {} {}".format(phase, image))
+            else:
+                total_msg.append("***** PHASE {}".format(phase))
 
         raw_data = m.get('raw_data', None)
         if raw_data is None:
@@ -310,20 +432,33 @@ def build_app(socket, appname):
     lck = redis_lock.Lock(rds, lock_name, expire=30, auto_renewal=True)
     with gevent.Timeout(APP_BUILD_TIMEOUT, False):
         if lck.acquire(blocking=block):
-            async_result = build_image.delay(appname, tag)
-            rds.hset(app_redis_key, "build-task-id", async_result.task_id)
+            build_id = submit_build(app, tag)
+            rds.hset(app_redis_key, "build-task-id", build_id)
+            fairness_key = get_fairness_key(app)
 
             db.session.remove()
             try:
-                for m in celery_task_stream_response(async_result.task_id, 900):
+                # wait for the build to be taken by a build worker
+                last_position = None
+                while True:
+                    position = get_build_position(build_id, fairness_key)
+                    if position is None:
+                        break
+                    if position != last_position and client_closed is False:
+                        last_position = position
+                        socket.send(make_msg("Queued", msg="{} builds ahead in the build queue".format(position), jsonize=True))
+                    gevent.sleep(BUILD_QUEUE_POLL_INTERVAL)
+
+                for item in iter_task_output(build_id, timeout=900):
                     # after 10 minutes, we still can't get output message, so we exit the build task
-                    if m is None:
-                        async_result.revoke(terminate=True)
+                    if item is None:
+                        cancel_build(build_id, app)
                         socket.send(make_errmsg("doesn't receive any messages in last 15 minutes, build task for app {} seems to be stuck".format(appname), jsonize=True))
                         break
+                    m = item[2]
                     try:
                         if client_closed is False:
-                            socket.send(m)
+                            socket.send(with_output_id(m, item[1]))
                     except WebSocketError as e:
                         client_closed = True
                         logger.warn("Can't send build msg to client: {}".format(str(e)))
@@ -331,11 +466,11 @@ def build_app(socket, appname):
                     if handle_msg(m) is False:
                         break
             except gevent.Timeout:
-                async_result.revoke(terminate=True)
+                cancel_build(build_id, app)
                 logger.debug("********* build gevent timeout")
                 socket.send(make_errmsg("timeout when build app {}".format(appname), jsonize=True))
             except Exception as e:
-                async_result.revoke(terminate=True)
+                cancel_build(build_id, app)
                 socket.send(make_errmsg("error when build app {}: {}".format(appname, str(e)), jsonize=True))
             finally:
                 lck.release()
@@ -361,8 +496,8 @@ def build_app(socket, appname):
 </div>'''
                 email_text = email_text_tpl.format(text_title, html.escape("\n".join(total_msg)) + '\n' + build_result_text)
                 email_list = [u.email for u in app.users]
-                send_email(email_list, subject, email_text)
-                bearychat_sendmsg(BEARYCHAT_CHANNEL, bearychat_msg)
+                notify_email(email_list, subject, email_text)
+                notify_bearychat(BEARYCHAT_CHANNEL, bearychat_msg)
         else:
             socket.send(make_msg("Unknown", msg="there seems exist another build task, try to fetch output", jsonize=True))
             build_task_id = rds.hget(app_redis_key, "build-task-id")
@@ -371,21 +506,174 @@ def build_app(socket, appname):
                 return
             if isinstance(build_task_id, bytes):
                 build_task_id = build_task_id.decode('utf8')
-            for m in celery_task_stream_response(build_task_id, 900):
+            # replay the output from the beginning(or from where the client left off)
+            start_ids = {build_task_id: args.get('last_id')}
+            for item in iter_task_output(build_task_id, start_ids=start_ids, timeout=900):
                 # after 10 minutes, we still can't get output message, so we exit the build task
                 try:
-                    if m is None:
+                    if item is None:
                         socket.send(make_errmsg("doesn't receive any messages in last 15 minutes, build task for app {} seems to be stuck".format(appname), jsonize=True))
                         break
+                    m = item[2]
                     if handle_msg(m) is False:
                         break
                     if client_closed is False:
-                        socket.send(m)
+                        socket.send(with_output_id(m, item[1]))
                 except WebSocketError as e:
                     client_closed = True
                     break
 
 
+@ws.route('/apps/deploy')
+@ignore_socket_dead
+@ws_user_require(False)
+def batch_deploy_apps(socket):
+    """
+    deploy multiple apps in one request.
+    all the items are validated first, nothing is deployed if any of them is invalid,
+    then the apps are rolled out concurrently and the result of every item is streamed.
+    ---
+    definitions:
+      BatchDeployArgs:
+        type: object
+        properties:
+          items:
+            type: array
+            items:
+              $ref: '#/definitions/DeployArgs'
+    parameters:
+      - name: batch_deploy_args
+        in: body
+        required: true
+        schema:
+          $ref: '#/definitions/BatchDeployArgs'
+    responses:
+      200:
+        description: multiple stream messages
+        schema:
+          $ref: '#/definitions/StreamMessage'
+    """
+    payload = None
+    while True:
+        message = socket.receive()
+        if message is None:
+            return
+        try:
+            payload = batch_deploy_schema.loads(message)
+            break
+        except ValidationError as e:
+            socket.send(json.dumps(e.messages))
+        except JSONDecodeError as e:
+            socket.send(json.dumps({'error': str(e)}))
+
+    items = payload.data['items']
+    total = len(items)
+    errors = []
+
+    def item_info(item):
+        return {'appname': item['appname'], 'cluster': item['cluster'], 'tag': item['tag']}
+
+    # the database is only accessed in this greenlet,
+    # the greenlets in the pool only talk to kubernetes
+    candidates = []
+    for item in items:
+        appname = item['appname']
+        app = App.get_by_name(appname)
+        if not app:
+            errors.append((item, 'app {} not found'.format(appname)))
+            continue
+        if not g.user.granted_to_app(app):
+            errors.append((item, 'You\'re not granted to this app, ask administrators for permission'))
+            continue
+        app_yaml = AppYaml.get_by_app_and_name(app, item['app_yaml_name'])
+        if not app_yaml:
+            errors.append((item, "AppYaml {} doesn't exist.".format(item['app_yaml_name'])))
+            continue
+        release = app.get_release_by_tag(item['tag'])
+        if not release:
+            errors.append((item, 'release {} not found.'.format(item['tag'])))
+            continue
+        candidates.append((item, app, app_yaml, release))
+
+    def check(candidate):
+        item, app, app_yaml, release = candidate
+        try:
+            specs = check_deploy_args(item['appname'], app_yaml, release, item['cluster'], item)
+            return candidate, specs, None
+        except HTTPException as e:
+            return candidate, None, e.description
+        except ApiException as e:
+            return candidate, None, "Error when check deploy args: {}".format(str(e))
+        except Exception as e:
+            logger.exception("kubernetes error ")
+            return candidate, None, 'kubernetes error: {}'.format(str(e))
+
+    def rollout(task):
+        item, app, specs = task
+        try:
+            deploy_specs(specs, item['tag'], item['cluster'])
+            return task, None
+        except HTTPException as e:
+            return task, e.description
+        except Exception as e:
+            logger.exception("kubernetes error ")
+            return task, 'kubernetes error: {}'.format(str(e))
+
+    pool = gevent.pool.Pool(BATCH_DEPLOY_CONCURRENCY)
+    with contextlib.ExitStack() as stack:
+        # acquire the locks in order to avoid deadlock with other batch requests
+        for appname in sorted(set(item['appname'] for item in items)):
+            stack.enter_context(lock_app(appname))
+
+        tasks = []
+        for candidate, specs, error in pool.imap_unordered(check, candidates):
+            item, app = candidate[0], candidate[1]
+            if error is not None:
+                errors.append((item, error))
+            else:
+                tasks.append((item, app, specs))
+
+        if errors:
+            for item, error in errors:
+                socket.send(make_msg("Validating", raw_data=item_info(item), success=False, error=error, jsonize=True))
+            socket.send(make_errmsg("{} of {} items are invalid, nothing is deployed".format(len(errors), total), jsonize=True))
+            return
+
+        deploy_tasks = []
+        for item, app, specs in tasks:
+            try:
+                SpecVersion.create(app, item['tag'], specs)
+            except:
+                logger.exception("can't create spec version")
+                errors.append((item, "internal server error"))
+                socket.send(make_msg("Deploying", raw_data=item_info(item), success=False, error="internal server error", jsonize=True))
+                continue
+            deploy_tasks.append((item, app, specs))
+
+        done = len(errors)
+        for (item, app, specs), error in pool.imap_unordered(rollout, deploy_tasks):
+            done += 1
+            progress = done * 100 // total
+            if error is not None:
+                errors.append((item, error))
+                socket.send(make_msg("Deploying", raw_data=item_info(item), success=False, error=error, progress=progress, jsonize=True))
+                continue
+            OPLog.create(
+                user_id=g.user.id,
+                app_id=app.id,
+                cluster=item['cluster'],
+                appname=item['appname'],
+                tag=item['tag'],
+                action=OPType.DEPLOY_APP,
+            )
+            socket.send(make_msg("Deploying", raw_data=item_info(item), msg="deployed", progress=progress, jsonize=True))
+
+    if errors:
+        socket.send(make_errmsg("{} of {} items failed to deploy".format(len(errors), total), jsonize=True))
+    else:
+        socket.send(make_msg("Finished", msg="{} items deployed".format(total), progress=100, jsonize=True))
+
+
 @ws.route('/job/<jobname>/log/events')
 @ignore_socket_dead
 @ws_user_require(False)
@@ -423,6 +711,47 @@ def get_job_log_events(socket, jobname):
             socket.send(json.dumps({"error": "no log, please retry"}))
 
 
+@ws.route('/job/<jobname>/restart')
+@ignore_socket_dead
+@ws_user_require(False)
+def restart_job_events(socket, jobname):
+    """
+    follow the progress of a job restart, the first message is the `task_id` returned by the restart api
+    ---
+    parameters:
+      - name: task_id
+        type: string
+        required: true
+    responses:
+      200:
+        description: multiple stream messages
+        schema:
+          $ref: '#/definitions/StreamMessage'
+    """
+    payload = None
+    while True:
+        message = socket.receive()
+        if message is None:
+            return
+        try:
+            payload = job_restart_args_schema.loads(message)
+            break
+        except ValidationError as e:
+            socket.send(json.dumps(e.messages))
+        except JSONDecodeError as e:
+            socket.send(json.dumps({'error': str(e)}))
+
+    task_id = payload.data['task_id']
+    # the task may wait in the queue, then wait up to JOB_DELETE_TIMEOUT seconds for the deletion
+    timeout = JOB_DELETE_TIMEOUT + JOB_RESTART_QUEUE_TIMEOUT
+    with session_removed():
+        for item in iter_task_output(task_id, timeout=timeout):
+            if item is None:
+                socket.send(make_errmsg("timeout when restart job {}".format(jobname), jsonize=True))
+                break
+            socket.send(item[2])
+
+
 @ws.route('/app/<appname>/entry')
 @ignore_socket_dead
 @ws_user_require(False)
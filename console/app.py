@@ -15,13 +15,12 @@ from flasgger import Swagger
 from werkzeug.utils import import_string
 
 from console.config import (
-    DEBUG, SENTRY_DSN, TASK_PUBSUB_CHANNEL,
-    TASK_PUBSUB_EOF, BEARYCHAT_CHANNEL,
+    DEBUG, SENTRY_DSN, BEARYCHAT_CHANNEL, K8S_INFORMER_ENABLED,
 )
-from console.ext import sess, db, mako, cache, init_oauth, rds, sockets
+from console.ext import sess, db, mako, cache, init_oauth, sockets
 from console.libs.datastructure import DateConverter
 from console.libs.jsonutils import VersatileEncoder
-from console.libs.utils import bearychat_sendmsg
+from console.libs.taskoutput import append_task_output, finish_task_output
 
 
 if DEBUG:
@@ -190,6 +189,9 @@ definitions:
         type: object
       progress:
         type: string
+      image:
+        type: string
+        description: the image the message belongs to, only for the build messages
 """
 
 
@@ -202,20 +204,21 @@ def make_celery(app):
         abstract = True
 
         def stream_output(self, data, task_id=None):
-            channel_name = TASK_PUBSUB_CHANNEL.format(task_id=task_id or self.request.id)
-            rds.publish(channel_name, json.dumps(data, cls=VersatileEncoder))
+            append_task_output(task_id or self.request.id, json.dumps(data, cls=VersatileEncoder))
 
         def on_success(self, retval, task_id, args, kwargs):
-            channel_name = TASK_PUBSUB_CHANNEL.format(task_id=task_id)
-            rds.publish(channel_name, TASK_PUBSUB_EOF.format(task_id=task_id))
+            finish_task_output(task_id)
 
         def on_failure(self, exc, task_id, args, kwargs, einfo):
-            channel_name = TASK_PUBSUB_CHANNEL.format(task_id=task_id)
             failure_msg = {'error': str(exc), 'args': args, 'kwargs': kwargs}
-            rds.publish(channel_name, json.dumps(failure_msg, cls=VersatileEncoder))
-            rds.publish(channel_name, TASK_PUBSUB_EOF.format(task_id=task_id))
+            append_task_output(task_id, json.dumps(failure_msg, cls=VersatileEncoder))
+            finish_task_output(task_id)
+            if self.name == 'console.tasks.send_notifications':
+                # don't notify the failure of notifications
+                return
+            from console.libs.notify import notify_bearychat
             msg = 'Console task {}:\nargs\n```\n{}\n```\nkwargs:\n```\n{}\n```\nerror message:\n```\n{}\n```'.format(self.name, args, kwargs, str(exc))
-            bearychat_sendmsg(BEARYCHAT_CHANNEL, msg)
+            notify_bearychat(BEARYCHAT_CHANNEL, msg)
 
         def __call__(self, *args, **kwargs):
             with app.app_context():
@@ -300,8 +303,11 @@ def create_app():
 
     @app.before_first_request
     def prepare_k8s():
-        # placeholder to prepare environment
-        pass
+        # only the web workers need the informers, so start them here
+        # instead of in KubeApi, the celery workers and pods watcher never serve requests.
+        if K8S_INFORMER_ENABLED:
+            from console.libs.k8s import KubeApi
+            KubeApi.instance().start_informers()
 
     return app
 
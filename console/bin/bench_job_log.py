@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark of the job log archival: compare reading the whole log into memory
+with streaming it in chunks(plain and gzip), no kubernetes cluster is needed:
+
+    python -m console.bin.bench_job_log --size 512 --chunk-size 65536
+"""
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from console.libs.utils import save_job_log
+
+LINE = b'2019-01-02 03:04:05,678 INFO [worker-1] processed batch 12345 in 0.123s, 1000 records, offset 9876543\n'
+
+
+def generate_log(size, chunk_size):
+    """
+    yield `size` bytes of log in chunks, like the response of kubernetes
+    """
+    chunk = (LINE * (chunk_size // len(LINE) + 1))[:chunk_size]
+    remaining = size
+    while remaining > 0:
+        yield chunk[:remaining]
+        remaining -= chunk_size
+
+
+def bench(name, root_dir, make_resp, compress):
+    tracemalloc.start()
+    start = time.time()
+    size = save_job_log('bench', make_resp(), version=0, compress=compress, root_dir=root_dir)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<12} {:>8.1f} MB/s  {:>8.3f}s  peak memory {:>8.1f} MB".format(
+        name, size / elapsed / 1024 / 1024, elapsed, peak / 1024 / 1024))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the job log archival')
+    parser.add_argument('--size', type=int, default=256, help="size of the log in MB")
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help="chunk size in bytes")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    size = args.size * 1024 * 1024
+    root_dir = tempfile.mkdtemp()
+    try:
+        bench("in-memory", root_dir, lambda: b''.join(generate_log(size, args.chunk_size)), False)
+        bench("stream", root_dir, lambda: generate_log(size, args.chunk_size), False)
+        bench("stream-gzip", root_dir, lambda: generate_log(size, args.chunk_size), True)
+    finally:
+        shutil.rmtree(root_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+micro-benchmark of the pod watcher: compare the event throughput of
+model mode(deserialize every event into V1Pod) and raw mode(work on the raw json).
+no kubernetes cluster or redis is needed:
+
+    python -m console.bin.bench_watch --events 5000 --compact
+"""
+import json
+import time
+import argparse
+
+from kubernetes import watch
+
+from console.libs.publisher import FullPodEncoder, CompactPodEncoder
+
+
+def make_pod_event(idx, action='MODIFIED'):
+    # 100 pods, every pod is modified many times
+    name = 'hello-5d8f7c9b6-{:05d}'.format(idx % 100)
+    pod = {
+        'kind': 'Pod',
+        'apiVersion': 'v1',
+        'metadata': {
+            'name': name,
+            'namespace': 'kae-app',
+            'uid': '0f5b3c1e-1234-11e9-8f3a-00163e0a{:04d}'.format(idx % 10000),
+            'resourceVersion': str(100000 + idx),
+            'creationTimestamp': '2019-01-02T03:04:05Z',
+            'labels': {'kae': 'true', 'kae-type': 'app', 'kae-app-name': 'hello', 'pod-template-hash': '5d8f7c9b6'},
+            'annotations': {'release_tag': 'v0.1.{}'.format(idx)},
+            'ownerReferences': [{
+                'apiVersion': 'extensions/v1beta1', 'kind': 'ReplicaSet', 'name': 'hello-5d8f7c9b6',
+                'uid': '0f5b3c1e-1234-11e9-8f3a-00163e0affff', 'controller': True, 'blockOwnerDeletion': True,
+            }],
+        },
+        'spec': {
+            'volumes': [
+                {'name': 'cephfs', 'hostPath': {'path': '/cephfs', 'type': ''}},
+                {'name': 'default-token-abcde', 'secret': {'secretName': 'default-token-abcde', 'defaultMode': 420}},
+            ],
+            'containers': [{
+                'name': 'hello',
+                'image': 'registry.cn-hangzhou.aliyuncs.com/kae/hello:v0.1.{}'.format(idx),
+                'command': ['python', 'app.py'],
+                'ports': [{'containerPort': 8080, 'protocol': 'TCP'}],
+                'env': [{'name': 'ENV_{}'.format(i), 'value': 'value-{}'.format(i)} for i in range(20)],
+                'resources': {'limits': {'cpu': '1', 'memory': '512Mi'}, 'requests': {'cpu': '500m', 'memory': '256Mi'}},
+                'volumeMounts': [
+                    {'name': 'cephfs', 'mountPath': '/cephfs'},
+                    {'name': 'default-token-abcde', 'readOnly': True, 'mountPath': '/var/run/secrets/kubernetes.io/serviceaccount'},
+                ],
+                'terminationMessagePath': '/dev/termination-log',
+                'terminationMessagePolicy': 'File',
+                'imagePullPolicy': 'IfNotPresent',
+            }],
+            'restartPolicy': 'Always',
+            'terminationGracePeriodSeconds': 30,
+            'dnsPolicy': 'ClusterFirst',
+            'serviceAccountName': 'default',
+            'nodeName': 'node-{}'.format(idx % 50),
+            'securityContext': {},
+            'schedulerName': 'default-scheduler',
+        },
+        'status': {
+            'phase': 'Running',
+            'conditions': [
+                {'type': t, 'status': 'True', 'lastProbeTime': None, 'lastTransitionTime': '2019-01-02T03:04:06Z'}
+                for t in ('Initialized', 'Ready', 'ContainersReady', 'PodScheduled')
+            ],
+            'hostIP': '10.0.0.{}'.format(idx % 250),
+            'podIP': '172.16.{}.{}'.format(idx % 250, idx % 200),
+            'startTime': '2019-01-02T03:04:05Z',
+            'containerStatuses': [{
+                'name': 'hello',
+                'state': {'running': {'startedAt': '2019-01-02T03:04:10Z'}},
+                'lastState': {},
+                'ready': True,
+                'restartCount': idx % 3,
+                'image': 'registry.cn-hangzhou.aliyuncs.com/kae/hello:v0.1.{}'.format(idx),
+                'imageID': 'docker-pullable://registry.cn-hangzhou.aliyuncs.com/kae/hello@sha256:abcdef',
+                'containerID': 'docker://0123456789abcdef',
+            }],
+            'qosClass': 'Burstable',
+        },
+    }
+    return json.dumps({'type': action, 'object': pod})
+
+
+def bench(name, lines, decode, encoder):
+    start = time.time()
+    size = 0
+    for line in lines:
+        event = decode(line)
+        obj = event['object']
+        podname = obj['metadata']['name'] if isinstance(obj, dict) else obj.metadata.name
+        size += len(encoder.encode('bench', podname, event['type'], obj))
+    elapsed = time.time() - start
+    print("{:<8} {:>10.0f} events/s  {:>8.3f}s  {:>8.0f} bytes/event".format(
+        name, len(lines) / elapsed, elapsed, size / len(lines)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the pod watcher')
+    parser.add_argument('--events', type=int, default=5000, help="number of events")
+    parser.add_argument('--compact', action='store_true', help="publish compact events")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lines = [make_pod_event(i, action='ADDED' if i < 100 else 'MODIFIED') for i in range(args.events)]
+    make_encoder = CompactPodEncoder if args.compact else FullPodEncoder
+
+    w = watch.Watch()
+    bench("model", lines, lambda line: w.unmarshal_event(line, 'V1Pod'), make_encoder())
+    bench("raw", lines, json.loads, make_encoder())
+
+
+if __name__ == '__main__':
+    main()
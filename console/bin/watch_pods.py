@@ -1,17 +1,30 @@
 # -*- coding: utf-8 -*-
-import json
+import os
+import time
+import math
+import uuid
+import random
+import socket
 import argparse
 import threading
+from kubernetes import client
 from urllib3.exceptions import ProtocolError
 
 # must import celery before import tasks
-from console.app import celery
+from console.app import app, celery
 from console.libs.utils import logger
-from console.libs.k8s import KubeApi
+from console.libs.k8s import KubeApi, ApiException
 from console.libs.utils import make_app_watcher_channel_name
-from console.libs.jsonutils import VersatileEncoder
-from console.tasks import handle_job_pod_event
+from console.libs.publisher import CoalescingPublisher, CompactPodEncoder
+from console.libs.reconciler import JobStatusReconciler
+from console.libs.watcher import ShardLease, make_watcher_shards, report_replica_status, remove_replica
+from console.tasks import handle_job_pod_event, save_pod_log
 from console.ext import rds
+from console.config import (
+    WATCHER_COALESCE_WINDOW, WATCHER_COMPACT_EVENTS, WATCHER_RAW_MODE,
+    WATCHER_RESOURCE_VERSION_SAVE_INTERVAL, WATCHER_LEASE_TTL, WATCHER_WATCH_TIMEOUT,
+    WATCHER_JOB_RECONCILE_INTERVAL,
+)
 
 
 def spawn(target, *args, **kw):
@@ -21,69 +34,360 @@ def spawn(target, *args, **kw):
     return t
 
 
+def pod_meta(obj):
+    """
+    :param obj: V1Pod object or the raw dict of the pod
+    :return: (namespace, name, labels, resource version)
+    """
+    if isinstance(obj, dict):
+        meta = obj['metadata']
+        return meta.get('namespace'), meta['name'], meta.get('labels') or {}, meta.get('resourceVersion')
+    meta = obj.metadata
+    return meta.namespace, meta.name, meta.labels or {}, meta.resource_version
+
+
+class ClusterPodWatcher(object):
+    """
+    watch the pods of a shard(the app and job pods of a cluster, or only one type of them).
+    the last resource version is saved in redis, so the watcher resumes from it after restart.
+    when the resource version is too old(410 Gone), relist the pods and only publish the changed pods.
+    """
+    RETRY_INTERVAL = 5
+
+    def __init__(self, shard_id, cluster, label_selector, publisher, reconciler=None, raw=False):
+        self.shard_id = shard_id
+        self.cluster = cluster
+        self.label_selector = label_selector
+        self.publisher = publisher
+        # update the job status in the watcher process, otherwise send every event to celery
+        self.reconciler = reconciler
+        self.raw = raw
+
+        self.resource_version = None
+        # (namespace, name) -> (resource version, labels) of the pods seen by the watcher
+        self.known = {}
+        # number of events handled, used to compute events/sec
+        self.event_count = 0
+        self._rv_key = "kae-watcher-shard-{}-resource-version".format(shard_id)
+        self._rv_saved_ts = 0
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """
+        the watcher stops after the current watch request returns(at most WATCHER_WATCH_TIMEOUT seconds),
+        or before it handles the next event. nothing is dispatched or saved after it's stopped.
+        """
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def load_resource_version(self):
+        rv = rds.get(self._rv_key)
+        if isinstance(rv, bytes):
+            rv = rv.decode('utf8')
+        return rv
+
+    def save_resource_version(self, force=False):
+        now = time.time()
+        # the shard may be watched by another replica now, don't overwrite its resource version
+        if self.resource_version is None or self.stopped:
+            return
+        if force or now - self._rv_saved_ts >= WATCHER_RESOURCE_VERSION_SAVE_INTERVAL:
+            rds.set(self._rv_key, self.resource_version)
+            self._rv_saved_ts = now
+
+    def _to_raw(self, obj):
+        if isinstance(obj, dict):
+            return obj
+        return KubeApi.instance().get_cluster(self.cluster).api_client.sanitize_for_serialization(obj)
+
+    def _make_deleted_pod(self, namespace, name, labels, resource_version):
+        if self.raw:
+            return {'metadata': {'namespace': namespace, 'name': name, 'labels': labels, 'resourceVersion': resource_version}}
+        meta = client.V1ObjectMeta(namespace=namespace, name=name, labels=labels, resource_version=resource_version)
+        return client.V1Pod(metadata=meta, status=client.V1PodStatus())
+
+    def dispatch(self, action, obj, raw_object=None):
+        if self.stopped:
+            return
+        namespace, name, labels, resource_version = pod_meta(obj)
+        if action == 'DELETED':
+            self.known.pop((namespace, name), None)
+        else:
+            self.known[(namespace, name)] = (resource_version, labels)
+
+        if 'kae-app-name' in labels:
+            appname = labels['kae-app-name']
+            channel = make_app_watcher_channel_name(self.cluster, appname)
+            self.publisher.publish(channel, name, action, obj)
+        elif 'kae-job-name' in labels:
+            self.dispatch_job(action, labels['kae-job-name'], obj, raw_object)
+
+    def dispatch_job(self, action, jobname, obj, raw_object=None):
+        if self.stopped:
+            return
+        if action == 'DELETED':
+            if self.reconciler is not None:
+                self.reconciler.forget(jobname)
+            return
+        raw_object = raw_object or self._to_raw(obj)
+        if self.reconciler is not None:
+            self.reconciler.submit(jobname, raw_object)
+        else:
+            handle_job_pod_event.delay(jobname, raw_object)
+
+    def relist(self, publish=True, resume=False):
+        """
+        list the pods and publish the pods changed since the last seen version
+        :param publish: only record the pods, don't publish them. the job pods are still sent
+                        to the job status handler, the jobs may change when the watcher is down.
+        :param resume: keep the resource version, the watcher resumes from it
+        """
+        pods = KubeApi.instance().list_all_pods(cluster_name=self.cluster, label_selector=self.label_selector, raw=self.raw)
+        if self.raw:
+            items, resource_version = pods['items'], pods['metadata']['resourceVersion']
+        else:
+            items, resource_version = pods.items, pods.metadata.resource_version
+
+        current = set()
+        changed = 0
+        for obj in items:
+            namespace, name, labels, rv = pod_meta(obj)
+            current.add((namespace, name))
+            old = self.known.get((namespace, name))
+            if old is not None and old[0] == rv:
+                continue
+            if publish:
+                changed += 1
+                self.dispatch('ADDED' if old is None else 'MODIFIED', obj)
+            else:
+                self.known[(namespace, name)] = (rv, labels)
+                if 'kae-job-name' in labels:
+                    self.dispatch_job('ADDED', labels['kae-job-name'], obj)
+        for key in list(self.known.keys()):
+            if key not in current:
+                rv, labels = self.known[key]
+                if publish:
+                    changed += 1
+                    self.dispatch('DELETED', self._make_deleted_pod(key[0], key[1], labels, rv))
+                else:
+                    self.known.pop(key)
+
+        logger.info("cluster {} relisted {} pods, {} changed".format(self.cluster, len(items), changed))
+        if not resume:
+            self.resource_version = resource_version
+            self.save_resource_version(force=True)
+
+    def watch(self):
+        """
+        watch from the last seen resource version until the server closes the stream.
+        :return: False if the resource version is too old and a relist is needed
+        """
+        kwargs = {
+            'cluster_name': self.cluster,
+            'label_selector': self.label_selector,
+            'timeout_seconds': WATCHER_WATCH_TIMEOUT,
+        }
+        if self.resource_version is not None:
+            kwargs['resource_version'] = self.resource_version
+        if self.raw:
+            watcher = KubeApi.instance().watch_pods_raw(allow_bookmarks=True, **kwargs)
+        else:
+            watcher = KubeApi.instance().watch_pods(allow_bookmarks=True, **kwargs)
+
+        for event in watcher:
+            if self._stopped.is_set():
+                return True
+            self.event_count += 1
+            obj = event['object']
+            if event['type'] == 'ERROR':
+                status = event.get('raw_object', obj)
+                logger.warn("cluster {} watch error: {}".format(self.cluster, status.get('message')))
+                return False
+            if event['type'] == 'BOOKMARK':
+                self.resource_version = obj['metadata']['resourceVersion']
+                self.save_resource_version(force=True)
+                continue
+
+            self.resource_version = pod_meta(obj)[3]
+            self.dispatch(event['type'], obj, event.get('raw_object', obj))
+            self.save_resource_version()
+        return True
+
+    def run(self):
+        need_list, publish, resume = False, True, False
+        if self.resource_version is None:
+            self.resource_version = self.load_resource_version()
+            if self.resource_version is None:
+                # the first time, the pods already exist don't need to be published
+                need_list, publish = True, False
+            elif not self.known:
+                # resume after restart(or from another replica), record the current pods first,
+                # so the relist after 410 only publishes the changed pods
+                need_list, publish, resume = True, False, True
+        while not self._stopped.is_set():
+            try:
+                if need_list:
+                    self.relist(publish=publish, resume=resume)
+                    need_list, publish, resume = False, True, False
+                need_list = not self.watch()
+            except ProtocolError:
+                logger.warn('skip this error... because kubernetes disconnect client after default 10m...')
+            except ApiException as e:
+                if e.status == 410:
+                    need_list = True
+                else:
+                    logger.exception("watch pods workers error")
+                    self._stopped.wait(self.RETRY_INTERVAL)
+            except Exception:
+                logger.exception("watch pods workers error")
+                self._stopped.wait(self.RETRY_INTERVAL)
+        logger.info("watcher of shard {} stopped".format(self.shard_id))
+
+
 class LongRunningWatcher(object):
-    def __init__(self, sync=False):
+    """
+    a replica of the pods watcher, the shards are split among the replicas:
+    every replica holds the leases of at most ceil(shards / replicas) shards and
+    watches them, when a replica dies, its leases expire and other replicas take them over.
+    """
+    def __init__(self, sync=False, raw=WATCHER_RAW_MODE):
         self.sync = sync
+        # work on the raw json of the events, don't deserialize them into models
+        self.raw = raw
+        self.replica_id = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.shards = make_watcher_shards(KubeApi.instance().cluster_names)
+        self.leases = {}
+        # shard id -> (thread, lease) of the stopped watchers whose threads are still running,
+        # the lease is released after the thread exits, so the shard is never watched twice
+        self.stopping = {}
         self.thread_map = {}
+        self.watcher_map = {}
+        encoder = CompactPodEncoder() if WATCHER_COMPACT_EVENTS else None
+        self.publisher = CoalescingPublisher(rds, window=WATCHER_COALESCE_WINDOW, encoder=encoder)
+        self.reconciler = None
+        if WATCHER_JOB_RECONCILE_INTERVAL > 0:
+            self.reconciler = JobStatusReconciler(app, self._save_pod_log, flush_interval=WATCHER_JOB_RECONCILE_INTERVAL)
+
+        self._last_event_counts = {}
+        self._last_report_ts = time.time()
+
+    @staticmethod
+    def _save_pod_log(jobname, podname, version):
+        save_pod_log.delay(jobname, podname, version)
 
     def start(self):
-        for name in KubeApi.instance().cluster_names:
-            logger.info("create watcher thread for cluster {}".format(name))
-            self.thread_map[name] = spawn(self.watch_app_job_pods, name)
+        logger.info("watcher replica {} started, {} shards in total".format(self.replica_id, len(self.shards)))
+        self.publisher.start()
+        if self.reconciler is not None:
+            self.reconciler.start()
+
+    def _start_shard(self, shard_id):
+        cluster, label_selector = self.shards[shard_id]
+        logger.info("create watcher thread for shard {}".format(shard_id))
+        watcher = ClusterPodWatcher(shard_id, cluster, label_selector, self.publisher,
+                                    reconciler=self.reconciler, raw=self.raw)
+        self.watcher_map[shard_id] = watcher
+        self.thread_map[shard_id] = spawn(watcher.run)
+
+    def _stop_shard(self, shard_id, lease_lost=False):
+        logger.info("stop watcher thread for shard {}".format(shard_id))
+        watcher = self.watcher_map.pop(shard_id, None)
+        if watcher is not None:
+            watcher.stop()
+        thread = self.thread_map.pop(shard_id, None)
+        self._last_event_counts.pop(shard_id, None)
+        lease = self.leases.pop(shard_id, None)
+        if lease is None or lease_lost:
+            return
+        if thread is not None and thread.is_alive():
+            self.stopping[shard_id] = (thread, lease)
+        else:
+            lease.release()
+
+    def _release_stopped_shards(self):
+        for shard_id, (thread, lease) in list(self.stopping.items()):
+            if not thread.is_alive():
+                del self.stopping[shard_id]
+                lease.release()
+            elif not lease.renew():
+                del self.stopping[shard_id]
+
+    def status(self):
+        now = time.time()
+        elapsed = max(now - self._last_report_ts, 1e-3)
+        events_per_sec = {}
+        for shard_id, watcher in self.watcher_map.items():
+            count = watcher.event_count
+            events_per_sec[shard_id] = round((count - self._last_event_counts.get(shard_id, 0)) / elapsed, 2)
+            self._last_event_counts[shard_id] = count
+        self._last_report_ts = now
+        return {
+            'shards': sorted(self.leases.keys()),
+            'events_per_sec': events_per_sec,
+        }
+
+    def balance(self):
+        self._release_stopped_shards()
+        for shard_id, lease in list(self.leases.items()):
+            if not lease.renew():
+                logger.warn("lost the lease of shard {}".format(shard_id))
+                self._stop_shard(shard_id, lease_lost=True)
+
+        for shard_id, t in list(self.thread_map.items()):
+            if not t.isAlive():
+                logger.info("shard {}'s watcher thread crashed, restart it".format(shard_id))
+                self.thread_map[shard_id] = spawn(self.watcher_map[shard_id].run)
+
+        replicas = report_replica_status(self.replica_id, self.status(), WATCHER_LEASE_TTL)
+        target = int(math.ceil(len(self.shards) / max(replicas, 1)))
+        if len(self.leases) > target:
+            # give the extra shards to other replicas
+            for shard_id in sorted(self.leases.keys())[target:]:
+                self._stop_shard(shard_id)
+        elif len(self.leases) < target:
+            candidates = [shard_id for shard_id in self.shards
+                          if shard_id not in self.leases and shard_id not in self.stopping]
+            random.shuffle(candidates)
+            for shard_id in candidates:
+                if len(self.leases) >= target:
+                    break
+                lease = ShardLease(shard_id, self.replica_id, WATCHER_LEASE_TTL)
+                if lease.acquire():
+                    self.leases[shard_id] = lease
+                    self._start_shard(shard_id)
 
     def wait(self):
-        while True:
-            for name, t in self.thread_map.items():
-                t.join(30)
-                if not t.isAlive():
-                    logger.info("cluster {}'s watcher thread crashed, restart it".format(name))
-                    self.thread_map[name] = spawn(self.watch_app_job_pods, name)
-
-    def watch_app_job_pods(self, cluster):
-        last_seen_version = None
-        label_selector = "kae-type in (app, job)"
-        while True:
-            try:
-                if last_seen_version is not None:
-                    watcher = KubeApi.instance().watch_pods(cluster_name=cluster, label_selector=label_selector, resource_version=last_seen_version)
-                else:
-                    watcher = KubeApi.instance().watch_pods(cluster_name=cluster, label_selector=label_selector)
-
-                for event in watcher:
-                    obj = event['object']
-                    labels = obj.metadata.labels or {}
-                    last_seen_version = obj.metadata.resource_version
-
-                    if 'kae-app-name' in labels:
-                        appname = labels['kae-app-name']
-                        channel = make_app_watcher_channel_name(cluster, appname)
-                        data = {
-                            'object': obj.to_dict(),
-                            'action': event['type'],
-                        }
-                        rds.publish(message=json.dumps(data, cls=VersatileEncoder), channel=channel)
-                    elif 'kae-job-name' in labels:
-                        if event['type'] == 'DELETED':
-                            continue
-                        jobname = labels['kae-job-name']
-                        handle_job_pod_event.delay(jobname, event['raw_object'])
-            except ProtocolError:
-                logger.warn('skip this error... because kubernetes disconnect client after default 10m...')
-            except Exception as e:
-                # logger.error("---------watch error ------------------")
-                logger.exception("watch pods workers error")
-                # logger.error("watch pods error {}".format(str(e)))
+        interval = max(WATCHER_LEASE_TTL / 3, 1)
+        try:
+            while True:
+                try:
+                    self.balance()
+                except Exception:
+                    logger.exception("watcher replica {} error".format(self.replica_id))
+                time.sleep(interval)
+        finally:
+            for shard_id in list(self.leases.keys()):
+                self._stop_shard(shard_id)
+            # the process is exiting, the watcher threads(daemon) exit with it
+            for _, lease in self.stopping.values():
+                lease.release()
+            remove_replica(self.replica_id)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Watch pods')
     parser.add_argument('--sync', action='store_true')
+    parser.add_argument('--raw', action='store_true', default=WATCHER_RAW_MODE,
+                        help="work on the raw json of the events instead of kubernetes models")
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
     args = parse_args()
-    wch = LongRunningWatcher(args.sync)
+    wch = LongRunningWatcher(args.sync, raw=args.raw)
     wch.start()
     wch.wait()
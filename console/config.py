@@ -32,7 +32,43 @@ APP_BUILD_TIMEOUT = 1800     # timeout for build image(30 minutes)
 # in order to avoid nginx to close the idle websocket connection,
 # we need to send heartbeat message to refresh the read timeout
 WS_HEARTBEAT_TIMEOUT = 60
-
+# max number of messages buffered for a websocket subscription of the pubsub hub,
+# the subscription is dropped when it's full(the client is too slow)
+PUBSUB_HUB_QUEUE_SIZE = getenv('PUBSUB_HUB_QUEUE_SIZE', default=1000, type=int)
+# the output of the celery tasks is stored in redis streams, at most this number of messages are kept for a task
+TASK_OUTPUT_MAX_LEN = getenv('TASK_OUTPUT_MAX_LEN', default=10000, type=int)
+# seconds to keep the output of a running task(in case the worker died), and after the task is done
+TASK_OUTPUT_TTL = getenv('TASK_OUTPUT_TTL', default=24 * 3600, type=int)
+TASK_OUTPUT_DONE_TTL = getenv('TASK_OUTPUT_DONE_TTL', default=3600, type=int)
+# the builds fetch the code from the bare mirrors of the repos in this dir, the least recently
+# used mirrors are removed when their total size(bytes) exceeds the budget
+GIT_MIRROR_ROOT_DIR = getenv('GIT_MIRROR_ROOT_DIR', default='/tmp/git-mirrors')
+GIT_MIRROR_DISK_BUDGET = getenv('GIT_MIRROR_DISK_BUDGET', default=20 * 1024 * 1024 * 1024, type=int)
+# max number of images of a release built concurrently, pushing an image overlaps with building the next ones
+BUILD_PARALLELISM = getenv('BUILD_PARALLELISM', default=2, type=int)
+# the builds run in their own celery queue, at most BUILDER_HOST_CONCURRENCY builds run on a builder host(docker daemon)
+BUILD_QUEUE = getenv('BUILD_QUEUE', default='console-build')
+BUILDER_HOST_CONCURRENCY = getenv('BUILDER_HOST_CONCURRENCY', default=2, type=int)
+# the queued builds are taken round-robin by app or team(the group of the git repo)
+BUILD_FAIRNESS_KEY = getenv('BUILD_FAIRNESS_KEY', default='app')
+# seconds to wait before retry when the builder host is busy
+BUILD_SLOT_RETRY_DELAY = getenv('BUILD_SLOT_RETRY_DELAY', default=5, type=int)
+# the build contexts(tar files) are cached in this dir by commit and dockerfile, the least
+# recently used ones are removed when their total size(bytes) exceeds the budget
+BUILD_CONTEXT_CACHE_DIR = getenv('BUILD_CONTEXT_CACHE_DIR', default='/tmp/build-contexts')
+BUILD_CONTEXT_CACHE_BUDGET = getenv('BUILD_CONTEXT_CACHE_BUDGET', default=10 * 1024 * 1024 * 1024, type=int)
+# seconds between the checks of the position of a queued build
+BUILD_QUEUE_POLL_INTERVAL = getenv('BUILD_QUEUE_POLL_INTERVAL', default=2, type=int)
+
+# seconds to wait for more notifications of the same recipient, they are sent in one message
+NOTIFY_BATCH_WINDOW = getenv('NOTIFY_BATCH_WINDOW', default=10, type=int)
+NOTIFY_MAX_RETRIES = getenv('NOTIFY_MAX_RETRIES', default=5, type=int)
+NOTIFY_RETRY_DELAY = getenv('NOTIFY_RETRY_DELAY', default=30, type=int)
+# max idle SMTP connections kept per process, and seconds to keep them
+SMTP_POOL_SIZE = getenv('SMTP_POOL_SIZE', default=2, type=int)
+SMTP_IDLE_TIMEOUT = getenv('SMTP_IDLE_TIMEOUT', default=60, type=int)
+
+EMAIL_SMTP_SERVER = "smtp.exmail.qq.com"
 EMAIL_SENDER = ""
 EMAIL_SENDER_PASSWOORD = ""
 # SERVER_NAME = getenv('SERVER_NAME', default='127.0.0.1')
@@ -45,6 +81,64 @@ DEFAULT_NS = getenv('DEFAULT_NS', default='kae')
 DEFAULT_APP_NS = getenv('DEFAULT_APP_NS', default='kae-app')
 DEFAULT_JOB_NS = getenv('DEFAULT_JOB_NS', default='kae-job')
 
+# keep an in-memory copy of pods, deployments and ingresses of every cluster(list-then-watch),
+# KubeApi serves the read operations from it when it is synced.
+K8S_INFORMER_ENABLED = getenv('K8S_INFORMER_ENABLED', default=False, type=bool)
+# server side timeout of a single watch request, the informer re-watches from the last resource version
+K8S_INFORMER_WATCH_TIMEOUT = getenv('K8S_INFORMER_WATCH_TIMEOUT', default=300, type=int)
+# timeout(seconds) of every cluster when calling the read methods of KubeApi with cluster_name=ALL_CLUSTER,
+# the writes wait for all the clusters
+K8S_CLUSTER_CALL_TIMEOUT = getenv('K8S_CLUSTER_CALL_TIMEOUT', default=60, type=int)
+# max connections kept by the api client of every cluster, it should match the greenlet concurrency of a worker
+K8S_CONNECTION_POOL_MAXSIZE = getenv('K8S_CONNECTION_POOL_MAXSIZE', default=32, type=int)
+# send tcp keepalive probes after the connection to api server is idle for this many seconds(0 to disable)
+K8S_TCP_KEEPALIVE_IDLE = getenv('K8S_TCP_KEEPALIVE_IDLE', default=60, type=int)
+# how to apply deployment, service and ingress:
+#   replace: replace the object(create it when it doesn't exist)
+#   patch: strategic merge patch in a single request, skip the write when the object is unchanged
+K8S_APPLY_STRATEGY = getenv('K8S_APPLY_STRATEGY', default='replace')
+# default seconds to wait for a deployment to be rolled out
+DEPLOY_ROLLOUT_TIMEOUT = getenv('DEPLOY_ROLLOUT_TIMEOUT', default=600, type=int)
+# seconds to wait for the old job to be deleted when restart a job
+JOB_DELETE_TIMEOUT = getenv('JOB_DELETE_TIMEOUT', default=300, type=int)
+# seconds the restart task waits for the deletion in one run, it's retried until JOB_DELETE_TIMEOUT,
+# so a restart doesn't hold a worker for long
+JOB_DELETE_WAIT_INTERVAL = getenv('JOB_DELETE_WAIT_INTERVAL', default=10, type=int)
+# seconds the restart task may wait in the queue, the websocket following the restart gives up
+# if there is no output in JOB_DELETE_TIMEOUT + JOB_RESTART_QUEUE_TIMEOUT seconds
+JOB_RESTART_QUEUE_TIMEOUT = getenv('JOB_RESTART_QUEUE_TIMEOUT', default=300, type=int)
+# after the ingress is changed, wait the ingress controller to pick up the change:
+# if INGRESS_SYNC_PROBE_URL is set, poll it until it returns 2xx(at most INGRESS_SYNC_TIMEOUT seconds),
+# the url can contain {name}, {namespace} and {resource_version} of the ingress,
+# otherwise sleep INGRESS_SYNC_DELAY seconds.
+INGRESS_SYNC_PROBE_URL = getenv('INGRESS_SYNC_PROBE_URL', default='')
+INGRESS_SYNC_TIMEOUT = getenv('INGRESS_SYNC_TIMEOUT', default=5, type=float)
+INGRESS_SYNC_DELAY = getenv('INGRESS_SYNC_DELAY', default=1, type=float)
+# the pod watcher merges the MODIFIED events of a pod in this window(seconds) and
+# publishes the events with a redis pipeline, set it to 0 to publish every event immediately
+WATCHER_COALESCE_WINDOW = getenv('WATCHER_COALESCE_WINDOW', default=0.2, type=float)
+# publish only the fields of the pod used by the UI, and a JSON patch for MODIFIED events
+WATCHER_COMPACT_EVENTS = getenv('WATCHER_COMPACT_EVENTS', default=False, type=bool)
+# the pod watcher works on the raw json of the events and never builds kubernetes models,
+# it's faster with WATCHER_COMPACT_EVENTS, otherwise the whole raw pods are converted to snake case keys
+WATCHER_RAW_MODE = getenv('WATCHER_RAW_MODE', default=False, type=bool)
+# the pod watcher saves the last seen resource version to redis at most once in this many seconds
+# (and on every bookmark), and resumes from it after restart
+WATCHER_RESOURCE_VERSION_SAVE_INTERVAL = getenv('WATCHER_RESOURCE_VERSION_SAVE_INTERVAL', default=5, type=int)
+# the pods watcher can run multiple replicas, every cluster is a shard owned by one replica,
+# set WATCHER_SHARD_BY_TYPE to split the app pods and job pods of a cluster into two shards.
+WATCHER_SHARD_BY_TYPE = getenv('WATCHER_SHARD_BY_TYPE', default=False, type=bool)
+# a replica must renew the lease of its shards in this many seconds, otherwise other replicas take them over
+WATCHER_LEASE_TTL = getenv('WATCHER_LEASE_TTL', default=30, type=int)
+# server side timeout of a single watch request, a replica stops the watch of a lost shard after it
+WATCHER_WATCH_TIMEOUT = getenv('WATCHER_WATCH_TIMEOUT', default=60, type=int)
+# the pods watcher computes the job status from the job pod events and updates the job table in
+# batches every this many seconds, only the log saving is sent to celery. set it to 0 to handle
+# every job pod event in celery
+WATCHER_JOB_RECONCILE_INTERVAL = getenv('WATCHER_JOB_RECONCILE_INTERVAL', default=1, type=float)
+# max number of apps rolled out concurrently by a batch deploy request
+BATCH_DEPLOY_CONCURRENCY = getenv('BATCH_DEPLOY_CONCURRENCY', default=8, type=int)
+
 SQLALCHEMY_DATABASE_URI = getenv('SQLALCHEMY_DATABASE_URI', default="mysql+pymysql://root@127.0.0.1:3306/kaetest?charset=utf8mb4")
 SQLALCHEMY_TRACK_MODIFICATIONS = getenv('SQLALCHEMY_TRACK_MODIFICATIONS', default=True, type=bool)
 SQLALCHEMY_POOL_SIZE = getenv('SQLALCHEMY_POOL_SIZE', default=30)
@@ -94,6 +188,14 @@ JOBS_ROOT_DIR = os.path.join(DFS_MOUNT_DIR, "kae/jobs")
 JOBS_OUPUT_ROOT_DIR = os.path.join(DFS_MOUNT_DIR, "kae/job-outputs")
 JOBS_REPO_DATA_DIR = os.path.join(DFS_MOUNT_DIR, "kae/job-repos")
 JOBS_LOG_ROOT_DIR = os.path.join(DFS_MOUNT_DIR, "kae/job-logs")
+# archive the job logs with gzip
+JOB_LOG_COMPRESS = getenv('JOB_LOG_COMPRESS', default=False, type=bool)
+# the job log is read from kubernetes and written to the archive in chunks of this size
+JOB_LOG_CHUNK_SIZE = getenv('JOB_LOG_CHUNK_SIZE', default=64 * 1024, type=int)
+# the offset of every N lines is recorded in the index of the archived job log, used to read the tail of the log
+JOB_LOG_INDEX_INTERVAL = getenv('JOB_LOG_INDEX_INTERVAL', default=1000, type=int)
+# max bytes returned by one read of the job log
+JOB_LOG_MAX_READ_SIZE = getenv('JOB_LOG_MAX_READ_SIZE', default=4 * 1024 * 1024, type=int)
 
 DFS_TYPE = os.environ.get('DFS_TYPE', 'hostPath')
 DFS_VOLUME = {}
@@ -144,11 +246,20 @@ TASK_PUBSUB_EOF = 'CELERY_TASK_DONE:{task_id}'
 timezone = getenv('TIMEZONE', default='Asia/Shanghai')
 broker_url = REDIS_URL
 result_backend = REDIS_URL
-broker_transport_options = {'visibility_timeout': 10}
+# the delayed tasks(countdown or retry) are redelivered if they are not run in visibility_timeout seconds,
+# so it must be longer than the longest delay(the last retry of the notifications). it's broker wide(the
+# redis transport has no per queue option), the tasks are acked early, so it only delays the redelivery
+# of the messages reserved by a lost worker. 3600 is the default of the redis transport.
+broker_transport_options = {'visibility_timeout': max(3600, NOTIFY_RETRY_DELAY * 2 ** NOTIFY_MAX_RETRIES)}
 task_default_queue = PROJECT_NAME
 task_queues = (
     Queue(PROJECT_NAME, routing_key=PROJECT_NAME),
+    Queue(BUILD_QUEUE, routing_key=BUILD_QUEUE),
 )
+# builds don't share the queue with the job events
+task_routes = {
+    'console.tasks.build_image': {'queue': BUILD_QUEUE, 'routing_key': BUILD_QUEUE},
+}
 task_default_exchange = PROJECT_NAME
 task_default_routing_key = PROJECT_NAME
 task_serializer = 'json'
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+the build contexts are tarred to files on disk and uploaded to the docker daemon from there,
+the files honor `.dockerignore` and never contain the `.git` files of the worktree.
+a context is determined by the commit and the dockerfile, so it's cached and shared by the
+builds of the same commit, the least recently used contexts are removed when their total size
+exceeds `BUILD_CONTEXT_CACHE_BUDGET`.
+"""
+import os
+import socket
+import hashlib
+import threading
+
+from docker.utils import create_archive, exclude_paths
+
+from console.config import BUILD_CONTEXT_CACHE_DIR, BUILD_CONTEXT_CACHE_BUDGET
+from console.libs.utils import logger
+
+# the worktree and submodules have a `.git` file pointing to the git mirror
+GIT_IGNORE_PATTERNS = ['.git', '**/.git']
+
+
+def make_context_name(commit, dockerfile):
+    return hashlib.sha1('{}:{}'.format(commit, os.path.normpath(dockerfile)).encode('utf-8')).hexdigest()
+
+
+def read_dockerignore(context_dir):
+    """
+    :return: the patterns in `.dockerignore`, the same as docker-py
+    """
+    path = os.path.join(context_dir, '.dockerignore')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = [l.strip() for l in f.read().splitlines()]
+    return [l for l in lines if l and not l.startswith('#')]
+
+
+class BuildContext(object):
+
+    def __init__(self, commit, dockerfile, root_dir=BUILD_CONTEXT_CACHE_DIR):
+        """
+        :param dockerfile: path of the dockerfile relative to the context
+        """
+        self.dockerfile = dockerfile
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, make_context_name(commit, dockerfile) + '.tar')
+
+    @property
+    def cached(self):
+        return os.path.exists(self.path)
+
+    def create(self, context_dir):
+        """
+        tar `context_dir` to the cache if it's not cached
+        """
+        if self.cached:
+            return
+        if not os.path.isdir(context_dir):
+            raise OSError("context dir {} doesn't exist".format(context_dir))
+        os.makedirs(self.root_dir, exist_ok=True)
+        patterns = read_dockerignore(context_dir) + GIT_IGNORE_PATTERNS
+        # the dockerfile is always sent, even if it's ignored
+        files = sorted(exclude_paths(context_dir, patterns, dockerfile=self.dockerfile))
+        # the cache dir may be shared by the builders on the node, their pids may be the same
+        tmp_path = '{}.{}.{}.{}.tmp'.format(self.path, socket.gethostname(), os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                create_archive(root=context_dir, files=files, fileobj=f)
+            # the builds of the same commit may create the context at the same time
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def open(self):
+        """
+        open the cached context to upload, the file can be read even if the cache is evicted
+        """
+        f = open(self.path, 'rb')
+        os.utime(self.path)
+        return f
+
+
+def evict_build_contexts(root_dir=BUILD_CONTEXT_CACHE_DIR, budget=BUILD_CONTEXT_CACHE_BUDGET):
+    """
+    remove the least recently used contexts until their total size is within `budget`
+    :return: number of bytes freed
+    """
+    if not os.path.exists(root_dir):
+        return 0
+    contexts = []
+    for filename in os.listdir(root_dir):
+        if not filename.endswith('.tar'):
+            continue
+        path = os.path.join(root_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        contexts.append((stat.st_mtime, path, stat.st_size))
+
+    total = sum(size for _, _, size in contexts)
+    freed = 0
+    for _, path, size in sorted(contexts):
+        if total - freed <= budget:
+            break
+        logger.info("remove build context {}, {} bytes".format(path, size))
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        freed += size
+    return freed
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+fair build queue. the builds are queued in redis per app(or team), every celery `build_image`
+task in `BUILD_QUEUE` is a token to run one build: the worker takes a slot of its builder host
+first, then takes the next build round-robin among the apps(or teams), so a burst of builds
+of one app doesn't starve the others.
+"""
+import os
+import json
+import time
+import socket
+
+from console.ext import rds
+from console.config import BUILDER_HOST_CONCURRENCY, BUILD_FAIRNESS_KEY, APP_BUILD_TIMEOUT
+
+BUILD_RING_KEY = "kae-build-queue-ring"
+BUILD_QUEUE_KEY_PREFIX = "kae-build-queue-"
+BUILD_INFO_KEY = "kae-build-queue-builds"
+BUILD_RUNNING_KEY = "kae-build-running"
+
+# builder host is the node of the docker daemon used by the worker
+BUILDER_HOST = os.environ.get('NODE_NAME') or socket.gethostname()
+
+_ENQUEUE_SCRIPT = rds.register_script("""
+redis.call('hset', KEYS[3], ARGV[2], ARGV[3])
+if redis.call('rpush', KEYS[2], ARGV[2]) == 1 then
+    redis.call('rpush', KEYS[1], ARGV[1])
+end
+""")
+
+# the key is put back to the end of the ring if it has more builds
+_POP_SCRIPT = rds.register_script("""
+while true do
+    local key = redis.call('lpop', KEYS[1])
+    if not key then
+        return nil
+    end
+    local queue = ARGV[1] .. key
+    local build_id = redis.call('lpop', queue)
+    if redis.call('llen', queue) > 0 then
+        redis.call('rpush', KEYS[1], key)
+    end
+    if build_id then
+        local info = redis.call('hget', KEYS[2], build_id)
+        redis.call('hdel', KEYS[2], build_id)
+        return {build_id, info}
+    end
+end
+""")
+
+_REMOVE_SCRIPT = rds.register_script("""
+local removed = redis.call('lrem', KEYS[2], 0, ARGV[2])
+redis.call('hdel', KEYS[3], ARGV[2])
+if redis.call('llen', KEYS[2]) == 0 then
+    redis.call('lrem', KEYS[1], 0, ARGV[1])
+end
+return removed
+""")
+
+_ACQUIRE_SLOT_SCRIPT = rds.register_script("""
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[4], ARGV[3])
+    return 1
+end
+return 0
+""")
+
+
+def _decode(s):
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+
+def make_builder_slots_key(host):
+    return "kae-builder-{}-slots".format(host)
+
+
+def get_fairness_key(app):
+    """
+    the builds with the same key are taken in order, different keys are taken round-robin.
+    the team is the group of the git repo, e.g. git@gitlab.example.com:team/app.git -> team
+    """
+    if BUILD_FAIRNESS_KEY == 'team':
+        if '://' in app.git:
+            path = app.git.split('://', 1)[1].split('/', 1)[-1]
+        else:
+            path = app.git.split(':', 1)[-1]
+        parts = path.strip('/').split('/')
+        if len(parts) > 1:
+            return 'team:' + '/'.join(parts[:-1])
+    return 'app:' + app.name
+
+
+def enqueue_build(build_id, appname, tag, key):
+    info = json.dumps({'appname': appname, 'tag': tag, 'key': key, 'queued': time.time()})
+    _ENQUEUE_SCRIPT(keys=[BUILD_RING_KEY, BUILD_QUEUE_KEY_PREFIX + key, BUILD_INFO_KEY], args=[key, build_id, info])
+
+
+def pop_build():
+    """
+    :return: (build id, info) of the next build, None if the queue is empty
+    """
+    res = _POP_SCRIPT(keys=[BUILD_RING_KEY, BUILD_INFO_KEY], args=[BUILD_QUEUE_KEY_PREFIX])
+    if not res:
+        return None
+    build_id, info = res
+    return _decode(build_id), json.loads(_decode(info))
+
+
+def remove_build(build_id, key):
+    """
+    :return: True if the build is removed from the queue(it's not started yet)
+    """
+    keys = [BUILD_RING_KEY, BUILD_QUEUE_KEY_PREFIX + key, BUILD_INFO_KEY]
+    return _REMOVE_SCRIPT(keys=keys, args=[key, build_id]) > 0
+
+
+def get_build_position(build_id, key):
+    """
+    the builds are taken round-robin, in every round, one build of every key in the ring is taken.
+    :return: number of builds taken before this build, None if the build is not in the queue
+    """
+    pipe = rds.pipeline(transaction=False)
+    pipe.lrange(BUILD_RING_KEY, 0, -1)
+    pipe.lrange(BUILD_QUEUE_KEY_PREFIX + key, 0, -1)
+    ring, queue = pipe.execute()
+    queue = [_decode(b) for b in queue]
+    if build_id not in queue:
+        return None
+    idx = queue.index(build_id)
+
+    ring = [_decode(k) for k in ring]
+    pipe = rds.pipeline(transaction=False)
+    for k in ring:
+        pipe.llen(BUILD_QUEUE_KEY_PREFIX + k)
+    lengths = pipe.execute()
+
+    position = idx
+    before = True
+    for k, length in zip(ring, lengths):
+        if k == key:
+            before = False
+            continue
+        # the keys before this key in the ring take one more build in the same round
+        position += min(length, idx + 1 if before else idx)
+    return position
+
+
+def acquire_builder_slot(slot_id, host=BUILDER_HOST, concurrency=BUILDER_HOST_CONCURRENCY, ttl=APP_BUILD_TIMEOUT + 60):
+    """
+    the slot expires after `ttl` seconds in case the worker is killed
+    """
+    now = time.time()
+    keys = [make_builder_slots_key(host)]
+    return _ACQUIRE_SLOT_SCRIPT(keys=keys, args=[now, concurrency, slot_id, now + ttl]) == 1
+
+
+def release_builder_slot(slot_id, host=BUILDER_HOST):
+    rds.zrem(make_builder_slots_key(host), slot_id)
+
+
+def mark_build_running(build_id, task_id, host=BUILDER_HOST):
+    rds.hset(BUILD_RUNNING_KEY, build_id, json.dumps({'task_id': task_id, 'host': host}))
+
+
+def unmark_build_running(build_id):
+    rds.hdel(BUILD_RUNNING_KEY, build_id)
+
+
+def submit_build(app, tag):
+    """
+    queue the build and send a token to the build workers
+    :return: the build id, the output of the build is stored with it(see `console.libs.taskoutput`)
+    """
+    from uuid import uuid4
+    from console.tasks import build_image
+
+    build_id = str(uuid4())
+    enqueue_build(build_id, app.name, tag, get_fairness_key(app))
+    build_image.delay()
+    return build_id
+
+
+def cancel_build(build_id, app):
+    """
+    remove the build from the queue, or terminate it if it's running
+    """
+    from console.libs.taskoutput import finish_task_output
+
+    if not remove_build(build_id, get_fairness_key(app)):
+        running = rds.hget(BUILD_RUNNING_KEY, build_id)
+        if not running:
+            return
+        running = json.loads(_decode(running))
+        from console.app import celery
+        celery.control.revoke(running['task_id'], terminate=True)
+        # the worker process is killed, so the slot is released here
+        release_builder_slot(running['task_id'], running['host'])
+        unmark_build_running(build_id)
+    # wake up the viewers of the build
+    finish_task_output(build_id)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+persistent bare mirrors of the git repos used by the builds. the mirror is fetched incrementally,
+and the release is checked out to a worktree of it. the least recently used mirrors are removed
+when their total size exceeds `GIT_MIRROR_DISK_BUDGET`.
+a mirror is locked while it's fetched and checked out, the files of the worktree don't
+depend on the mirror after that, so the mirror can be fetched or removed during the build.
+"""
+import os
+import fcntl
+import shutil
+import hashlib
+
+from console.config import GIT_MIRROR_ROOT_DIR, GIT_MIRROR_DISK_BUDGET
+from console.libs.cloner import Cloner
+from console.libs.utils import logger
+
+
+def make_mirror_name(repo):
+    # the same as Cloner.repo_hash
+    return hashlib.sha1(repo.strip().encode('utf-8')).hexdigest()
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _run_git(args, cwd=None):
+    # consume the output, GitError is raised when git fails
+    for _ in Cloner.exec_git_command(args, cwd=cwd):
+        pass
+
+
+class GitMirror(object):
+
+    def __init__(self, repo, root_dir=GIT_MIRROR_ROOT_DIR):
+        self.repo = repo.strip()
+        self.root_dir = root_dir
+        name = make_mirror_name(self.repo)
+        self.path = os.path.join(root_dir, name + '.git')
+        # the mtime of the lock file is the last time the mirror is used
+        self.lock_path = os.path.join(root_dir, name + '.lock')
+        self.size_path = os.path.join(root_dir, name + '.size')
+
+    def _sync(self):
+        if os.path.exists(self.path):
+            yield from Cloner.exec_git_command(['fetch', '--prune', '--progress', 'origin'], cwd=self.path)
+        else:
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            try:
+                yield from Cloner.exec_git_command(['clone', '--mirror', '--progress', self.repo, tmp_path])
+                os.rename(tmp_path, self.path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def fetch(self):
+        """
+        clone the mirror if it doesn't exist, otherwise fetch the new commits.
+        yield the output of git
+        """
+        os.makedirs(self.root_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield from self._sync()
+            with open(self.size_path, 'w') as f:
+                f.write(str(_dir_size(self.path)))
+            os.utime(self.lock_path)
+
+    def resolve(self, ref):
+        """
+        :return: the commit id of `ref`(tag, branch or commit)
+        """
+        lines = list(Cloner.exec_git_command(['rev-parse', '--verify', '{}^{{commit}}'.format(ref)], cwd=self.path))
+        return lines[-1]
+
+    def add_worktree(self, ref, work_dir):
+        """
+        check out `ref` to a worktree in `work_dir`, the submodules are checked out too.
+        yield the output of git
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.remove_worktree(work_dir)
+            _run_git(['worktree', 'add', '--detach', work_dir, ref], cwd=self.path)
+            if os.path.exists(os.path.join(work_dir, '.gitmodules')):
+                yield from Cloner.exec_git_command(['submodule', 'update', '--init', '--recursive'], cwd=work_dir)
+
+    def checkout(self, ref, work_dir):
+        """
+        fetch the mirror and check out `ref` to a worktree in `work_dir`.
+        yield the output of git
+        """
+        yield from self.fetch()
+        yield from self.add_worktree(ref, work_dir)
+
+    def remove_worktree(self, work_dir):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if os.path.exists(self.path):
+            _run_git(['worktree', 'prune'], cwd=self.path)
+
+
+def evict_mirrors(root_dir=GIT_MIRROR_ROOT_DIR, budget=GIT_MIRROR_DISK_BUDGET, keep=None):
+    """
+    remove the least recently used mirrors until their total size is within `budget`,
+    the mirrors being fetched are skipped.
+    :param keep: the repo whose mirror should be kept, usually it's just used
+    :return: number of bytes freed
+    """
+    if not os.path.exists(root_dir):
+        return 0
+    mirrors = []
+    for filename in os.listdir(root_dir):
+        if not filename.endswith('.lock'):
+            continue
+        name = filename[:-len('.lock')]
+        try:
+            with open(os.path.join(root_dir, name + '.size')) as f:
+                size = int(f.read())
+            mtime = os.path.getmtime(os.path.join(root_dir, filename))
+        except (OSError, ValueError):
+            continue
+        mirrors.append((mtime, name, size))
+
+    total = sum(size for _, _, size in mirrors)
+    freed = 0
+    for _, name, size in sorted(mirrors):
+        if total - freed <= budget:
+            break
+        if keep and name == make_mirror_name(keep):
+            continue
+        # the lock file is kept, other processes may be waiting on it
+        with open(os.path.join(root_dir, name + '.lock'), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            logger.info("remove git mirror {}, {} bytes".format(name, size))
+            os.remove(os.path.join(root_dir, name + '.size'))
+            shutil.rmtree(os.path.join(root_dir, name + '.git'), ignore_errors=True)
+        freed += size
+    return freed
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import time
+import threading
+from collections import defaultdict
+
+from kubernetes import watch
+from urllib3.exceptions import ProtocolError
+
+from console.config import K8S_INFORMER_WATCH_TIMEOUT
+from console.libs.utils import logger
+
+
+def spawn(target, *args, **kw):
+    t = threading.Thread(target=target, name=target.__name__, args=args, kwargs=kw)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class ResourceInformer(object):
+    """
+    list-then-watch one kind of kubernetes object in a namespace and keep
+    a copy of them in memory, indexed by name and by the value of `index_label`.
+    """
+    RETRY_INTERVAL = 5
+
+    def __init__(self, kind, list_func, namespace, index_label, watch_timeout=K8S_INFORMER_WATCH_TIMEOUT):
+        self.kind = kind
+        self.list_func = list_func
+        self.namespace = namespace
+        self.index_label = index_label
+        self.watch_timeout = watch_timeout
+
+        self.synced = False
+        self.resource_version = None
+        self._store = {}
+        self._index = defaultdict(set)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __str__(self):
+        return '<Informer {}:{}>'.format(self.kind, self.namespace)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = spawn(self._run)
+
+    def get(self, name):
+        with self._lock:
+            obj = self._store.get(name)
+        # return a copy, so the caller can modify it safely
+        return copy.deepcopy(obj)
+
+    def list_by_label(self, value):
+        with self._lock:
+            objs = [self._store[name] for name in self._index.get(value, ())]
+        return copy.deepcopy(objs)
+
+    def _label_value(self, obj):
+        labels = obj.metadata.labels or {}
+        return labels.get(self.index_label)
+
+    def _list(self):
+        result = self.list_func(namespace=self.namespace)
+        store = {}
+        index = defaultdict(set)
+        for obj in result.items:
+            store[obj.metadata.name] = obj
+            value = self._label_value(obj)
+            if value is not None:
+                index[value].add(obj.metadata.name)
+        with self._lock:
+            self._store = store
+            self._index = index
+            self.resource_version = result.metadata.resource_version
+        self.synced = True
+
+    def _update(self, event_type, obj):
+        name = obj.metadata.name
+        with self._lock:
+            old = self._store.pop(name, None)
+            if old is not None:
+                old_value = self._label_value(old)
+                if old_value is not None:
+                    self._index[old_value].discard(name)
+                    if not self._index[old_value]:
+                        del self._index[old_value]
+            if event_type != 'DELETED':
+                self._store[name] = obj
+                value = self._label_value(obj)
+                if value is not None:
+                    self._index[value].add(name)
+            self.resource_version = obj.metadata.resource_version
+
+    def _watch(self):
+        """
+        watch from the last seen resource version until the server closes the stream.
+        :return: False if the resource version is expired and a relist is needed
+        """
+        kwargs = {
+            'namespace': self.namespace,
+            'timeout_seconds': self.watch_timeout,
+        }
+        if self.resource_version is not None:
+            kwargs['resource_version'] = self.resource_version
+        w = watch.Watch()
+        for event in w.stream(self.list_func, **kwargs):
+            if event['type'] == 'ERROR':
+                # usually 410 Gone: the resource version is too old
+                logger.info("{} got error event {}, relist".format(self, event['raw_object'].get('message')))
+                w.stop()
+                return False
+            self._update(event['type'], event['object'])
+        return True
+
+    def _run(self):
+        need_list = True
+        while True:
+            try:
+                if need_list:
+                    self._list()
+                    need_list = False
+                need_list = not self._watch()
+            except ProtocolError:
+                logger.warn('{} disconnected by kubernetes, rewatch'.format(self))
+            except Exception:
+                logger.exception('{} error'.format(self))
+                self.synced = False
+                need_list = True
+                time.sleep(self.RETRY_INTERVAL)
+
+
+class ClusterInformer(object):
+    """
+    informers of a single cluster:
+      - pods in app and job namespace
+      - deployments and ingresses in app namespace
+    """
+    def __init__(self, core_v1api, extensions_api, app_namespace, job_namespace):
+        self._informers = {}
+        self._add(ResourceInformer('pod', core_v1api.list_namespaced_pod, app_namespace, 'kae-app-name'))
+        self._add(ResourceInformer('pod', core_v1api.list_namespaced_pod, job_namespace, 'kae-job-name'))
+        self._add(ResourceInformer('deployment', extensions_api.list_namespaced_deployment, app_namespace, 'kae-app-name'))
+        self._add(ResourceInformer('ingress', extensions_api.list_namespaced_ingress, app_namespace, 'kae-app-name'))
+
+    def _add(self, informer):
+        self._informers[(informer.kind, informer.namespace, informer.index_label)] = informer
+
+    def start(self):
+        for informer in self._informers.values():
+            informer.start()
+
+    def lookup(self, kind, namespace, index_label='kae-app-name'):
+        """
+        return the informer only when it exists and is synced, otherwise return None
+        """
+        informer = self._informers.get((kind, namespace, index_label))
+        if informer is None or informer.synced is False:
+            return None
+        return informer
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+ranged and tail reads of the job logs.
+an index(`log.<version>.idx`) is written beside the archived log, it records the byte
+offset of every `interval` lines, so the last N lines are located without scanning the log.
+offsets of the gzipped logs are offsets of the uncompressed log, the gzipped logs are written
+as independent gzip members starting at the indexed lines, so a read only decompresses the log
+from the member before it(the concatenated members are still a normal gzip file).
+"""
+import os
+import json
+import gzip
+import mmap
+import bisect
+import contextlib
+
+from console.config import JOBS_LOG_ROOT_DIR, JOB_LOG_INDEX_INTERVAL
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def get_job_log_path(job_name, version, root_dir=JOBS_LOG_ROOT_DIR):
+    """
+    :return: path of the archived log, None if the log doesn't exist
+    """
+    path = os.path.join(root_dir, job_name, 'log.{}.txt'.format(version))
+    for p in (path, path + '.gz'):
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def get_log_index_path(log_path):
+    # log.1.txt or log.1.txt.gz -> log.1.idx
+    if log_path.endswith('.gz'):
+        log_path = log_path[:-len('.gz')]
+    return log_path[:-len('.txt')] + '.idx'
+
+
+def open_log(log_path):
+    return gzip.open(log_path, 'rb') if log_path.endswith('.gz') else open(log_path, 'rb')
+
+
+class LineIndex(object):
+    """
+    byte offsets of line 0, interval, 2 * interval... of the log
+    """
+
+    def __init__(self, interval=JOB_LOG_INDEX_INTERVAL):
+        self.interval = interval
+        self.offsets = [0]
+        # offsets of the gzip members in the compressed log, the k-th member starts at offsets[k]
+        self.members = []
+        self.newlines = 0
+        self.size = 0
+        # the last line isn't terminated by a newline
+        self.partial = False
+
+    @property
+    def lines(self):
+        return self.newlines + (1 if self.partial else 0)
+
+    def feed(self, chunk):
+        pos = chunk.find(b'\n')
+        while pos != -1:
+            self.newlines += 1
+            if self.newlines % self.interval == 0:
+                self.offsets.append(self.size + pos + 1)
+            pos = chunk.find(b'\n', pos + 1)
+        self.size += len(chunk)
+        if chunk:
+            self.partial = not chunk.endswith(b'\n')
+
+    def to_dict(self):
+        return {
+            'interval': self.interval,
+            'offsets': self.offsets,
+            'members': self.members,
+            'newlines': self.newlines,
+            'size': self.size,
+            'partial': self.partial,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        index = cls(d['interval'])
+        index.offsets = d['offsets']
+        # the logs gzipped as one member before
+        index.members = d.get('members', [])
+        index.newlines = d['newlines']
+        index.size = d['size']
+        index.partial = d['partial']
+        return index
+
+    def dump(self, path):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the index, None if the index doesn't exist or is broken
+        """
+        try:
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def load_log_index(log_path, build=True):
+    """
+    load the index of the archived log, the logs archived without index are
+    scanned once to build it when `build` is True.
+    """
+    index_path = get_log_index_path(log_path)
+    index = LineIndex.load(index_path)
+    if index is None and build:
+        index = LineIndex()
+        with open_log(log_path) as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                index.feed(chunk)
+        try:
+            index.dump(index_path)
+        except OSError:
+            pass
+    return index
+
+
+class GzipMembersWriter(object):
+    """
+    compress the log to `fileobj`, a new gzip member is started at every line recorded in `index`
+    """
+
+    def __init__(self, fileobj, index):
+        self.fileobj = fileobj
+        self.index = index
+        self.index.members = [fileobj.tell()]
+        self._member = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj)
+
+    def write(self, chunk):
+        start, count = self.index.size, len(self.index.offsets)
+        self.index.feed(chunk)
+        pos = 0
+        for offset in self.index.offsets[count:]:
+            self._member.write(chunk[pos:offset - start])
+            pos = offset - start
+            self._member.close()
+            self.index.members.append(self.fileobj.tell())
+            self._member = gzip.GzipFile(filename='', mode='wb', fileobj=self.fileobj)
+        self._member.write(chunk[pos:])
+
+    def close(self):
+        self._member.close()
+
+
+@contextlib.contextmanager
+def open_log_at(log_path, offset, index=None):
+    """
+    open the archived log positioned at `offset`
+    :param index: index of the gzipped log, the log is decompressed from the beginning without it
+    """
+    if not log_path.endswith('.gz'):
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            yield f
+        return
+
+    with open(log_path, 'rb') as raw:
+        start = 0
+        if index is not None and index.members:
+            k = min(bisect.bisect_right(index.offsets, offset), len(index.members)) - 1
+            raw.seek(index.members[k])
+            start = index.offsets[k]
+        with gzip.GzipFile(mode='rb', fileobj=raw) as f:
+            f.seek(offset - start)
+            yield f
+
+
+def get_log_size(log_path):
+    """
+    size of the log(before compression)
+    """
+    if log_path.endswith('.gz'):
+        return load_log_index(log_path).size
+    return os.path.getsize(log_path)
+
+
+def _skip_lines(f, offset, count):
+    """
+    :param f: the log positioned at `offset`
+    :return: the offset after `count` lines from `offset`
+    """
+    while count > 0:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pos = -1
+        while count > 0:
+            pos = chunk.find(b'\n', pos + 1)
+            if pos == -1:
+                break
+            count -= 1
+        if count == 0:
+            return offset + pos + 1
+        offset += len(chunk)
+    return offset
+
+
+def _tail_offset_mmap(log_path, n):
+    size = os.path.getsize(log_path)
+    if size == 0:
+        return 0
+    with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        # the trailing newline terminates the last line, it doesn't start a new one
+        pos = size - 1 if m[size - 1:size] == b'\n' else size
+        for _ in range(n):
+            pos = m.rfind(b'\n', 0, pos)
+            if pos == -1:
+                return 0
+        return pos + 1
+
+
+def find_tail_offset(log_path, n):
+    """
+    :return: byte offset of the first of the last `n` lines of the archived log
+    """
+    index = load_log_index(log_path, build=log_path.endswith('.gz'))
+    if index is None:
+        # plain log archived without index, search the newlines backwards
+        return _tail_offset_mmap(log_path, n)
+    if n <= 0:
+        return index.size
+
+    first = max(index.lines - n, 0)
+    k = first // index.interval
+    offset = index.offsets[k]
+    skip = first - k * index.interval
+    if skip == 0:
+        return offset
+    with open_log_at(log_path, offset, index) as f:
+        return _skip_lines(f, offset, skip)
+
+
+def iter_log_range(log_path, start, end, chunk_size=READ_CHUNK_SIZE):
+    """
+    yield the bytes [start, end) of the archived log in chunks
+    """
+    index = load_log_index(log_path) if log_path.endswith('.gz') else None
+    with open_log_at(log_path, start, index) as f:
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def slice_chunks(chunks, start, end=None):
+    """
+    yield the bytes [start, end) of a stream of chunks, e.g. the live log read from kubernetes
+    """
+    offset = 0
+    for chunk in chunks:
+        chunk_start, offset = offset, offset + len(chunk)
+        if offset <= start:
+            continue
+        data = chunk[max(start - chunk_start, 0):]
+        if end is not None and offset >= end:
+            data = data[:len(data) - (offset - end)]
+            if data:
+                yield data
+            return
+        yield data
@@ -1,26 +1,41 @@
 import os
 import time
+import socket
+import functools
+import threading
 import yaml
 import logging
 import json
 import base64
 import copy
+import hashlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+import gevent
+from gevent import monkey
 from addict import Dict
 from kubernetes import client, config, watch
-from kubernetes.watch.watch import iter_resp_lines
+from kubernetes.watch.watch import iter_resp_lines, SimpleNamespace
 from kubernetes.stream import stream
 
 from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import ProtocolError
+from werkzeug.utils import cached_property
 
 from console.config import (
     HOST_VOLUMES_DIR, POD_LOG_DIR, CLUSTER_BASE_DOMAIN_MAP,
     REGISTRY_AUTHS, DFS_VOLUME, DFS_MOUNT_DIR, JOBS_ROOT_DIR, JOBS_OUPUT_ROOT_DIR,
-    INGRESS_ANNOTATIONS_PREFIX,
+    INGRESS_ANNOTATIONS_PREFIX, DEFAULT_APP_NS, DEFAULT_JOB_NS, K8S_CLUSTER_CALL_TIMEOUT,
+    K8S_CONNECTION_POOL_MAXSIZE, K8S_TCP_KEEPALIVE_IDLE, K8S_APPLY_STRATEGY,
+    DEPLOY_ROLLOUT_TIMEOUT, JOB_DELETE_TIMEOUT,
+    INGRESS_SYNC_PROBE_URL, INGRESS_SYNC_DELAY, INGRESS_SYNC_TIMEOUT,
 )
 
 from .utils import (
-    parse_image_name, id_generator, make_canary_appname, search_tls_secret, get_dfs_host_dir,
+    logger, parse_image_name, id_generator, make_canary_appname, search_tls_secret, get_dfs_host_dir,
 )
+from .informer import ClusterInformer
 
 
 class KubeError(Exception):
@@ -31,15 +46,62 @@ class KubeError(Exception):
         return self.msg
 
 
+def new_api_client(context=None):
+    """
+    create an api client for the context in kubeconfig, when context is None,
+    use the default configuration(incluster config).
+    all the api groups of a cluster should share this client, so they share the connection pool.
+    """
+    if context is None:
+        cfg = client.Configuration()
+    else:
+        # `Configuration()` returns a copy of the process wide default(the incluster config),
+        # the settings the context doesn't override(e.g. api_key of the token) would leak to
+        # the other cluster, so create a fresh configuration without the default.
+        cfg = client.Configuration.__new__(client.Configuration)
+        cfg.__init__()
+        config.load_kube_config(context=context, client_configuration=cfg)
+    cfg.connection_pool_maxsize = K8S_CONNECTION_POOL_MAXSIZE
+    api_client = client.ApiClient(configuration=cfg)
+
+    if K8S_TCP_KEEPALIVE_IDLE > 0:
+        socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, K8S_TCP_KEEPALIVE_IDLE))
+        # the pool manager passes connection_pool_kw to every connection pool it creates
+        api_client.rest_client.pool_manager.connection_pool_kw['socket_options'] = socket_options
+    return api_client
+
+
+class ClusterResults(dict):
+    """
+    results of a call on all clusters(cluster name -> result),
+    the clusters which failed or timed out are recorded in `errors`(cluster name -> exception).
+    """
+    def __init__(self, *args, **kwargs):
+        super(ClusterResults, self).__init__(*args, **kwargs)
+        self.errors = {}
+
+
 class KubeApi(object):
     _INSTANCE = None
     ALL_CLUSTER = "__all_cluster__"
+    # the methods only read from the clusters, they are timed out when called on all the clusters
+    _READ_METHOD_PREFIXES = ('get_', 'list_')
     DEFAULT_CLUSTER = "__default_cluster__"
 
     def __init__(self):
+        # cluster name -> ClientApiBundle, a bundle is created on first use
         self.cluster_map = {}
         self.default_cluster_name = None
-        self._load_multiple_clients()
+        self.stats = {
+            'kubeconfig_load_seconds': None,
+            'clusters': {},
+        }
+        self._contexts = []
+        self._incluster = False
+        self._lock = threading.Lock()
+        self._load_contexts()
 
     @classmethod
     def instance(cls):
@@ -49,48 +111,126 @@ class KubeApi(object):
 
     @property
     def cluster_names(self):
-        return list(self.cluster_map.keys())
+        return list(self._contexts)
 
     def cluster_exist(self, cluster_name):
-        return cluster_name in self.cluster_map
+        return cluster_name in self._contexts
 
-    def _load_multiple_clients(self):
+    def _load_contexts(self):
+        """
+        only parse the cluster names from kubeconfig, the clients are created when the cluster is used.
+        """
+        start = time.time()
         if os.path.exists(os.path.expanduser("~/.kube/config")):
             contexts, active_context = config.list_kube_config_contexts()
             if not contexts:
                 raise Exception("no context in kubeconfig")
             self.default_cluster_name = active_context['name']
-
-            contexts = [context['name'] for context in contexts]
-            for ctx in contexts:
-                core_v1api = client.CoreV1Api(
-                    api_client=config.new_client_from_config(context=ctx))
-                extensions_api = client.ExtensionsV1beta1Api(
-                    api_client=config.new_client_from_config(context=ctx))
-                batch_api = client.BatchV1Api(
-                    api_client=config.new_client_from_config(context=ctx))
-                self.cluster_map[ctx] = ClientApiBundle(ctx, core_v1api, extensions_api, batch_api)
+            self._contexts = [context['name'] for context in contexts]
         else:
-            config.load_incluster_config()
-            core_v1api = client.CoreV1Api()
-            extensions_api = client.ExtensionsV1beta1Api()
-            batch_api = client.BatchV1Api()
-            self.cluster_map['incluster'] = ClientApiBundle('incluster', core_v1api, extensions_api, batch_api)
+            self._incluster = True
+            self._contexts = ['incluster']
             self.default_cluster_name = "incluster"
+        self.stats['kubeconfig_load_seconds'] = time.time() - start
+
+    def _new_api_client(self, cluster_name):
+        start = time.time()
+        if self._incluster:
+            config.load_incluster_config()
+            api_client = new_api_client()
+        else:
+            api_client = new_api_client(cluster_name)
+        elapsed = time.time() - start
+        self.stats['clusters'][cluster_name] = {'client_load_seconds': elapsed}
+        logger.info("load client of cluster {} in {:.3f} seconds".format(cluster_name, elapsed))
+        return api_client
+
+    def get_cluster(self, cluster_name):
+        """
+        get the ClientApiBundle of the cluster, create it if necessary.
+        :return: None if the cluster doesn't exist
+        """
+        cluster = self.cluster_map.get(cluster_name, None)
+        if cluster is not None:
+            return cluster
+        if cluster_name not in self._contexts:
+            return None
+        with self._lock:
+            if cluster_name not in self.cluster_map:
+                self.cluster_map[cluster_name] = ClientApiBundle(
+                    cluster_name, functools.partial(self._new_api_client, cluster_name))
+            return self.cluster_map[cluster_name]
+
+    def start_informers(self):
+        """
+        start the informers of every cluster, after they are synced,
+        the read operations(pods, deployments, ingresses) are served from memory.
+        """
+        for name in self._contexts:
+            self.get_cluster(name).start_informer()
+
+    def _call_all_clusters(self, item, args, kwargs, timeout, partial_results):
+        """
+        call the method on every cluster concurrently, use greenlets when running
+        in gevent worker, otherwise use threads.
+        the calls still running after `timeout` seconds are abandoned, None means waiting for all of them.
+        when partial_results is False, the exception of the first failed cluster is raised,
+        otherwise the results of succeeded clusters are returned, and the errors are stored in `errors`.
+        """
+        clusters = [(name, self.get_cluster(name)) for name in self._contexts]
+        results = ClusterResults()
+        errors = {}
+        if not clusters:
+            return results
+
+        if monkey.is_module_patched('socket'):
+            jobs = [(name, gevent.spawn(getattr(cluster, item), *args, **kwargs)) for name, cluster in clusters]
+            gevent.joinall([job for _, job in jobs], timeout=timeout)
+            for name, job in jobs:
+                if not job.ready():
+                    job.kill(block=False)
+                    errors[name] = KubeError("timeout after {} seconds".format(timeout))
+                elif job.successful():
+                    results[name] = job.value
+                else:
+                    errors[name] = job.exception
+        else:
+            executor = ThreadPoolExecutor(max_workers=len(clusters))
+            jobs = [(name, executor.submit(getattr(cluster, item), *args, **kwargs)) for name, cluster in clusters]
+            # the threads of timed out calls can't be killed, don't wait for them
+            executor.shutdown(wait=False)
+            futures_wait([job for _, job in jobs], timeout=timeout)
+            for name, job in jobs:
+                if not job.done():
+                    job.cancel()
+                    errors[name] = KubeError("timeout after {} seconds".format(timeout))
+                elif job.exception() is not None:
+                    errors[name] = job.exception()
+                else:
+                    results[name] = job.result()
+
+        # keep the cluster order, so the raised exception is deterministic
+        for name, _ in clusters:
+            if name in errors:
+                logger.error("call {} on cluster {} error: {}".format(item, name, errors[name]))
+                results.errors[name] = errors[name]
+        if results.errors and partial_results is False:
+            raise next(iter(results.errors.values()))
+        return results
 
     def __getattr__(self, item):
         def wrapper(*args, **kwargs):
             cluster_name = kwargs.pop('cluster_name', self.default_cluster_name)
+            # the writes are never abandoned halfway(e.g. undeploy an app from all the clusters)
+            default_timeout = K8S_CLUSTER_CALL_TIMEOUT if item.startswith(self._READ_METHOD_PREFIXES) else None
+            cluster_timeout = kwargs.pop('cluster_timeout', default_timeout)
+            partial_results = kwargs.pop('partial_results', False)
             if cluster_name == self.ALL_CLUSTER:
-                results = {}
-                for name, cluster in self.cluster_map.items():
-                    func = getattr(cluster, item)
-                    results[name] = func(*args, **kwargs)
-                return results
+                return self._call_all_clusters(item, args, kwargs, cluster_timeout, partial_results)
 
             if cluster_name == self.DEFAULT_CLUSTER:
                 cluster_name = self.default_cluster_name
-            cluster = self.cluster_map.get(cluster_name, None)
+            cluster = self.get_cluster(cluster_name)
             if cluster is None:
                 raise Exception("cluster {} is not available".format(cluster_name))
             func = getattr(cluster, item)
@@ -100,12 +240,60 @@ class KubeApi(object):
 
 
 class ClientApiBundle(object):
-    def __init__(self, name, core_v1api, extensions_api, batch_api):
+    # annotation to store the hash of the object applied by console last time
+    APPLIED_HASH_ANNOTATION = "kae-applied-hash"
+    # kind -> (api attribute, read method, patch method, create method)
+    _PATCH_APPLY_METHODS = {
+        "Deployment": ("extensions_api", "read_namespaced_deployment", "patch_namespaced_deployment",
+                       "create_namespaced_deployment"),
+        "Service": ("core_v1api", "read_namespaced_service", "patch_namespaced_service", "create_namespaced_service"),
+        "Ingress": ("extensions_api", "read_namespaced_ingress", "patch_namespaced_ingress",
+                    "create_namespaced_ingress"),
+    }
+
+    def __init__(self, name, api_client_factory):
+        """
+        :param name: cluster name
+        :param api_client_factory: callable to create the api client, the client
+               is created on first use, so clusters never touched never open sockets.
+        """
         self.name = name
         self.cluster = name
-        self.core_v1api = core_v1api
-        self.extensions_api = extensions_api
-        self.batch_api = batch_api
+        self._api_client_factory = api_client_factory
+        self.informer = None
+
+    @cached_property
+    def api_client(self):
+        return self._api_client_factory()
+
+    @cached_property
+    def core_v1api(self):
+        return client.CoreV1Api(api_client=self.api_client)
+
+    @cached_property
+    def extensions_api(self):
+        return client.ExtensionsV1beta1Api(api_client=self.api_client)
+
+    @cached_property
+    def batch_api(self):
+        return client.BatchV1Api(api_client=self.api_client)
+
+    def start_informer(self, app_namespace=DEFAULT_APP_NS, job_namespace=DEFAULT_JOB_NS):
+        if self.informer is None:
+            self.informer = ClusterInformer(self.core_v1api, self.extensions_api, app_namespace, job_namespace)
+            self.informer.start()
+
+    def _get_synced_informer(self, kind, namespace, index_label='kae-app-name'):
+        if self.informer is None:
+            return None
+        return self.informer.lookup(kind, namespace, index_label)
+
+    @staticmethod
+    def _make_pod_list(informer, label_value):
+        return client.V1PodList(
+            items=informer.list_by_label(label_value),
+            metadata=client.V1ListMeta(resource_version=informer.resource_version),
+        )
 
     def create_job(self, spec, namespace='default'):
         body = self._create_job_dict(spec)
@@ -121,6 +309,44 @@ class ClientApiBundle(object):
             if not (e.status == 404 and ignore_404 is True):
                 raise e
 
+    @staticmethod
+    def _wait_deleted(read_func, list_func, name, namespace, timeout):
+        """
+        wait the object to be deleted with a field selector watch
+        :return: False if the object still exists after `timeout` seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                obj = read_func(name=name, namespace=namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    return True
+                raise e
+            resource_version = obj.metadata.resource_version
+
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                return False
+            w = watch.Watch()
+            try:
+                for event in w.stream(list_func, namespace,
+                                      field_selector="metadata.name={}".format(name),
+                                      resource_version=resource_version, timeout_seconds=remaining):
+                    if event['type'] == 'DELETED':
+                        return True
+                    if event['type'] == 'ERROR':
+                        # the resource version is too old, read the object again
+                        break
+            except ProtocolError:
+                logger.warn("watch of {} disconnected, rewatch".format(name))
+            finally:
+                w.stop()
+
+    def wait_job_deleted(self, jobname, namespace='default', timeout=JOB_DELETE_TIMEOUT):
+        return self._wait_deleted(self.batch_api.read_namespaced_job, self.batch_api.list_namespaced_job,
+                                  jobname, namespace, timeout)
+
     def get_job(self, jobname, namespace='default'):
         return self.batch_api.read_namespaced_job(jobname, namespace=namespace)
 
@@ -131,6 +357,20 @@ class ClientApiBundle(object):
         kwargs.pop('follow', False)
         return self.core_v1api.read_namespaced_pod_log(name=podname, namespace=namespace, **kwargs)
 
+    def stream_pod_log(self, podname, namespace='default', chunk_size=64 * 1024, **kwargs):
+        """
+        read the pod log in chunks(bytes), so the whole log is never in memory
+        """
+        kwargs['_preload_content'] = False
+        kwargs.pop('follow', False)
+        resp = self.core_v1api.read_namespaced_pod_log(name=podname, namespace=namespace, **kwargs)
+        try:
+            for chunk in resp.stream(chunk_size):
+                yield chunk
+        finally:
+            resp.close()
+            resp.release_conn()
+
     def follow_pod_log(self, podname, namespace='default', **kwargs):
         kwargs['_preload_content'] = False
         kwargs['follow'] = True
@@ -138,19 +378,89 @@ class ClientApiBundle(object):
         for line in iter_resp_lines(resp):
             yield line
 
+    def get_pod(self, podname, namespace='default', ignore_404=False, live=False):
+        """
+        :param live: read from the api server even if the informer is synced
+        """
+        informer = None if live else self._get_synced_informer('pod', namespace)
+        if informer is not None:
+            return self._get_from_informer(informer, podname, ignore_404)
+        try:
+            return self.core_v1api.read_namespaced_pod(name=podname, namespace=namespace)
+        except ApiException as e:
+            if e.status == 404 and ignore_404 is True:
+                return None
+            else:
+                raise e
+
     def get_job_pods(self, jobname, namespace='default'):
+        informer = self._get_synced_informer('pod', namespace, 'kae-job-name')
+        if informer is not None:
+            return self._make_pod_list(informer, jobname)
         label_selector = "kae-job-name={}".format(jobname)
         return self.core_v1api.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
 
     def get_app_pods(self, name, namespace="default"):
+        informer = self._get_synced_informer('pod', namespace)
+        if informer is not None:
+            return self._make_pod_list(informer, name)
         label_selector = "kae-app-name={}".format(name)
         return self.core_v1api.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
 
     def watch_pods(self, label_selector=None, **kwargs):
+        """
+        watch the pods like `watch.Watch`: the `object` of the event is V1Pod and the raw dict is `raw_object`,
+        the events are read with `watch_pods_raw`, so the BOOKMARK events can be requested.
+        the `object` of the ERROR and BOOKMARK events is the raw dict.
+        """
+        for event in self.watch_pods_raw(label_selector=label_selector, **kwargs):
+            event['raw_object'] = event['object']
+            if event['type'] not in ('ERROR', 'BOOKMARK'):
+                resp = SimpleNamespace(data=json.dumps(event['raw_object']))
+                event['object'] = self.api_client.deserialize(resp, 'V1Pod')
+            yield event
+
+    def list_all_pods(self, label_selector=None, raw=False):
+        """
+        list pods in all namespaces
+        :param raw: return the raw dict instead of V1PodList
+        """
         if label_selector is None:
             label_selector = "kae=true"
-        w = watch.Watch()
-        return w.stream(self.core_v1api.list_pod_for_all_namespaces, label_selector=label_selector, **kwargs)
+        if not raw:
+            return self.core_v1api.list_pod_for_all_namespaces(label_selector=label_selector)
+        resp = self.core_v1api.list_pod_for_all_namespaces(label_selector=label_selector, _preload_content=False)
+        return json.loads(resp.data)
+
+    def watch_pods_raw(self, label_selector=None, resource_version=None, timeout_seconds=None, allow_bookmarks=False):
+        """
+        like `watch_pods`, but the events are not deserialized into models: the `object` of
+        the event is the raw dict. it returns when the server closes the stream.
+        :param allow_bookmarks: ask the server to send BOOKMARK events
+        """
+        if label_selector is None:
+            label_selector = "kae=true"
+        query_params = [('labelSelector', label_selector), ('watch', 'true')]
+        if resource_version is not None:
+            query_params.append(('resourceVersion', resource_version))
+        if timeout_seconds is not None:
+            query_params.append(('timeoutSeconds', timeout_seconds))
+        if allow_bookmarks:
+            query_params.append(('allowWatchBookmarks', 'true'))
+        # the kubernetes client doesn't know allowWatchBookmarks, so call the api directly
+        resp = self.api_client.call_api(
+            '/api/v1/pods', 'GET',
+            query_params=query_params,
+            header_params={'Accept': 'application/json;stream=watch'},
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True,
+            _preload_content=False)
+        try:
+            for line in iter_resp_lines(resp):
+                yield json.loads(line)
+        finally:
+            resp.close()
+            resp.release_conn()
 
     def exec_shell(self, podname, namespace='default', container=None):
         exec_command = ['/bin/sh']
@@ -263,13 +573,17 @@ class ClientApiBundle(object):
     def delete_secret(self, appname, namespace="default"):
         self.core_v1api.delete_namespaced_secret(name=appname, namespace=namespace, body=client.V1DeleteOptions())
 
-    def apply(self, d, namespace="default"):
+    def apply(self, d, namespace="default", strategy=K8S_APPLY_STRATEGY):
         """
         create or update deplopyment, service, ingress
         :param d:
         :param namespace:
+        :param strategy: `replace` or `patch`
         :return:
         """
+        if strategy == "patch":
+            self.patch_apply(d, namespace=namespace)
+            return
         kind = d["kind"]
         name = d["metadata"]["name"]
         if kind == "Deployment":
@@ -291,6 +605,71 @@ class ClientApiBundle(object):
                 else:
                     raise e
 
+    @classmethod
+    def _hash_object(cls, d):
+        obj = copy.deepcopy(d)
+        obj['metadata'].pop('resourceVersion', None)
+        content = json.dumps(obj, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+    @staticmethod
+    def _add_replace_directives(d):
+        """
+        strategic merge patch merges maps and keyed lists, so the fields removed from
+        the desired object would be kept, use `$patch: replace` to replace them as a whole.
+        """
+        kind = d["kind"]
+        if kind == "Deployment":
+            d['spec']['template']['spec']['$patch'] = 'replace'
+        elif kind == "Service":
+            d['spec']['ports'] = [{'$patch': 'replace'}] + list(d['spec']['ports'])
+        elif kind == "Ingress":
+            d['spec']['$patch'] = 'replace'
+
+    def patch_apply(self, d, namespace="default", create_missing=True):
+        """
+        create or update deployment, service, ingress with a single strategic merge patch.
+        the hash of the desired object is stored in an annotation, when the current object
+        was already applied with the same hash, the write is skipped. the current object is
+        read from the api server, the informer cache may lag behind the last write.
+        :param d:
+        :param namespace:
+        :param create_missing: create the object when it doesn't exist
+        :return: False if the write is skipped
+        """
+        kind = d["kind"]
+        name = d["metadata"]["name"]
+        api_attr, read_method, patch_method, create_method = self._PATCH_APPLY_METHODS[kind]
+        api = getattr(self, api_attr)
+
+        applied_hash = self._hash_object(d)
+        try:
+            current = getattr(api, read_method)(name=name, namespace=namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise e
+            current = None
+        if current is not None:
+            annotations = current.metadata.annotations or {}
+            if annotations.get(self.APPLIED_HASH_ANNOTATION) == applied_hash:
+                logger.debug("{} {} is unchanged, skip applying".format(kind, name))
+                return False
+
+        body = copy.deepcopy(d)
+        if not body['metadata'].get('annotations'):
+            body['metadata']['annotations'] = {}
+        body['metadata']['annotations'][self.APPLIED_HASH_ANNOTATION] = applied_hash
+        patch_body = copy.deepcopy(body)
+        self._add_replace_directives(patch_body)
+        try:
+            getattr(api, patch_method)(name=name, namespace=namespace, body=patch_body)
+        except ApiException as e:
+            if e.status == 404 and create_missing is True:
+                getattr(api, create_method)(namespace=namespace, body=body)
+            else:
+                raise e
+        return True
+
     def create_or_update_service(self, d, namespace="default"):
         name = d['metadata']['name']
         try:
@@ -396,7 +775,34 @@ class ClientApiBundle(object):
         ing.metadata.annotations = annotations
         self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=namespace)
 
-    def undeploy_app_canary(self, appname, namespace="default", ignore_404=False):
+    def wait_ingress_synced(self, ing, namespace="default"):
+        """
+        wait the ingress controller to pick up the change of the ingress.
+        if INGRESS_SYNC_PROBE_URL is set, poll it until it returns 2xx,
+        otherwise sleep INGRESS_SYNC_DELAY seconds.
+        """
+        if not INGRESS_SYNC_PROBE_URL:
+            time.sleep(INGRESS_SYNC_DELAY)
+            return
+        url = INGRESS_SYNC_PROBE_URL.format(
+            name=ing.metadata.name, namespace=namespace,
+            resource_version=ing.metadata.resource_version)
+        deadline = time.time() + INGRESS_SYNC_TIMEOUT
+        while time.time() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=INGRESS_SYNC_TIMEOUT) as resp:
+                    if 200 <= resp.status < 300:
+                        return
+            except Exception as e:
+                logger.debug("ingress sync probe {} failed: {}".format(url, str(e)))
+            time.sleep(0.1)
+        logger.warn("ingress {} isn't synced in {} seconds".format(ing.metadata.name, INGRESS_SYNC_TIMEOUT))
+
+    def undeploy_app_canary(self, appname, namespace="default", ignore_404=False, update_ingress=True):
+        """
+        remove canary deployment, service and the canary rules in the app's ingress.
+        :param update_ingress: set to False if the app's ingress is deleted or will be deleted
+        """
         canary_appname = make_canary_appname(appname)
         delete_keys = [
             "{}/abtesting".format(INGRESS_ANNOTATIONS_PREFIX),
@@ -404,23 +810,28 @@ class ClientApiBundle(object):
         ]
         # remove abtesting rules
         try:
-            ing = self.extensions_api.read_namespaced_ingress(appname, namespace=namespace)
-
-            annotations = ing.metadata.annotations if ing.metadata.annotations else {}
-            for k in delete_keys:
-                if k in annotations:
-                    ing.metadata.annotations.pop(k)
-            for rule in ing.spec.rules:
-                need_delete = []
-                for path in rule.http.paths:
-                    if path.backend.service_name == canary_appname:
-                        need_delete.append(path)
-                for path in need_delete:
-                    rule.http.paths.remove(path)
-
-            self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=namespace)
-            # the nginx-ingress needs about 1 seconds to detect the change of the ingress
-            time.sleep(1)
+            if update_ingress:
+                ing = self.extensions_api.read_namespaced_ingress(appname, namespace=namespace)
+
+                changed = False
+                annotations = ing.metadata.annotations if ing.metadata.annotations else {}
+                for k in delete_keys:
+                    if k in annotations:
+                        ing.metadata.annotations.pop(k)
+                        changed = True
+                for rule in ing.spec.rules:
+                    need_delete = []
+                    for path in rule.http.paths:
+                        if path.backend.service_name == canary_appname:
+                            need_delete.append(path)
+                    for path in need_delete:
+                        rule.http.paths.remove(path)
+                        changed = True
+
+                # skip the rewrite when there are no canary rules
+                if changed:
+                    ing = self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=namespace)
+                    self.wait_ingress_synced(ing, namespace=namespace)
         except ApiException as e:
             if not (e.status == 404 and ignore_404 is True):
                 raise e
@@ -448,7 +859,11 @@ class ClientApiBundle(object):
             'release_tag': release_tag,
         }
         d = self._create_deployment_dict(spec, version=version, renew_id=renew_id, annotations=dp_annotations)
-        self.extensions_api.replace_namespaced_deployment(name=appname, namespace=namespace, body=d)
+        if K8S_APPLY_STRATEGY == "patch":
+            # the deployment must exist, so a 404 is raised instead of creating it
+            self.patch_apply(d, namespace=namespace, create_missing=False)
+        else:
+            self.extensions_api.replace_namespaced_deployment(name=appname, namespace=namespace, body=d)
 
     def rollback_app(self, appname, revision=0, namespace="default"):
         rollback_to = client.ExtensionsV1beta1RollbackConfig()
@@ -464,9 +879,7 @@ class ClientApiBundle(object):
         self.extensions_api.create_namespaced_deployment_rollback(name=appname, namespace=namespace, body=rollback)
 
     def undeploy_app(self, appname, apptype, namespace='default', ignore_404=False):
-        self.undeploy_app_canary(appname, namespace=namespace, ignore_404=True)
-
-        # delete resource in the following order: ingress, service, deployment, secret, configmap
+        # delete resource in the following order: ingress, canary, service, deployment, secret, configmap
         if apptype == "web":
             try:
                 self.extensions_api.delete_namespaced_ingress(
@@ -477,6 +890,9 @@ class ClientApiBundle(object):
                 if not (e.status == 404 and ignore_404 is True):
                     raise e
 
+        # the ingress is already deleted, so there is no need to remove the canary rules from it
+        self.undeploy_app_canary(appname, namespace=namespace, ignore_404=True, update_ingress=False)
+
         if apptype in ("worker", "web"):
             try:
                 self.core_v1api.delete_namespaced_service(
@@ -506,13 +922,18 @@ class ClientApiBundle(object):
             if e.status != 404:
                 raise e
 
-    def get_deployment(self, name, namespace='default', ignore_404=False):
+    def get_deployment(self, name, namespace='default', ignore_404=False, live=False):
         """
         get kubernetes deployment object
         :param name:
         :param namespace:
+        :param live: read from the api server even if the informer is synced,
+                     use it when the resource version of the result is used to update the deployment
         :return:
         """
+        informer = None if live else self._get_synced_informer('deployment', namespace)
+        if informer is not None:
+            return self._get_from_informer(informer, name, ignore_404)
         try:
             return self.extensions_api.read_namespaced_deployment(name=name, namespace=namespace)
         except ApiException as e:
@@ -521,13 +942,115 @@ class ClientApiBundle(object):
             else:
                 raise e
 
-    def get_ingress(self, name, namespace='default', ignore_404=False):
+    @staticmethod
+    def rollout_status(dp):
         """
-        get kubernetes deployment object
+        compute the rollout status of a deployment(the same rules as `kubectl rollout status`)
+        :param dp: deployment object
+        :return: dict, `done` is True when the rollout is finished, `failed` is True when
+                 the progress deadline is exceeded
+        """
+        spec_replicas = dp.spec.replicas or 0
+        st = dp.status
+        status = {
+            'name': dp.metadata.name,
+            'generation': dp.metadata.generation,
+            'observed_generation': st.observed_generation,
+            'replicas': spec_replicas,
+            'updated_replicas': st.updated_replicas or 0,
+            'available_replicas': st.available_replicas or 0,
+            'total_replicas': st.replicas or 0,
+            'done': False,
+            'failed': False,
+            'msg': '',
+        }
+        if st.observed_generation is None or dp.metadata.generation > st.observed_generation:
+            status['msg'] = "waiting for deployment spec update to be observed"
+            return status
+        for cond in st.conditions or []:
+            if cond.type == 'Progressing' and cond.reason == 'ProgressDeadlineExceeded':
+                status['failed'] = True
+                status['msg'] = "deployment {} exceeded its progress deadline".format(dp.metadata.name)
+                return status
+        if status['updated_replicas'] < spec_replicas:
+            status['msg'] = "{} out of {} new replicas have been updated".format(status['updated_replicas'], spec_replicas)
+        elif status['total_replicas'] > status['updated_replicas']:
+            status['msg'] = "{} old replicas are pending termination".format(status['total_replicas'] - status['updated_replicas'])
+        elif status['available_replicas'] < status['updated_replicas']:
+            status['msg'] = "{} of {} updated replicas are available".format(status['available_replicas'], status['updated_replicas'])
+        else:
+            status['done'] = True
+            status['msg'] = "deployment {} successfully rolled out".format(dp.metadata.name)
+        return status
+
+    def watch_rollout(self, name, namespace='default', timeout=DEPLOY_ROLLOUT_TIMEOUT):
+        """
+        watch the deployment with a single watch stream and yield the rollout status every time it changes,
+        stop when the rollout is finished or failed, or `timeout` seconds passed.
+        """
+        deadline = time.time() + timeout
+        resource_version = None
+        last_status = None
+        while True:
+            if resource_version is None:
+                dp = self.extensions_api.read_namespaced_deployment(name=name, namespace=namespace)
+                resource_version = dp.metadata.resource_version
+                status = self.rollout_status(dp)
+                if status != last_status:
+                    last_status = status
+                    yield status
+                if status['done'] or status['failed']:
+                    return
+
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                return
+            w = watch.Watch()
+            try:
+                for event in w.stream(self.extensions_api.list_namespaced_deployment, namespace,
+                                      field_selector="metadata.name={}".format(name),
+                                      resource_version=resource_version, timeout_seconds=remaining):
+                    if event['type'] == 'ERROR':
+                        # the resource version is too old, read the deployment again
+                        resource_version = None
+                        break
+                    if event['type'] == 'DELETED':
+                        raise KubeError("deployment {} is deleted".format(name))
+                    dp = event['object']
+                    resource_version = dp.metadata.resource_version
+                    status = self.rollout_status(dp)
+                    if status != last_status:
+                        last_status = status
+                        yield status
+                    if status['done'] or status['failed']:
+                        return
+            except ProtocolError:
+                logger.warn("rollout watch of deployment {} disconnected, rewatch".format(name))
+            finally:
+                w.stop()
+
+    def wait_rollout(self, name, namespace='default', timeout=DEPLOY_ROLLOUT_TIMEOUT):
+        """
+        block until the rollout is finished or failed, or `timeout` seconds passed.
+        :return: the last rollout status, with `timeout` set to True if the rollout isn't finished in time
+        """
+        status = None
+        for status in self.watch_rollout(name, namespace=namespace, timeout=timeout):
+            pass
+        status['timeout'] = not (status['done'] or status['failed'])
+        return status
+
+    def get_ingress(self, name, namespace='default', ignore_404=False, live=False):
+        """
+        get kubernetes ingress object
         :param name:
         :param namespace:
+        :param live: read from the api server even if the informer is synced
         :return:
         """
+        informer = None if live else self._get_synced_informer('ingress', namespace)
+        if informer is not None:
+            return self._get_from_informer(informer, name, ignore_404)
         try:
             return self.extensions_api.read_namespaced_ingress(name=name, namespace=namespace)
         except ApiException as e:
@@ -536,6 +1059,13 @@ class ClientApiBundle(object):
             else:
                 raise e
 
+    @staticmethod
+    def _get_from_informer(informer, name, ignore_404=False):
+        obj = informer.get(name)
+        if obj is None and ignore_404 is False:
+            raise ApiException(status=404, reason="Not Found")
+        return obj
+
     def _construct_pod_spec(self, name, volumes_root, container_spec_list,
                             restartPolicy='Always', initial_env=None,
                             initial_vol_mounts=None, default_work_dir=None, secret_name=None):
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+asynchronous notifications(email and bearychat).
+the notifications are queued in redis per recipient, the first one of a recipient schedules
+a celery task `send_notifications` after `NOTIFY_BATCH_WINDOW` seconds, which sends all the
+notifications queued for the recipient by then in one message, and retries if it fails.
+the emails are sent through the SMTP connections pooled in the worker process.
+"""
+import os
+import json
+import time
+import smtplib
+import threading
+
+from console.config import (
+    BOT_WEBHOOK_URL, NOTIFY_BATCH_WINDOW, SMTP_POOL_SIZE, SMTP_IDLE_TIMEOUT,
+)
+
+NOTIFY_EMAIL = 'email'
+NOTIFY_BEARYCHAT = 'bearychat'
+
+
+def make_notify_queue_key(kind, recipient):
+    return "kae-notify-{}-{}".format(kind, recipient)
+
+
+def make_notify_scheduled_key(kind, recipient):
+    return "kae-notify-{}-{}-scheduled".format(kind, recipient)
+
+
+def _enqueue(kind, recipient, item):
+    from console.ext import rds
+    from console.tasks import send_notifications
+
+    rds.rpush(make_notify_queue_key(kind, recipient), json.dumps(item))
+    # only one task is scheduled for the notifications queued in the batch window
+    if rds.set(make_notify_scheduled_key(kind, recipient), 1, nx=True, ex=NOTIFY_BATCH_WINDOW * 10):
+        send_notifications.apply_async((kind, recipient), countdown=NOTIFY_BATCH_WINDOW)
+
+
+def notify_email(receivers, subject, text):
+    """
+    :param text: the html body
+    """
+    for receiver in receivers:
+        if receiver:
+            _enqueue(NOTIFY_EMAIL, receiver, {'subject': subject, 'text': text})
+
+
+def notify_bearychat(to, content):
+    if not all([to, content, BOT_WEBHOOK_URL]):
+        return
+    _enqueue(NOTIFY_BEARYCHAT, to.strip(';'), {'content': content})
+
+
+def pop_notifications(kind, recipient):
+    """
+    :return: all the notifications queued for the recipient
+    """
+    from console.ext import rds
+
+    # the notifications queued after this are sent by a new task
+    rds.delete(make_notify_scheduled_key(kind, recipient))
+    key = make_notify_queue_key(kind, recipient)
+    pipe = rds.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    items, _ = pipe.execute()
+    return [json.loads(item.decode('utf-8') if isinstance(item, bytes) else item) for item in items]
+
+
+def requeue_notifications(kind, recipient, items):
+    """
+    put the notifications failed to send back to the front of the queue
+    """
+    from console.ext import rds
+
+    if items:
+        rds.lpush(make_notify_queue_key(kind, recipient), *[json.dumps(item) for item in reversed(items)])
+
+
+def merge_emails(items):
+    """
+    :return: (subject, text) of the email containing all the notifications
+    """
+    if len(items) == 1:
+        return items[0]['subject'], items[0]['text']
+    subject = 'KAE: {} notifications'.format(len(items))
+    text = '<hr/>'.join('<h3>{}</h3>{}'.format(item['subject'], item['text']) for item in items)
+    return subject, text
+
+
+def merge_bearychat_msgs(items):
+    return '\n\n'.join(item['content'] for item in items)
+
+
+class SMTPPool(object):
+    """
+    the idle SMTP connections of a server and sender, the connections idle longer than
+    `idle_timeout` seconds are closed(the servers usually close them first).
+    """
+
+    def __init__(self, server, sender, password, maxsize=SMTP_POOL_SIZE, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.server = server
+        self.sender = sender
+        self.password = password
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        # (last used time, connection)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.server)
+        conn.login(self.sender, self.password)
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def _acquire(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                used, conn = self._idle.pop()
+            if now - used < self.idle_timeout:
+                return conn
+            self._close(conn)
+        return self._connect()
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((time.time(), conn))
+                return
+        self._close(conn)
+
+    def sendmail(self, receivers, msg):
+        """
+        :param msg: the `email.message.Message`
+        """
+        conn = self._acquire()
+        try:
+            try:
+                conn.sendmail(self.sender, receivers, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # the pooled connection is closed by the server, retry with a new one
+                conn.close()
+                conn = self._connect()
+                conn.sendmail(self.sender, receivers, msg.as_string())
+        except Exception:
+            self._close(conn)
+            raise
+        self._release(conn)
+
+
+_smtp_pools = {}
+_smtp_pools_pid = None
+_smtp_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(server, sender, password):
+    """
+    the pool of the current process, the connections can't be shared by the forked workers
+    """
+    global _smtp_pools, _smtp_pools_pid
+    with _smtp_pools_lock:
+        if _smtp_pools_pid != os.getpid():
+            _smtp_pools = {}
+            _smtp_pools_pid = os.getpid()
+        key = (server, sender)
+        if key not in _smtp_pools:
+            _smtp_pools[key] = SMTPPool(server, sender, password)
+        return _smtp_pools[key]
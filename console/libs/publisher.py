@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import time
+import threading
+
+from console.libs.jsonutils import VersatileEncoder
+from console.libs.utils import logger
+
+
+_FIRST_CAP_RE = re.compile(r'(.)([A-Z][a-z]+)')
+_ALL_CAP_RE = re.compile(r'([a-z0-9])([A-Z])')
+
+
+def _snake_case(name):
+    # hostIP -> host_ip, containerID -> container_id, startedAt -> started_at
+    return _ALL_CAP_RE.sub(r'\1_\2', _FIRST_CAP_RE.sub(r'\1_\2', name)).lower()
+
+
+def _format_time(value):
+    # the same format as VersatileEncoder: 2019-01-02T03:04:05Z -> 2019-01-02 03:04:05
+    if not value:
+        return value
+    return value.replace('T', ' ').rstrip('Z')
+
+
+# the keys of these fields are user data(labels, resource names...), they are kept as they are
+_MAP_FIELDS = {'labels', 'annotations', 'node_selector', 'limits', 'requests'}
+
+
+def raw_to_dict(value):
+    """
+    convert a raw kubernetes object to the same format as `to_dict()` of the model
+    """
+    if isinstance(value, list):
+        return [raw_to_dict(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for k, v in value.items():
+        key = _snake_case(k)
+        if key in _MAP_FIELDS:
+            result[key] = v
+        elif isinstance(v, str) and key.endswith(('_at', '_time', '_timestamp')):
+            result[key] = _format_time(v)
+        else:
+            result[key] = raw_to_dict(v)
+    return result
+
+
+def project_raw_pod(raw):
+    """
+    the same as `project_pod`, but works on the raw dict of the pod
+    """
+    meta, spec, status = raw['metadata'], raw.get('spec') or {}, raw.get('status') or {}
+    container_statuses = []
+    for cs in status.get('containerStatuses') or []:
+        state = cs.get('state')
+        if state is not None:
+            state = {k: raw_to_dict(state[k]) if state.get(k) else None for k in ('running', 'terminated', 'waiting')}
+        container_statuses.append({
+            'name': cs.get('name'),
+            'image': cs.get('image'),
+            'ready': cs.get('ready'),
+            'restart_count': cs.get('restartCount'),
+            'state': state,
+        })
+    return {
+        'metadata': {
+            'name': meta['name'],
+            'namespace': meta.get('namespace'),
+            'labels': meta.get('labels'),
+            'resource_version': meta.get('resourceVersion'),
+            'creation_timestamp': _format_time(meta.get('creationTimestamp')),
+            'deletion_timestamp': _format_time(meta.get('deletionTimestamp')),
+        },
+        'spec': {
+            'node_name': spec.get('nodeName'),
+        },
+        'status': {
+            'phase': status.get('phase'),
+            'reason': status.get('reason'),
+            'host_ip': status.get('hostIP'),
+            'pod_ip': status.get('podIP'),
+            'start_time': _format_time(status.get('startTime')),
+            'conditions': raw_to_dict(status.get('conditions') or []),
+            'container_statuses': container_statuses,
+        },
+    }
+
+
+def project_pod(pod):
+    """
+    only keep the fields of the pod used by the UI
+    :param pod: V1Pod object or the raw dict of the pod
+    """
+    if isinstance(pod, dict):
+        return project_raw_pod(pod)
+    meta, spec, status = pod.metadata, pod.spec, pod.status
+    container_statuses = []
+    for cs in status.container_statuses or []:
+        container_statuses.append({
+            'name': cs.name,
+            'image': cs.image,
+            'ready': cs.ready,
+            'restart_count': cs.restart_count,
+            'state': cs.state.to_dict() if cs.state else None,
+        })
+    return {
+        'metadata': {
+            'name': meta.name,
+            'namespace': meta.namespace,
+            'labels': meta.labels,
+            'resource_version': meta.resource_version,
+            'creation_timestamp': meta.creation_timestamp,
+            'deletion_timestamp': meta.deletion_timestamp,
+        },
+        'spec': {
+            'node_name': spec.node_name if spec else None,
+        },
+        'status': {
+            'phase': status.phase,
+            'reason': status.reason,
+            'host_ip': status.host_ip,
+            'pod_ip': status.pod_ip,
+            'start_time': status.start_time,
+            'conditions': [c.to_dict() for c in status.conditions or []],
+            'container_statuses': container_statuses,
+        },
+    }
+
+
+def _escape_pointer(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def json_diff(old, new, path=''):
+    """
+    generate JSON patch(RFC 6902) operations to change `old` to `new`,
+    dicts are compared recursively, other values(including lists) are replaced as a whole.
+    """
+    ops = []
+    for k in old:
+        if k not in new:
+            ops.append({'op': 'remove', 'path': '{}/{}'.format(path, _escape_pointer(k))})
+    for k, v in new.items():
+        p = '{}/{}'.format(path, _escape_pointer(k))
+        if k not in old:
+            ops.append({'op': 'add', 'path': p, 'value': v})
+        elif isinstance(v, dict) and isinstance(old[k], dict):
+            ops.extend(json_diff(old[k], v, p))
+        elif v != old[k]:
+            ops.append({'op': 'replace', 'path': p, 'value': v})
+    return ops
+
+
+class FullPodEncoder(object):
+    """
+    publish the whole pod object, the raw dict is converted to the same format as the model(snake case keys)
+    """
+    def encode(self, channel, key, action, obj):
+        data = {
+            'object': raw_to_dict(obj) if isinstance(obj, dict) else obj.to_dict(),
+            'action': action,
+        }
+        return json.dumps(data, cls=VersatileEncoder)
+
+
+class CompactPodEncoder(object):
+    """
+    publish the projection of the pod, for MODIFIED event, only publish
+    the JSON patch against the last published projection, the message looks like:
+        {"action": "MODIFIED", "name": "pod name", "base_version": "1", "resource_version": "2", "patch": [...]}
+    `base_version` is the resource version of the projection the patch should be applied to.
+    """
+    def __init__(self):
+        # (channel, pod name) -> last published projection
+        self._last = {}
+
+    def encode(self, channel, key, action, obj):
+        proj = project_pod(obj)
+        if action == 'DELETED':
+            self._last.pop((channel, key), None)
+            last = None
+        else:
+            last = self._last.get((channel, key))
+            self._last[(channel, key)] = proj
+
+        if action == 'MODIFIED' and last is not None:
+            data = {
+                'action': action,
+                'name': key,
+                'base_version': last['metadata']['resource_version'],
+                'resource_version': proj['metadata']['resource_version'],
+                'patch': json_diff(last, proj),
+            }
+        else:
+            data = {
+                'object': proj,
+                'action': action,
+            }
+        return json.dumps(data, cls=VersatileEncoder)
+
+
+class CoalescingPublisher(object):
+    """
+    buffer the pod events for a short window and publish them with a redis pipeline.
+    in a window, the MODIFIED events of the same pod are merged into the pending
+    ADDED/MODIFIED event of that pod(last write wins), ADDED and DELETED events are
+    never dropped, so the order of them is preserved.
+    """
+
+    def __init__(self, rds, window=0.2, max_pending=1000, encoder=None):
+        """
+        :param rds: redis client
+        :param window: seconds to buffer the events, publish immediately if it is 0
+        :param max_pending: flush when the number of pending events exceeds it
+        :param encoder: object to encode the event to message, default is FullPodEncoder
+        """
+        self.rds = rds
+        self.window = window
+        self.max_pending = max_pending
+        self.encoder = encoder or FullPodEncoder()
+
+        self._pending = []
+        # (channel, key) -> index of the last pending event of that key in self._pending
+        self._last = {}
+        self._lock = threading.Lock()
+        # the encoder may keep state, so the events must be encoded and published in order
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self.window > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='coalescing-publisher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def publish(self, channel, key, action, obj):
+        """
+        :param channel: redis channel
+        :param key: events with the same key can be merged, usually it's the pod name
+        :param action: ADDED, MODIFIED or DELETED
+        :param obj: kubernetes object
+        """
+        with self._lock:
+            idx = self._last.get((channel, key))
+            if action == 'MODIFIED' and idx is not None and self._pending[idx][2] in ('ADDED', 'MODIFIED'):
+                ch, _, last_action, _ = self._pending[idx]
+                self._pending[idx] = (ch, key, last_action, obj)
+            else:
+                self._last[(channel, key)] = len(self._pending)
+                self._pending.append((channel, key, action, obj))
+            need_flush = self.window <= 0 or len(self._pending) >= self.max_pending
+        if need_flush:
+            self.flush()
+
+    def pop_pending(self):
+        """
+        return the pending (channel, message) list and clear it.
+        """
+        with self._lock:
+            pending, self._pending, self._last = self._pending, [], {}
+        return [(channel, self.encoder.encode(channel, key, action, obj)) for channel, key, action, obj in pending]
+
+    def flush(self):
+        with self._flush_lock:
+            messages = self.pop_pending()
+            if not messages:
+                return
+            pipe = self.rds.pipeline(transaction=False)
+            for channel, message in messages:
+                pipe.publish(channel, message)
+            pipe.execute()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("error when publish pod events")
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+a per-process pubsub hub for the websocket handlers: all the subscriptions of the
+process share one redis connection, the messages are dispatched to the gevent queue of
+every subscription, the redis channels and patterns are reference counted.
+"""
+import os
+from collections import defaultdict
+
+import gevent
+import gevent.lock
+import gevent.queue
+
+from console.config import PUBSUB_HUB_QUEUE_SIZE
+from console.libs.utils import logger
+
+# the hub always subscribes this channel, so the connection is set up before any subscriptions
+HUB_CONTROL_CHANNEL = "kae-pubsub-hub"
+
+
+class SubscriptionOverflow(Exception):
+    """the subscriber is too slow, some messages are dropped"""
+
+
+def _decode(s):
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+
+class Subscription(object):
+
+    def __init__(self, hub, maxsize):
+        self.hub = hub
+        self.channels = set()
+        self.patterns = set()
+        self.overflowed = False
+        self._queue = gevent.queue.Queue(maxsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put(self, channel, data):
+        if self.overflowed:
+            return
+        try:
+            self._queue.put_nowait((channel, data))
+        except gevent.queue.Full:
+            self.overflowed = True
+            self.hub.remove(self)
+
+    def get(self, timeout=None):
+        """
+        :return: (channel, data) of the next message, None when timeout
+        :raise: SubscriptionOverflow when some messages are dropped
+        """
+        if self.overflowed:
+            raise SubscriptionOverflow()
+        try:
+            return self._queue.get(timeout=timeout)
+        except gevent.queue.Empty:
+            return None
+
+    def unsubscribe(self, *channels):
+        self.hub.unsubscribe(self, channels)
+
+    def close(self):
+        self.hub.remove(self)
+
+
+class PubSubHub(object):
+
+    def __init__(self, rds, maxsize=PUBSUB_HUB_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._pubsub = rds.pubsub()
+        # channel(or pattern) -> subscriptions
+        self._channels = defaultdict(set)
+        self._patterns = defaultdict(set)
+        # keep the order of the SUBSCRIBE/UNSUBSCRIBE commands the same as the reference count changes
+        self._lock = gevent.lock.RLock()
+        self._reader = None
+
+    def start(self):
+        if self._reader is None:
+            self._pubsub.subscribe(HUB_CONTROL_CHANNEL)
+            self._reader = gevent.spawn(self._run)
+
+    def subscribe(self, channels=(), patterns=()):
+        sub = Subscription(self, self.maxsize)
+        with self._lock:
+            new_channels = [c for c in channels if c not in self._channels]
+            new_patterns = [p for p in patterns if p not in self._patterns]
+            for c in channels:
+                self._channels[c].add(sub)
+                sub.channels.add(c)
+            for p in patterns:
+                self._patterns[p].add(sub)
+                sub.patterns.add(p)
+            if new_channels:
+                self._pubsub.subscribe(*new_channels)
+            if new_patterns:
+                self._pubsub.psubscribe(*new_patterns)
+        return sub
+
+    def unsubscribe(self, sub, channels=(), patterns=()):
+        with self._lock:
+            unused_channels = self._release(self._channels, sub, sub.channels, channels)
+            unused_patterns = self._release(self._patterns, sub, sub.patterns, patterns)
+            if unused_channels:
+                self._pubsub.unsubscribe(*unused_channels)
+            if unused_patterns:
+                self._pubsub.punsubscribe(*unused_patterns)
+
+    def remove(self, sub):
+        self.unsubscribe(sub, list(sub.channels), list(sub.patterns))
+
+    @staticmethod
+    def _release(refs, sub, owned, names):
+        unused = []
+        for name in names:
+            if name not in owned:
+                continue
+            owned.discard(name)
+            subs = refs[name]
+            subs.discard(sub)
+            if not subs:
+                del refs[name]
+                unused.append(name)
+        return unused
+
+    def _dispatch(self, message):
+        channel = _decode(message['channel'])
+        data = message['data']
+        if message['type'] == 'pmessage':
+            subs = self._patterns.get(_decode(message['pattern']), ())
+        else:
+            subs = self._channels.get(channel, ())
+        for sub in list(subs):
+            sub.put(channel, data)
+
+    def _run(self):
+        while True:
+            try:
+                message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=30)
+                if message is not None:
+                    self._dispatch(message)
+            except Exception:
+                # the connection is rebuilt and the channels are subscribed again in the next read
+                logger.exception("error when read pubsub messages")
+                gevent.sleep(1)
+
+
+_hub = None
+_hub_pid = None
+
+
+def get_pubsub_hub():
+    """
+    the hub of the current process, it's created lazily(after the worker is forked)
+    """
+    global _hub, _hub_pid
+    if _hub is None or _hub_pid != os.getpid():
+        from console.ext import rds
+        _hub = PubSubHub(rds)
+        _hub_pid = os.getpid()
+        _hub.start()
+    return _hub
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from console.ext import db
+from console.libs.utils import logger
+
+
+def job_pod_status(obj):
+    """
+    compute the job status from the raw dict of the job's pod
+    :return: (status, terminated), terminated is True when the container of the pod is terminated
+    """
+    status = (None, None)
+    pod_status = obj['status']
+    if 'containerStatuses' in pod_status:
+        state = pod_status['containerStatuses'][0]['state']
+        for k, v in state.items():
+            status = (k, v.get('reason', None))
+        status_str = '{}: {}'.format(*status)
+    elif pod_status['phase'] == 'Pending':
+        return "Pending", False
+    else:
+        status_str = '{}: {}'.format(pod_status['phase'], pod_status.get('reason'))
+
+    if status == ('terminated', 'Completed'):
+        status_str = 'Completed'
+    elif status == ('running', None):
+        status_str = 'Running'
+    return status_str, status[0] == 'terminated'
+
+
+class JobStatusReconciler(object):
+    """
+    compute the job status from the job pod events in the watcher process and
+    update the `job` table in batches, the no-op transitions are dropped.
+    only the log saving of the terminated pods is sent to `on_terminated`(usually a celery task).
+    """
+
+    def __init__(self, app, on_terminated, flush_interval=1.0):
+        """
+        :param app: flask app, the database is accessed in its app context
+        :param on_terminated: called with (jobname, podname, job version) when the job's pod is terminated
+        :param flush_interval: seconds between two batches
+        """
+        self.app = app
+        self.on_terminated = on_terminated
+        self.flush_interval = flush_interval
+
+        # jobname -> (podname, status) waiting to be written
+        self._pending = {}
+        # jobname -> name of the terminated pod whose log should be saved
+        self._terminated = {}
+        # jobname -> (podname, status) last written by the reconciler, the pod is recreated
+        # when the job is restarted, so the same status of the new version isn't dropped
+        self._applied = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='job-status-reconciler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, jobname, obj):
+        """
+        :param obj: raw dict of the job's pod
+        """
+        status, terminated = job_pod_status(obj)
+        podname = obj['metadata']['name']
+        with self._lock:
+            last = self._pending.get(jobname, self._applied.get(jobname))
+            if last == (podname, status):
+                # e.g. the MODIFIED events before the pod is deleted, or the pods replayed by a relist
+                return
+            if terminated:
+                self._terminated[jobname] = podname
+            self._pending[jobname] = (podname, status)
+
+    def forget(self, jobname):
+        """
+        the job's pod is deleted, drop the status written for it
+        """
+        with self._lock:
+            self._applied.pop(jobname, None)
+
+    def flush(self):
+        from console.models import Job
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            terminated, self._terminated = self._terminated, {}
+        if not pending and not terminated:
+            return
+
+        with self.app.app_context():
+            try:
+                names = set(pending) | set(terminated)
+                jobs = Job.query.filter(Job.name.in_(names)).all()
+                changed = []
+                for job in jobs:
+                    _, status = pending.get(job.name, (None, None))
+                    # the status is reset when the job is restarted(`Job.inc_version`)
+                    if status is not None and job.status != status:
+                        job.status = status
+                        changed.append(job)
+                if changed:
+                    db.session.commit()
+                # the status already in the table was written with its log saved(e.g. before the watcher restarted)
+                for job in changed:
+                    if job.name in terminated:
+                        self.on_terminated(job.name, terminated[job.name], job.version)
+            except Exception:
+                db.session.rollback()
+                # retry in the next batch unless there are newer events
+                with self._lock:
+                    for jobname, item in pending.items():
+                        self._pending.setdefault(jobname, item)
+                    for jobname, podname in terminated.items():
+                        self._terminated.setdefault(jobname, podname)
+                raise
+            finally:
+                db.session.remove()
+
+        with self._lock:
+            self._applied.update(pending)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("error when update job status")
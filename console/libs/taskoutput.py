@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+the output of the celery tasks is stored in a capped redis stream per task, so the viewers
+attached late or reconnected can replay it from the beginning or from a given entry id.
+the id of every new entry is published on `TASK_PUBSUB_CHANNEL` to wake up the viewers,
+the output itself is always read from the stream.
+"""
+from console.ext import rds
+from console.config import (
+    TASK_PUBSUB_CHANNEL, TASK_PUBSUB_EOF, TASK_OUTPUT_MAX_LEN, TASK_OUTPUT_TTL, TASK_OUTPUT_DONE_TTL,
+)
+
+READ_COUNT = 1000
+
+# the ttl of the running task is set only once, so the output appended after EOF doesn't extend it
+_APPEND_SCRIPT = rds.register_script("""
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'data', ARGV[2])
+if ARGV[4] == '1' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+elseif redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('PUBLISH', KEYS[2], id)
+return id
+""")
+
+
+def _decode(s):
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+
+def make_task_output_key(task_id):
+    return "kae-task-{}-output".format(task_id)
+
+
+def append_task_output(task_id, data, done=False):
+    """
+    :param data: the message(str)
+    :param done: the task is done, the output expires in `TASK_OUTPUT_DONE_TTL` seconds
+    :return: the entry id
+    """
+    keys = [make_task_output_key(task_id), TASK_PUBSUB_CHANNEL.format(task_id=task_id)]
+    ttl = TASK_OUTPUT_DONE_TTL if done else TASK_OUTPUT_TTL
+    return _decode(_APPEND_SCRIPT(keys=keys, args=[TASK_OUTPUT_MAX_LEN, data, ttl, 1 if done else 0]))
+
+
+def finish_task_output(task_id):
+    return append_task_output(task_id, TASK_PUBSUB_EOF.format(task_id=task_id), done=True)
+
+
+def is_task_output_eof(data):
+    return data.startswith('CELERY_TASK_DONE')
+
+
+def _next_id(entry_id):
+    ms, seq = entry_id.split('-')
+    return '{}-{}'.format(ms, int(seq) + 1)
+
+
+def read_task_output(task_id, after_id='0-0'):
+    """
+    yield (entry id, data) of the stored output after `after_id`
+    """
+    key = make_task_output_key(task_id)
+    start = _next_id(after_id)
+    while True:
+        entries = rds.execute_command('XRANGE', key, start, '+', 'COUNT', READ_COUNT)
+        for entry_id, fields in entries:
+            entry_id = _decode(entry_id)
+            yield entry_id, _decode(fields[1])
+        if len(entries) < READ_COUNT:
+            return
+        start = _next_id(entry_id)
+
+
+def iter_task_output(task_ids, start_ids=None, timeout=None):
+    """
+    yield (task id, entry id, data) of the output of the tasks until all of them are done,
+    the stored output is replayed first, then the new output is followed.
+    yield None if there is no output in `timeout` seconds.
+    :param start_ids: task id -> entry id, only the output after it is yielded, default from the beginning
+    """
+    from console.libs.pubsub import get_pubsub_hub, SubscriptionOverflow
+
+    if isinstance(task_ids, str):
+        task_ids = task_ids,
+    start_ids = start_ids or {}
+    last_ids = {tid: start_ids.get(tid) or '0-0' for tid in task_ids}
+    channels = {TASK_PUBSUB_CHANNEL.format(task_id=tid): tid for tid in task_ids}
+    running = set(task_ids)
+
+    def read(tids):
+        items = []
+        for tid in tids:
+            for entry_id, data in read_task_output(tid, last_ids[tid]):
+                last_ids[tid] = entry_id
+                if is_task_output_eof(data):
+                    running.discard(tid)
+                    break
+                items.append((tid, entry_id, data))
+        return items
+
+    hub = get_pubsub_hub()
+    # subscribe before the replay, since the output is always read from the streams,
+    # nothing is missed or duplicated between them.
+    sub = hub.subscribe(list(channels))
+    try:
+        items = read(list(running))
+        while True:
+            for item in items:
+                yield item
+            if not running:
+                return
+
+            woken = set()
+            try:
+                resp = sub.get(timeout=timeout)
+                # the entries appended in a burst are read together
+                while resp is not None:
+                    woken.add(channels[resp[0]])
+                    resp = sub.get(timeout=0)
+            except SubscriptionOverflow:
+                sub.close()
+                sub = hub.subscribe(list(channels))
+                woken = set(running)
+
+            if woken:
+                items = read(woken & running)
+            else:
+                # timeout, check the streams in case a notification was lost
+                items = read(list(running))
+                if not items and running:
+                    yield None
+    finally:
+        sub.close()
@@ -5,28 +5,24 @@ import time
 import json
 import string
 import random
-import shutil
 import logging
 import urllib.request
-import smtplib
-from smtplib import SMTPException
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.utils import COMMASPACE, formatdate
 from email.encoders import encode_base64
-from subprocess import Popen, PIPE, STDOUT, run, CalledProcessError
 
 import docker
 from flask import session
 from functools import wraps
 
 from console.config import (
-    BOT_WEBHOOK_URL, LOGGER_NAME, DEBUG, DEFAULT_REGISTRY, JOBS_LOG_ROOT_DIR,
-    REPO_DATA_DIR, TLS_SECRET_MAP, EMAIL_SENDER, EMAIL_SENDER_PASSWOORD,
-    DFS_HOST_DIR_MAP,
+    BOT_WEBHOOK_URL, LOGGER_NAME, DEBUG, DEFAULT_REGISTRY, JOBS_LOG_ROOT_DIR, JOB_LOG_COMPRESS,
+    REPO_DATA_DIR, TLS_SECRET_MAP, EMAIL_SENDER, DFS_HOST_DIR_MAP, BUILD_PARALLELISM,
 )
 from console.libs.jsonutils import VersatileEncoder
+from console.libs.joblog import LineIndex, GzipMembersWriter, get_log_index_path
 
 
 logger = logging.getLogger(LOGGER_NAME)
@@ -91,8 +87,7 @@ def send_get_json_request(url, headers=None):
     return res.getcode(), data
 
 
-def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SENDER_PASSWOORD,
-               files=None, server="smtp.exmail.qq.com"):
+def make_email(receivers, subject, text, sender=EMAIL_SENDER, files=None):
     msg = MIMEMultipart()
     msg['Subject'] = subject
     msg['From'] = sender
@@ -107,21 +102,13 @@ def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SEN
 
             part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(fname))
             msg.attach(part)
-
-    logger.info("sending email..")
-    try:
-        s = smtplib.SMTP(server)
-        s.login(sender, password)
-        s.sendmail(sender, receivers, msg.as_string())
-        s.close()
-        logger.info("Sent email successfully")
-        return True
-    except SMTPException as e:
-        logger.warning("Error: unable to send email %s" % str(e))
-        return False
+    return msg
 
 
-def bearychat_sendmsg(to, content):
+def post_bearychat_msg(to, content):
+    """
+    :raise: the error of the request
+    """
     if not all([to, content, BOT_WEBHOOK_URL]):
         return
     to = to.strip(';')
@@ -136,12 +123,8 @@ def bearychat_sendmsg(to, content):
     headers = {
         'Connection': 'close',
     }
-    try:
-        code, res = send_post_json_request(BOT_WEBHOOK_URL, data, headers)
-        return res
-    except:
-        logger.exception('Send bearychat msg failed')
-        return
+    code, res = send_post_json_request(BOT_WEBHOOK_URL, data, headers)
+    return res
 
 
 def make_shell_env(env_content):
@@ -242,20 +225,51 @@ def get_job_log_versions(job_name):
         os.makedirs(log_dir)
     versions = []
     for filename in os.listdir(log_dir):
-        group = re.match(r'log\.(?P<id>\d+)\.txt', filename)
+        group = re.match(r'log\.(?P<id>\d+)\.txt(\.gz)?$', filename)
         if group:
             versions.append(int(group.group('id')))
     return sorted(versions)
 
 
-def save_job_log(job_name, resp, version):
-    log_dir = os.path.join(JOBS_LOG_ROOT_DIR, job_name)
+def save_job_log(job_name, resp, version, compress=JOB_LOG_COMPRESS, root_dir=JOBS_LOG_ROOT_DIR):
+    """
+    write the job log to `JOBS_LOG_ROOT_DIR/<job>/log.<version>.txt`(with `.gz` suffix if compressed).
+    the log is written to a temporary file first, so a partial log is never visible.
+    the line index(`log.<version>.idx`) used by the ranged reads is built at the same time.
+    :param resp: the whole log(str or bytes) or an iterable of chunks
+    :param compress: compress the log with gzip, in members starting at the indexed lines
+    :return: number of bytes of the log(before compression)
+    """
+    log_dir = os.path.join(root_dir, job_name)
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
     log_path = os.path.join(log_dir, 'log.{}.txt'.format(version))
+    if compress:
+        log_path += '.gz'
+    tmp_path = '{}.{}.tmp'.format(log_path, os.getpid())
 
-    with open(log_path, 'w') as f:
-        f.write(resp)
+    if isinstance(resp, (str, bytes)):
+        resp = [resp]
+    index = LineIndex()
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = GzipMembersWriter(f, index) if compress else None
+            for chunk in resp:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf8')
+                if writer is not None:
+                    writer.write(chunk)
+                else:
+                    f.write(chunk)
+                    index.feed(chunk)
+            if writer is not None:
+                writer.close()
+        os.rename(tmp_path, log_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    index.dump(get_log_index_path(log_path))
+    return index.size
 
 
 def make_app_watcher_channel_name(cluster, appname):
@@ -270,7 +284,7 @@ def make_errmsg(msg, jsonize=False):
         return data
 
 
-def make_msg(phase, raw_data=None, success=True, error=None, msg=None, progress=None, jsonize=False):
+def make_msg(phase, raw_data=None, success=True, error=None, msg=None, progress=None, jsonize=False, image=None):
     d = {
         "success": success,
         "phase": phase,
@@ -279,6 +293,8 @@ def make_msg(phase, raw_data=None, success=True, error=None, msg=None, progress=
         'msg': msg,
         'error': error,
     }
+    if image is not None:
+        d['image'] = image
     if jsonize:
         return json.dumps(d) + '\n'
     else:
@@ -304,56 +320,274 @@ def build_image_helper(appname, release):
         yield make_msg("Finished", msg="already built")
         return
 
-    # clone code
+    from console.libs.cloner import GitError
+    from console.libs.gitmirror import GitMirror, evict_mirrors
+    from console.libs.buildcontext import evict_build_contexts
+
+    mirror = GitMirror(release.git)
+    try:
+        for line in mirror.fetch():
+            yield make_msg("Cloning", msg=line)
+        commit = mirror.resolve(git_tag)
+    except GitError as e:
+        raise BuildError(make_msg("Cloning", success=False, error="git fetch error: {}".format(str(e))))
+    try:
+        evict_mirrors(keep=release.git)
+    except Exception:
+        logger.exception("error when evict git mirrors")
+
     repo_dir = os.path.join(REPO_DATA_DIR, appname)
-    shutil.rmtree(repo_dir, ignore_errors=True)
-    p = Popen(['git',  'clone',  '--recursive', '--progress', release.git, repo_dir], stdout=PIPE,
-              stderr=STDOUT, env=os.environ.copy())
-
-    for line in iter(p.stdout.readline, ""):
-        if not line:
-            break
-        if isinstance(line, bytes):
-            line = line.decode('utf8')
-        line = line.strip(" \n")
-        yield make_msg("Cloning", msg=line)
-    p.wait()
-    if p.returncode:
-        raise BuildError(make_msg("Cloning", success=False, error="git clone error: {}".format(p.returncode)))
+    plan = _plan_builds(appname, release, commit, repo_dir)
+    # the code is only needed when some images are not built yet and their contexts are not cached
+    need_checkout = any(item['reuse'] is None and not item['context'].cached for item in plan)
+    if need_checkout:
+        try:
+            for line in mirror.add_worktree(commit, repo_dir):
+                yield make_msg("Cloning", msg=line)
+        except GitError as e:
+            raise BuildError(make_msg("Checkout", success=False, error="checkout tag error: {}".format(str(e))))
+
+    try:
+        yield from _build_and_push(appname, release, commit, repo_dir, plan)
+    finally:
+        if need_checkout:
+            mirror.remove_worktree(repo_dir)
+        try:
+            evict_build_contexts()
+        except Exception:
+            logger.exception("error when evict build contexts")
+
+
+DOCKER_BASE_URL = "unix:///var/run/docker.sock"
+
+
+def _get_cache_images(appname, release):
+    """
+    :return: build name -> image of the previous built release, used as the cache of the build
+    """
+    previous = release.get_previous_built_version()
+    if previous is None:
+        return {}
+    try:
+        builds = previous.specs.builds
+    except Exception:
+        # the specs of an old release may be invalid now
+        return {}
+    return {
+        build.name: "{}:{}".format(construct_full_image_name(build.name, appname), build.tag or previous.tag)
+        for build in builds
+    }
 
+
+def _image_exists(client, image):
+    try:
+        client.inspect_image(image)
+        return True
+    except docker.errors.NotFound:
+        pass
     try:
-        run(
-            "git checkout {}".format(git_tag), shell=True,
-            check=True, cwd=repo_dir, stdout=PIPE, stderr=STDOUT,
-            universal_newlines=True,
-        )
-    except CalledProcessError as e:
-        raise BuildError(make_msg("Checkout", success=False, error="checkout tag error: {}".format(str(e))))
-
-    client = docker.APIClient(base_url="unix:///var/run/docker.sock")
-    for build in specs.builds:
+        client.inspect_distribution(image)
+        return True
+    except docker.errors.APIError:
+        return False
+
+
+def _plan_builds(appname, release, commit, repo_dir):
+    """
+    :return: a list of dict for every build of the release, `reuse` is the image built
+             from the same commit, dockerfile and build args, None if it must be built.
+    """
+    from console.models import BuildCache
+    from console.libs.buildcontext import BuildContext
+
+    client = docker.APIClient(base_url=DOCKER_BASE_URL)
+    cache_images = _get_cache_images(appname, release)
+    plan = []
+    for build in release.specs.builds:
         image_name_no_tag = construct_full_image_name(build.name, appname)
         image_tag = build.tag if build.tag else release.tag
-        dockerfile = build.dockerfile
-        if dockerfile is None:
-            dockerfile = os.path.join(repo_dir, "Dockerfile")
-        full_image_name = "{}:{}".format(image_name_no_tag, image_tag)
+        dockerfile = build.dockerfile or "Dockerfile"
+        buildargs = getattr(build, 'args', None)
+        cache_key = BuildCache.make_cache_key(commit, dockerfile, buildargs)
+        cached = BuildCache.get_by_key(cache_key)
+        reuse = None
+        if cached is not None:
+            if _image_exists(client, cached.image_ref):
+                reuse = cached.image_ref
+            else:
+                # the image is removed from the registry
+                cached.delete()
+        plan.append({
+            'image': "{}:{}".format(image_name_no_tag, image_tag),
+            'dockerfile': dockerfile,
+            'context': BuildContext(commit, dockerfile),
+            'buildargs': buildargs,
+            'cache_image': cache_images.get(build.name),
+            'cache_key': cache_key,
+            'reuse': reuse,
+        })
+    return plan
+
+
+def _retag_image(source, image):
+    """
+    tag the image built before(pull it if it's not in local) as `image`
+    """
+    client = docker.APIClient(base_url=DOCKER_BASE_URL)
+    yield make_msg("Building", msg="reuse image {} built from the same commit".format(source), image=image)
+    try:
+        try:
+            client.inspect_image(source)
+        except docker.errors.NotFound:
+            for line in client.pull(source, stream=True):
+                output_dict = json.loads(line.decode('utf8'))
+                if 'error' in output_dict:
+                    raise BuildError(make_msg("Building", success=False, error="pull error: {}".format(output_dict['error']), image=image))
+        repository, tag = image.rsplit(':', 1)
+        client.tag(source, repository, tag, force=True)
+    except docker.errors.APIError as e:
+        raise BuildError(make_msg("Building", success=False, error="tag error: {}".format(str(e)), image=image))
 
-        # use docker to build image
+
+def _build_image(repo_dir, context, image, cache_image=None, buildargs=None):
+    """
+    :param context: the `BuildContext`, it's created from `repo_dir` if it's not cached
+    :param buildargs: the build args of the build spec, they are part of the build cache key
+    """
+    client = docker.APIClient(base_url=DOCKER_BASE_URL)
+    cache_from = None
+    if cache_image:
+        # the cache image must be in local
         try:
-            for line in client.build(path=repo_dir, dockerfile=dockerfile, tag=full_image_name):
+            client.inspect_image(cache_image)
+            cache_from = [cache_image]
+        except docker.errors.NotFound:
+            yield make_msg("Building", msg="pulling cache image {}".format(cache_image), image=image)
+            try:
+                for _ in client.pull(cache_image, stream=True):
+                    pass
+                cache_from = [cache_image]
+            except docker.errors.APIError as e:
+                logger.warn("can't pull cache image {}: {}".format(cache_image, str(e)))
+
+    try:
+        if context.cached:
+            yield make_msg("Building", msg="reuse the build context of the same commit", image=image)
+        else:
+            context.create(repo_dir)
+        f = context.open()
+    except (OSError, ValueError) as e:
+        raise BuildError(make_msg("Building", success=False, error="build context error: {}".format(str(e)), image=image))
+
+    try:
+        # the context is streamed from the file
+        with f:
+            for line in client.build(fileobj=f, custom_context=True, dockerfile=context.dockerfile, tag=image,
+                                     cache_from=cache_from, buildargs=buildargs):
                 output_dict = json.loads(line.decode('utf8'))
                 if 'stream' in output_dict:
-                    yield make_msg("Building", raw_data=output_dict, msg=output_dict['stream'].rstrip("\n"))
-        except docker.errors.APIError as e:
-            raise BuildError(make_msg("Building", success=False, error="Building error: {}".format(str(e))))
+                    yield make_msg("Building", raw_data=output_dict, msg=output_dict['stream'].rstrip("\n"), image=image)
+                elif 'error' in output_dict:
+                    raise BuildError(make_msg("Building", success=False, error="Building error: {}".format(output_dict['error']), image=image))
+    except docker.errors.APIError as e:
+        raise BuildError(make_msg("Building", success=False, error="Building error: {}".format(str(e)), image=image))
+
+
+def _push_image(image):
+    """
+    :return: digest of the pushed image
+    """
+    client = docker.APIClient(base_url=DOCKER_BASE_URL)
+    digest = None
+    try:
+        for line in client.push(image, stream=True):
+            output_dict = json.loads(line.decode('utf8'))
+            if 'error' in output_dict:
+                raise BuildError(make_msg("Pushing", success=False, error="pushing error: {}".format(output_dict['error']), image=image))
+            if 'aux' in output_dict:
+                digest = output_dict['aux'].get('Digest')
+            msg = "{}:{}\n".format(output_dict.get('id'), output_dict.get('status'))
+            yield make_msg("Pushing", raw_data=output_dict, msg=msg.rstrip("\n"), image=image)
+    except docker.errors.APIError as e:
+        raise BuildError(make_msg("Pushing", success=False, error="pushing error: {}".format(str(e)), image=image))
+    return digest
+
+
+def _build_and_push(appname, release, commit, repo_dir, plan):
+    """
+    build the images of the release with `BUILD_PARALLELISM` threads, every image is pushed
+    in another thread pool after it's built, so pushing overlaps with building the next images.
+    the images built from the same commit before are retagged instead.
+    the messages of all the images are yielded in the order they are produced.
+    """
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from console.models import BuildCache
+
+    messages = queue.Queue()
+    stop = threading.Event()
+    # (done, item, digest) is put into `messages` when an image is pushed
+    done = object()
+
+    def run_stage(gen):
+        """
+        :return: (success, return value of the stage)
+        """
         try:
-            for line in client.push(full_image_name, stream=True):
-                output_dict = json.loads(line.decode('utf8'))
-                msg = "{}:{}\n".format(output_dict.get('id'), output_dict.get('status'))
-                yield make_msg("Pushing", raw_data=output_dict, msg=msg.rstrip("\n"))
-        except docker.errors.APIError as e:
-            raise BuildError(make_msg("Pushing", success=False, error="pushing error: {}".format(str(e))))
-        logger.debug("=========", full_image_name)
-    yield make_msg("Finished", msg="build app {}'s release {} successfully".format(appname, git_tag))
+            while True:
+                try:
+                    msg = next(gen)
+                except StopIteration as e:
+                    return True, e.value
+                if stop.is_set():
+                    return False, None
+                messages.put(msg)
+        except BuildError as e:
+            messages.put(e)
+        except Exception as e:
+            logger.exception("error when build app {}".format(appname))
+            messages.put(BuildError(make_msg("Building", success=False, error="Building error: {}".format(str(e)))))
+        return False, None
+
+    def push(item):
+        ok, digest = run_stage(_push_image(item['image']))
+        if ok:
+            messages.put((done, item, digest))
+
+    def build_and_push(item):
+        if item['reuse']:
+            gen = _retag_image(item['reuse'], item['image'])
+        else:
+            gen = _build_image(repo_dir, item['context'], item['image'], item['cache_image'], item['buildargs'])
+        ok, _ = run_stage(gen)
+        if ok and not stop.is_set():
+            push_pool.submit(push, item)
+
+    build_pool = ThreadPoolExecutor(max_workers=BUILD_PARALLELISM)
+    push_pool = ThreadPoolExecutor(max_workers=BUILD_PARALLELISM)
+    try:
+        for item in plan:
+            build_pool.submit(build_and_push, item)
+
+        remaining = len(plan)
+        while remaining:
+            msg = messages.get()
+            if isinstance(msg, BuildError):
+                raise msg
+            if isinstance(msg, tuple) and msg[0] is done:
+                remaining -= 1
+                _, item, digest = msg
+                # the database is only accessed in this thread(it has the app context)
+                # the image can't be reused without the digest
+                if item['reuse'] is None and digest:
+                    BuildCache.record(item['cache_key'], commit, item['image'], digest)
+                continue
+            yield msg
+    finally:
+        # stop the running builds and pushes(when error or timeout)
+        stop.set()
+        build_pool.shutdown(wait=False)
+        push_pool.shutdown(wait=False)
+    yield make_msg("Finished", msg="build app {}'s release {} successfully".format(appname, release.tag))
 
@@ -2,22 +2,32 @@
 import re
 import numbers
 from humanfriendly import parse_size, InvalidSize
-from marshmallow import validates_schema, ValidationError, fields
+from marshmallow import validates_schema, ValidationError, fields, validate
 from numbers import Number
 
-from console.libs.k8s import KubeApi
-
 from kaelib.spec import (
     StrictSchema, validate_cpu, validate_memory, validate_appname, validate_jobname,
     validate_app_type, validate_tag,
 )
 
+from console.config import DEPLOY_ROLLOUT_TIMEOUT
+
 
 def validate_positive_integer(i):
     if i <= 0:
         raise ValidationError("Need a positive integer")
 
 
+def validate_non_negative_integer(i):
+    if i < 0:
+        raise ValidationError("Need a non-negative integer")
+
+
+def validate_stream_id(s):
+    if re.match(r'^\d+-\d+$', s) is None:
+        raise ValidationError("invalid stream entry id")
+
+
 def validate_weight(i):
     if i <= 0 or i > 100:
         raise ValidationError("invalid percent value")
@@ -153,6 +163,8 @@ def validate_cpu_dict(dd):
 
 
 def validate_cluster_name(cluster):
+    # import lazily, so importing the schemas doesn't load kubernetes clients
+    from console.libs.k8s import KubeApi
     if KubeApi.instance().cluster_exist(cluster) is False:
         raise ValidationError("cluster {} not exists".format(cluster))
 
@@ -214,6 +226,25 @@ class DeploySchema(StrictSchema):
     debug = fields.Bool(missing=False)
 
 
+class BatchDeployItemSchema(DeploySchema):
+    appname = fields.Str(required=True, validate=validate_appname)
+
+
+class BatchDeploySchema(StrictSchema):
+    # the nested schema is applied to every item, StrictSchema can't check unknown fields of a list
+    items = fields.List(fields.Nested(BatchDeployItemSchema), required=True)
+
+    @validates_schema
+    def further_check(self, data):
+        items = data.get('items', [])
+        if not items:
+            raise ValidationError("items can't be empty")
+        # the schema validators still run when some items are invalid
+        keys = [(item.get('appname'), item.get('cluster')) for item in items if isinstance(item, dict)]
+        if len(set(keys)) != len(keys):
+            raise ValidationError("an app can only be deployed to a cluster once in a batch")
+
+
 class ScaleSchema(StrictSchema):
     cluster = fields.Str(required=True, validate=validate_cluster_name)
     cpus = fields.Dict(validate=validate_cpu_dict)
@@ -234,6 +265,11 @@ class ScaleSchema(StrictSchema):
 class BuildArgsSchema(StrictSchema):
     tag = fields.Str(required=True)
     block = fields.Bool(missing=False)  # whether block when there exist other build task for this app
+    last_id = fields.Str(validate=validate_stream_id)  # the `output_id` of the last message received, used to resume the output of the running build task
+
+
+class JobRestartArgsSchema(StrictSchema):
+    task_id = fields.Str(required=True)  # the `task_id` returned by the restart api
 
 
 class ClusterArgSchema(StrictSchema):
@@ -253,6 +289,11 @@ class ClusterCanarySchema(StrictSchema):
     canary = fields.Bool(missing=False)
 
 
+class RolloutArgsSchema(ClusterCanarySchema):
+    # the request holds a worker while waiting, so it can't wait longer than the default
+    timeout = fields.Int(validate=validate.Range(min=1, max=DEPLOY_ROLLOUT_TIMEOUT))
+
+
 class AppCanaryWeightArgSchema(StrictSchema):
     cluster = fields.Str(required=True, validate=validate_cluster_name)
     weight = fields.Int(required=True, validate=validate_weight)
@@ -317,6 +358,11 @@ class JobArgsSchema(StrictSchema):
                     raise ValidationError("{} is required when specs_text is null".format(field))
 
 
+class JobLogArgsSchema(StrictSchema):
+    version = fields.Int(validate=validate_non_negative_integer)
+    tail = fields.Int(validate=validate_positive_integer)
+
+
 class PodEntryArgsSchema(StrictSchema):
     podname = fields.Str(required=True)
     cluster = fields.Str(required=True)
@@ -326,10 +372,13 @@ class PodEntryArgsSchema(StrictSchema):
 
 cluster_args_schema = ClusterArgSchema()
 cluster_canary_schema = ClusterCanarySchema()
+rollout_args_schema = RolloutArgsSchema()
 register_schema = RegisterSchema()
 deploy_schema = DeploySchema()
+batch_deploy_schema = BatchDeploySchema()
 scale_schema = ScaleSchema()
 build_args_schema = BuildArgsSchema()
+job_restart_args_schema = JobRestartArgsSchema()
 secret_schema = SecretArgsSchema()
 config_map_schema = ConfigMapArgsSchema()
 page_args_schema = PaginationSchema()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+the pods watcher can run multiple replicas, the shards(clusters, or (cluster, pod type) pairs)
+are split among the replicas with leases stored in redis.
+"""
+
+import json
+import time
+
+from console.ext import rds
+from console.config import WATCHER_SHARD_BY_TYPE
+
+WATCHER_REPLICAS_KEY = "kae-watcher-replicas"
+WATCHER_STATUS_KEY = "kae-watcher-status"
+POD_TYPES = ('app', 'job')
+
+
+def make_watcher_shards(cluster_names, by_type=WATCHER_SHARD_BY_TYPE):
+    """
+    :return: shard id -> (cluster name, label selector of the pods)
+    """
+    shards = {}
+    for cluster in cluster_names:
+        if by_type:
+            for pod_type in POD_TYPES:
+                shards["{}:{}".format(cluster, pod_type)] = (cluster, "kae-type={}".format(pod_type))
+        else:
+            shards[cluster] = (cluster, "kae-type in ({})".format(", ".join(POD_TYPES)))
+    return shards
+
+
+def make_shard_lease_key(shard_id):
+    return "kae-watcher-shard-{}-lease".format(shard_id)
+
+
+class ShardLease(object):
+    """
+    a lease of a shard owned by a watcher replica, it must be renewed before `ttl` seconds passed,
+    otherwise other replicas can take it over.
+    """
+    _RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+    _RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+    def __init__(self, shard_id, owner, ttl):
+        self.shard_id = shard_id
+        self.owner = owner
+        self.ttl = ttl
+        self.key = make_shard_lease_key(shard_id)
+
+    def acquire(self):
+        return bool(rds.set(self.key, self.owner, nx=True, px=int(self.ttl * 1000)))
+
+    def renew(self):
+        return rds.eval(self._RENEW_SCRIPT, 1, self.key, self.owner, int(self.ttl * 1000)) == 1
+
+    def release(self):
+        rds.eval(self._RELEASE_SCRIPT, 1, self.key, self.owner)
+
+
+def report_replica_status(replica_id, status, ttl):
+    """
+    heartbeat of a watcher replica, the replica is considered dead if it doesn't report in `ttl` seconds.
+    :return: number of alive replicas
+    """
+    now = time.time()
+    status['updated'] = now
+    pipe = rds.pipeline(transaction=False)
+    pipe.zadd(WATCHER_REPLICAS_KEY, now, replica_id)
+    pipe.zremrangebyscore(WATCHER_REPLICAS_KEY, '-inf', now - ttl)
+    pipe.hset(WATCHER_STATUS_KEY, replica_id, json.dumps(status))
+    pipe.zcard(WATCHER_REPLICAS_KEY)
+    return pipe.execute()[-1]
+
+
+def remove_replica(replica_id):
+    pipe = rds.pipeline(transaction=False)
+    pipe.zrem(WATCHER_REPLICAS_KEY, replica_id)
+    pipe.hdel(WATCHER_STATUS_KEY, replica_id)
+    pipe.execute()
+
+
+def get_watcher_status(shard_ids):
+    """
+    :param shard_ids: all the shards should be watched
+    :return: the alive replicas with their shards and events/sec, and the owner of every shard
+    """
+    alive = set(r.decode('utf8') if isinstance(r, bytes) else r for r in rds.zrange(WATCHER_REPLICAS_KEY, 0, -1))
+    replicas = {}
+    stale = []
+    for replica_id, content in rds.hgetall(WATCHER_STATUS_KEY).items():
+        if isinstance(replica_id, bytes):
+            replica_id = replica_id.decode('utf8')
+        if replica_id not in alive:
+            stale.append(replica_id)
+            continue
+        replicas[replica_id] = json.loads(content)
+    if stale:
+        rds.hdel(WATCHER_STATUS_KEY, *stale)
+
+    owners = rds.mget([make_shard_lease_key(shard_id) for shard_id in shard_ids]) if shard_ids else []
+    shards = {}
+    for shard_id, owner in zip(shard_ids, owners):
+        shards[shard_id] = owner.decode('utf8') if isinstance(owner, bytes) else owner
+    return {
+        'replicas': replicas,
+        'shards': shards,
+    }
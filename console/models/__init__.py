@@ -1,13 +1,13 @@
 # coding: utf-8
 
 from .user import User, get_current_user
-from .app import App, Release, SpecVersion, AppYaml
+from .app import App, Release, SpecVersion, AppYaml, BuildCache
 from .oplog import OPLog, OPType
 from .job import Job
 
 
 __all__ = [
-    'User', 'App', 'Release', 'SpecVersion', 'AppYaml',
+    'User', 'App', 'Release', 'SpecVersion', 'AppYaml', 'BuildCache',
     'OPLog', 'OPType',
     'Job',
     'get_current_user',
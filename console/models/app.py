@@ -2,6 +2,7 @@
 
 import json
 import yaml
+import hashlib
 from addict import Dict
 from sqlalchemy import event, DDL
 from sqlalchemy.exc import IntegrityError
@@ -168,6 +169,11 @@ class Release(BaseModelMixin):
         else:
             return q_set[n]
 
+    def get_previous_built_version(self):
+        return Release.query.filter(
+            Release.app_id == self.app_id, Release.id < self.id, Release.build_status == True,
+        ).order_by(Release.id.desc()).first()
+
     @classmethod
     def get(cls, id):
         r = super(Release, cls).get(id)
@@ -243,6 +249,51 @@ class Release(BaseModelMixin):
             db.session.rollback()
 
 
+class BuildCache(BaseModelMixin):
+    """
+    the images built from the same commit, dockerfile and build args are the same,
+    so the image is retagged and pushed instead of building again.
+    """
+    cache_key = db.Column(db.CHAR(64), nullable=False, unique=True)
+    commit = db.Column(db.CHAR(40), nullable=False, index=True)
+    # full image name with tag
+    image = db.Column(db.CHAR(255), nullable=False)
+    digest = db.Column(db.CHAR(128), nullable=False, default='')
+
+    def __str__(self):
+        return '<BuildCache {}: {}>'.format(self.commit, self.image)
+
+    @staticmethod
+    def make_cache_key(commit, dockerfile, args=None):
+        """
+        :param dockerfile: path of the dockerfile in the repo
+        """
+        s = json.dumps([commit, dockerfile, args or {}], sort_keys=True)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_by_key(cls, cache_key):
+        return cls.query.filter_by(cache_key=cache_key).first()
+
+    @classmethod
+    def record(cls, cache_key, commit, image, digest=''):
+        try:
+            return cls.create(cache_key=cache_key, commit=commit, image=image, digest=digest or '')
+        except IntegrityError:
+            # the same commit is built by another build at the same time
+            db.session.rollback()
+            return cls.get_by_key(cache_key)
+
+    @property
+    def image_ref(self):
+        """
+        reference of the image by digest, so it's the same image even if the tag is overwritten
+        """
+        if not self.digest:
+            return self.image
+        return '{}@{}'.format(self.image.rsplit(':', 1)[0], self.digest)
+
+
 class AppYaml(BaseModelMixin):
     __table_args__ = (
         db.UniqueConstraint('app_id', 'name'),
@@ -76,6 +76,9 @@ class Job(BaseModelMixin):
 
     def inc_version(self):
         self.version += 1
+        # the status is reported per version, the new version may end with the same status
+        # as the old one, and its log must be saved as well
+        self.status = ''
         try:
             db.session.add(self)
             db.session.commit()
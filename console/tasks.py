@@ -1,112 +1,149 @@
 # -*- coding: utf-8 -*-
+import time
+
 from celery import current_app
 from celery.exceptions import SoftTimeLimitExceeded
 
-from console.config import TASK_PUBSUB_CHANNEL, APP_BUILD_TIMEOUT
-from console.ext import rds, db
-from console.libs.utils import logger, save_job_log, BuildError, build_image_helper, make_errmsg
+from console.config import (
+    APP_BUILD_TIMEOUT, BUILD_SLOT_RETRY_DELAY, DEFAULT_JOB_NS, JOB_LOG_CHUNK_SIZE, NOTIFY_MAX_RETRIES, NOTIFY_RETRY_DELAY,
+    JOB_DELETE_TIMEOUT, JOB_DELETE_WAIT_INTERVAL,
+    EMAIL_SMTP_SERVER, EMAIL_SENDER, EMAIL_SENDER_PASSWOORD,
+)
+from console.ext import db
+from console.libs.utils import logger, save_job_log, BuildError, build_image_helper, make_errmsg, make_msg
 from console.libs.k8s import KubeApi, ApiException
+from console.libs.reconciler import job_pod_status
 from console.models import Release, Job
 
 
-@current_app.task(bind=True, soft_time_limit=APP_BUILD_TIMEOUT)
-def build_image(self, appname, git_tag):
+@current_app.task(bind=True, soft_time_limit=APP_BUILD_TIMEOUT, max_retries=None)
+def build_image(self):
+    """
+    a token to run the next build in the build queue(see `console.libs.buildqueue`),
+    the output of the build is streamed with the build id.
+    """
+    from console.libs.buildqueue import (
+        acquire_builder_slot, release_builder_slot, pop_build, mark_build_running, unmark_build_running,
+    )
+    from console.libs.taskoutput import finish_task_output
+
+    if not acquire_builder_slot(self.request.id):
+        # the builder host is busy, the token may be taken by another host
+        raise self.retry(countdown=BUILD_SLOT_RETRY_DELAY)
+    try:
+        build = pop_build()
+        if build is None:
+            # the build is cancelled before started
+            return
+        build_id, info = build
+        mark_build_running(build_id, self.request.id)
+        try:
+            _build_release(self, build_id, info['appname'], info['tag'])
+        finally:
+            unmark_build_running(build_id)
+            finish_task_output(build_id)
+    finally:
+        release_builder_slot(self.request.id)
+
+
+def _build_release(task, build_id, appname, git_tag):
     release = Release.get_by_app_and_tag(appname, git_tag)
     try:
         for msg in build_image_helper(appname, release):
-            self.stream_output(msg)
+            task.stream_output(msg, task_id=build_id)
     except BuildError as e:
-        self.stream_output(e.data)
+        task.stream_output(e.data, task_id=build_id)
     except SoftTimeLimitExceeded:
         logger.warn("build timeout.")
-        self.stream_output(make_errmsg('build timeout, please test in local environment and contact administrator'))
+        task.stream_output(make_errmsg('build timeout, please test in local environment and contact administrator'), task_id=build_id)
 
 
-@current_app.task
-def handle_job_pod_event(jobname, obj):
+@current_app.task(bind=True, max_retries=None)
+def restart_job(self, jobname, deadline=None):
+    """
+    :param deadline: the time the old job must be deleted before, set when the task is retried
+    """
     job = Job.get_by_name(jobname)
     if not job:
+        self.stream_output(make_errmsg("job {} not found".format(jobname)))
         return
-    state = {}
-    job_update = {}
-    status = (None, None)
-    if 'containerStatuses' in obj['status']:
-        state = obj['status']['containerStatuses'][0]['state']
-        for k, v in state.items():
-            status = (k, v.get('reason', None))
-            status_str = '{}: {}'.format(*status)
-            continue
-        job_update['state'] = state
-    elif obj['status']['phase'] == 'Pending':
-        job.update_status("Pending")
+    specs = job.specs
+    # the task may wait long time, don't hold the db connection
+    db.session.remove()
+
+    if deadline is None:
+        self.stream_output(make_msg("Deleting", msg="deleting old job {}".format(jobname)))
+        KubeApi.instance().delete_job(jobname, ignore_404=True, namespace=DEFAULT_JOB_NS)
+        deadline = time.time() + JOB_DELETE_TIMEOUT
+    # wait for the deletion a while in each run, so the worker isn't held by a slow deletion
+    timeout = max(min(deadline - time.time(), JOB_DELETE_WAIT_INTERVAL), 1)
+    if not KubeApi.instance().wait_job_deleted(jobname, namespace=DEFAULT_JOB_NS, timeout=timeout):
+        if time.time() < deadline:
+            raise self.retry(args=(jobname,), kwargs={'deadline': deadline}, countdown=0)
+        self.stream_output(make_errmsg("timeout when wait old job {} to be deleted".format(jobname)))
         return
-    else:
-        status_str = '{}: {}'.format(obj['status']['phase'], obj['status']['reason'])
 
-    pod_name = obj['metadata']['name']
+    self.stream_output(make_msg("Creating", msg="creating job {}".format(jobname)))
+    KubeApi.instance().create_job(specs, namespace=DEFAULT_JOB_NS)
+    self.stream_output(make_msg("Finished", msg="job {} restarted".format(jobname)))
 
-    # update status
-    if status == ('terminated', 'Completed'):
-        job_update['status'] = 'Completed'
-    elif status == ('running', None):
-        job_update['status'] = 'Running'
-    else:
-        job_update['status'] = status_str
 
-    job.update_status(job_update['status'])
+@current_app.task
+def handle_job_pod_event(jobname, obj):
+    job = Job.get_by_name(jobname)
+    if not job:
+        return
+    status, terminated = job_pod_status(obj)
+    if job.status == status:
+        # the event is replayed(e.g. the watcher relisted the pods after restart), the log was saved.
+        # the status is reset when the job is restarted, so it's the status of the current version
+        return
+    job.update_status(status)
 
     # When a job is successful finished, save log
-    if status[0] == 'terminated':
-        save_pod_log(jobname, pod_name, job.version)
+    if terminated:
+        save_pod_log(jobname, obj['metadata']['name'], job.version)
 
 
 @current_app.task
 def save_pod_log(jobname, podname, version=0):
+    chunks = KubeApi.instance().stream_pod_log(podname=podname, namespace=DEFAULT_JOB_NS, chunk_size=JOB_LOG_CHUNK_SIZE)
     try:
-        resp = KubeApi.instance().get_pod_log(podname=podname)
+        save_job_log(job_name=jobname, resp=chunks, version=version)
     except ApiException as e:
         if e.status == 404:
             return
         else:
             raise e
-    try:
-        save_job_log(job_name=jobname, resp=resp, version=version)
     except:
         logger.exception("Error when get pod log")
 
 
-def celery_task_stream_response(celery_task_ids, timeout=0, exit_when_timeout=True):
-    if isinstance(celery_task_ids, str):
-        celery_task_ids = celery_task_ids,
+@current_app.task(bind=True, max_retries=NOTIFY_MAX_RETRIES)
+def send_notifications(self, kind, recipient):
+    """
+    send all the notifications queued for the recipient in one message(see `console.libs.notify`)
+    """
+    from console.libs.notify import (
+        NOTIFY_EMAIL, pop_notifications, requeue_notifications, merge_emails, merge_bearychat_msgs, get_smtp_pool,
+    )
+    from console.libs.utils import make_email, post_bearychat_msg
 
-    task_progress_channels = [TASK_PUBSUB_CHANNEL.format(task_id=id_) for id_ in celery_task_ids]
-    pubsub = rds.pubsub()
-    pubsub.subscribe(task_progress_channels)
+    items = pop_notifications(kind, recipient)
+    if not items:
+        return
     try:
-        while pubsub.subscribed:
-            resp = pubsub.get_message(timeout=timeout)
-            if resp is None:
-                if exit_when_timeout:
-                    logger.warn("pubsub timeout {}".format(celery_task_ids))
-                    return None
-                continue
-            raw_content = resp['data']
-            # omit the initial message where item['data'] is 1L
-            if not isinstance(raw_content, (bytes, str)):
-                continue
-            content = raw_content
-            if isinstance(content, bytes):
-                content = content.decode('utf-8')
-            logger.debug('Got pubsub message: %s', content)
-            # task will publish TASK_PUBSUB_EOF at success or failure
-            if content.startswith('CELERY_TASK_DONE'):
-                finished_task_id = content[content.find(':') + 1:]
-                finished_task_channel = TASK_PUBSUB_CHANNEL.format(task_id=finished_task_id)
-                logger.debug('Task %s finished, break celery_task_stream_response', finished_task_id)
-                pubsub.unsubscribe(finished_task_channel)
-            else:
-                yield content
-    finally:
-        logger.debug("celery stream response exit ************")
-        pubsub.unsubscribe()
-        pubsub.close()
+        if kind == NOTIFY_EMAIL:
+            subject, text = merge_emails(items)
+            msg = make_email([recipient], subject, text)
+            get_smtp_pool(EMAIL_SMTP_SERVER, EMAIL_SENDER, EMAIL_SENDER_PASSWOORD).sendmail([recipient], msg)
+        else:
+            post_bearychat_msg(recipient, merge_bearychat_msgs(items))
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            logger.exception("drop {} notifications to {}".format(len(items), recipient))
+            return
+        logger.warn("error when send notifications to {}, retry later: {}".format(recipient, str(e)))
+        # the notifications queued during the retry delay are sent with them
+        requeue_notifications(kind, recipient, items)
+        raise self.retry(countdown=NOTIFY_RETRY_DELAY * 2 ** self.request.retries)
@@ -59,6 +59,15 @@ def test_db(request, app):
     request.addfinalizer(teardown)
 
 
+@pytest.fixture
+def test_rds(request, app):
+    u = urlparse(app.config['REDIS_URL'])
+    if u.hostname not in ('localhost', '127.0.0.1'):
+        raise Exception('Need to run test on localhost or in container')
+
+    request.addfinalizer(rds.flushdb)
+
+
 # @pytest.fixture(scope='session')
 # def test_app_image():
 #     if not core_online:
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import tarfile
+
+from console.libs.buildcontext import BuildContext, evict_build_contexts
+
+
+def _make_repo(tmpdir):
+    repo = tmpdir.mkdir('repo')
+    repo.join('Dockerfile').write('FROM scratch\n')
+    repo.join('.dockerignore').write('# comment\nDockerfile\n*.log\n')
+    repo.join('.git').write('gitdir: /tmp/mirror.git/worktrees/repo\n')
+    repo.join('app.py').write('print(1)\n')
+    repo.join('debug.log').write('log\n')
+    sub = repo.mkdir('lib')
+    sub.join('.git').write('gitdir: ../.git/modules/lib\n')
+    sub.join('lib.py').write('')
+    return str(repo)
+
+
+def test_build_context(tmpdir):
+    repo_dir = _make_repo(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    context = BuildContext('abc', 'Dockerfile', root_dir=cache_dir)
+    assert not context.cached
+    context.create(repo_dir)
+    assert context.cached
+
+    with context.open() as f, tarfile.open(fileobj=f) as t:
+        names = set(t.getnames())
+    # the dockerfile is kept even if it's ignored
+    assert names == {'Dockerfile', '.dockerignore', 'app.py', 'lib', 'lib/lib.py'}
+
+    # the same commit and dockerfile share the context
+    assert BuildContext('abc', './Dockerfile', root_dir=cache_dir).cached
+    assert not BuildContext('abd', 'Dockerfile', root_dir=cache_dir).cached
+
+
+def test_evict_build_contexts(tmpdir):
+    repo_dir = _make_repo(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    contexts = [BuildContext(str(i), 'Dockerfile', root_dir=cache_dir) for i in range(3)]
+    for i, context in enumerate(contexts):
+        context.create(repo_dir)
+    size = tmpdir.join('cache').listdir()[0].size()
+    # the first one is used recently
+    contexts[0].open().close()
+
+    assert evict_build_contexts(cache_dir, budget=size) == 2 * size
+    assert [c.cached for c in contexts] == [True, False, False]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from console.libs.buildqueue import (
+    enqueue_build, pop_build, remove_build, get_build_position, acquire_builder_slot, release_builder_slot,
+)
+
+
+def test_builds_are_taken_round_robin(test_rds):
+    for i in range(3):
+        enqueue_build('a{}'.format(i), 'a', 'v{}'.format(i), 'app:a')
+    enqueue_build('b0', 'b', 'v0', 'app:b')
+
+    assert get_build_position('a0', 'app:a') == 0
+    assert get_build_position('b0', 'app:b') == 1
+    assert get_build_position('a2', 'app:a') == 3
+    assert get_build_position('x', 'app:a') is None
+
+    assert remove_build('a1', 'app:a')
+    assert not remove_build('a1', 'app:a')
+
+    build_id, info = pop_build()
+    assert build_id == 'a0'
+    assert info['appname'] == 'a' and info['tag'] == 'v0'
+    assert [pop_build()[0] for _ in range(2)] == ['b0', 'a2']
+    assert pop_build() is None
+
+
+def test_builder_slots(test_rds):
+    assert acquire_builder_slot('t1', host='node1', concurrency=2)
+    assert acquire_builder_slot('t2', host='node1', concurrency=2)
+    assert not acquire_builder_slot('t3', host='node1', concurrency=2)
+    assert acquire_builder_slot('t3', host='node2', concurrency=2)
+
+    release_builder_slot('t1', host='node1')
+    assert acquire_builder_slot('t3', host='node1', concurrency=2)
+    # the expired slots are reclaimed
+    assert acquire_builder_slot('t4', host='node3', concurrency=1, ttl=-1)
+    assert acquire_builder_slot('t5', host='node3', concurrency=1)
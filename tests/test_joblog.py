@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+
+import pytest
+
+from console.libs.joblog import (
+    LineIndex, GzipMembersWriter, get_log_index_path, load_log_index, find_tail_offset, iter_log_range,
+    slice_chunks,
+)
+
+
+def _write_log(tmpdir, data, compress=False, index_interval=None):
+    path = str(tmpdir.join('log.1.txt.gz' if compress else 'log.1.txt'))
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+        f.write(data)
+    if index_interval:
+        index = LineIndex(index_interval)
+        for i in range(0, len(data), 7):
+            index.feed(data[i:i + 7])
+        index.dump(get_log_index_path(path))
+    return path
+
+
+def _tail(path, n):
+    start = find_tail_offset(path, n)
+    return b''.join(iter_log_range(path, start, 1 << 20))
+
+
+@pytest.mark.parametrize('compress,index_interval', [(False, None), (False, 3), (True, 3), (True, None)])
+def test_tail(tmpdir, compress, index_interval):
+    lines = [b'line %d' % i for i in range(20)]
+    path = _write_log(tmpdir, b'\n'.join(lines) + b'\n', compress, index_interval)
+    assert _tail(path, 1) == b'line 19\n'
+    assert _tail(path, 5) == b'\n'.join(lines[-5:]) + b'\n'
+    assert _tail(path, 6) == b'\n'.join(lines[-6:]) + b'\n'
+    assert _tail(path, 100) == b'\n'.join(lines) + b'\n'
+
+    # the last line isn't terminated by newline
+    tmpdir.remove()
+    tmpdir.mkdir()
+    path = _write_log(tmpdir, b'\n'.join(lines), compress, index_interval)
+    assert _tail(path, 2) == b'line 18\nline 19'
+
+
+def test_line_index():
+    index = LineIndex(2)
+    for chunk in (b'a\nb', b'b\nc\n', b'dd\ne'):
+        index.feed(chunk)
+    assert index.offsets == [0, 5, 10]
+    assert index.lines == 5
+    assert index.size == 11
+
+
+def test_gzip_index_built_once(tmpdir):
+    path = _write_log(tmpdir, b'a\nb\nc\n', compress=True)
+    assert LineIndex.load(get_log_index_path(path)) is None
+    assert load_log_index(path).size == 6
+    assert LineIndex.load(get_log_index_path(path)).lines == 3
+
+
+def test_iter_log_range(tmpdir):
+    path = _write_log(tmpdir, b'0123456789')
+    assert b''.join(iter_log_range(path, 2, 5)) == b'234'
+    assert b''.join(iter_log_range(path, 8, 100)) == b'89'
+
+
+def test_gzip_members(tmpdir):
+    data = b''.join(b'line %d\n' % i for i in range(20))
+    path = str(tmpdir.join('log.1.txt.gz'))
+    index = LineIndex(3)
+    with open(path, 'wb') as f:
+        writer = GzipMembersWriter(f, index)
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        writer.close()
+    index.dump(get_log_index_path(path))
+
+    # a member is started at every indexed line
+    assert len(index.members) == len(index.offsets) == 7
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == data
+    assert _tail(path, 4) == b''.join(b'line %d\n' % i for i in range(16, 20))
+    for start, end in [(0, 10), (index.offsets[2], index.offsets[3]), (index.offsets[2] + 1, 100), (100, 1000)]:
+        assert b''.join(iter_log_range(path, start, end)) == data[start:end]
+
+    # the members before the start aren't decompressed
+    with open(path, 'r+b') as f:
+        f.write(b'\0' * index.members[1])
+    assert b''.join(iter_log_range(path, index.offsets[1] + 2, 100)) == data[index.offsets[1] + 2:100]
+
+
+def test_slice_chunks():
+    chunks = [b'012', b'345', b'6789']
+    assert b''.join(slice_chunks(iter(chunks), 2, 7)) == b'23456'
+    assert b''.join(slice_chunks(iter(chunks), 4)) == b'456789'
+    assert b''.join(slice_chunks(iter(chunks), 3, 6)) == b'345'
+    assert b''.join(slice_chunks(iter(chunks), 20)) == b''
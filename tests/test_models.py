@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 import copy
 
 import pytest
-from console.models import App, Release, OPLog, OPType, User
+from console.models import App, Release, OPLog, OPType, User, BuildCache
 from console.config import FAKE_USER
 from .prepare import (
     default_appname, default_git, default_tag, default_specs_text,
@@ -71,3 +71,17 @@ def test_oplog(test_db):
 
     query_by_appname = OPLog.get_by(appname=default_appname)
     assert len(query_by_appname) == 2
+
+
+def test_build_cache(test_db):
+    commit = 'a' * 40
+    key = BuildCache.make_cache_key(commit, 'Dockerfile')
+    assert key != BuildCache.make_cache_key(commit, 'docker/Dockerfile')
+    assert key != BuildCache.make_cache_key(commit, 'Dockerfile', {'ENV': 'prod'})
+    assert BuildCache.get_by_key(key) is None
+
+    cache = BuildCache.record(key, commit, 'registry.example.com/hello:v1', 'sha256:1234')
+    assert cache.image_ref == 'registry.example.com/hello@sha256:1234'
+    # the first build wins
+    BuildCache.record(key, commit, 'registry.example.com/world:v2', 'sha256:5678')
+    assert BuildCache.get_by_key(key).image == 'registry.example.com/hello:v1'
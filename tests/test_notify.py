@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import smtplib
+from email.mime.text import MIMEText
+
+import pytest
+
+from console.libs import notify
+from console.libs.notify import SMTPPool, merge_emails
+
+
+class FakeSMTP(object):
+    instances = []
+
+    def __init__(self, server):
+        self.sent = []
+        self.closed = False
+        self.disconnected = False
+        FakeSMTP.instances.append(self)
+
+    def login(self, sender, password):
+        pass
+
+    def sendmail(self, sender, receivers, msg):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        self.sent.append(receivers)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    FakeSMTP.instances = []
+    monkeypatch.setattr(notify.smtplib, 'SMTP', FakeSMTP)
+    return FakeSMTP
+
+
+def test_merge_emails():
+    assert merge_emails([{'subject': 's', 'text': 't'}]) == ('s', 't')
+    subject, text = merge_emails([{'subject': 's1', 'text': 't1'}, {'subject': 's2', 'text': 't2'}])
+    assert subject == 'KAE: 2 notifications'
+    assert text == '<h3>s1</h3>t1<hr/><h3>s2</h3>t2'
+
+
+def test_smtp_pool(fake_smtp):
+    pool = SMTPPool('smtp.example.com', 'sender', 'password', maxsize=1, idle_timeout=60)
+    msg = MIMEText('hello')
+    pool.sendmail(['a'], msg)
+    pool.sendmail(['b'], msg)
+    # the connection is reused
+    assert len(fake_smtp.instances) == 1
+    assert fake_smtp.instances[0].sent == [['a'], ['b']]
+
+    # reconnect when the pooled connection is closed by the server
+    fake_smtp.instances[0].disconnected = True
+    pool.sendmail(['c'], msg)
+    assert len(fake_smtp.instances) == 2
+    assert fake_smtp.instances[1].sent == [['c']]
+
+    pool.idle_timeout = -1
+    pool.sendmail(['d'], msg)
+    assert fake_smtp.instances[1].closed
+    assert fake_smtp.instances[2].sent == [['d']]
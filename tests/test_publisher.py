@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from console.libs.publisher import CoalescingPublisher, CompactPodEncoder, FullPodEncoder, json_diff
+
+
+class FakePod(object):
+    def __init__(self, name, phase):
+        self.name = name
+        self.phase = phase
+
+    def to_dict(self):
+        return {'name': self.name, 'phase': self.phase}
+
+
+def _publish(publisher, action, name, phase, channel='ch'):
+    publisher.publish(channel, name, action, FakePod(name, phase))
+
+
+def _pending(publisher):
+    result = []
+    for channel, message in publisher.pop_pending():
+        data = json.loads(message)
+        result.append((channel, data['action'], data['object']['name'], data['object']['phase']))
+    return result
+
+
+def test_coalesce_modified_events():
+    publisher = CoalescingPublisher(None, window=10)
+    _publish(publisher, 'ADDED', 'p1', 'Pending')
+    _publish(publisher, 'MODIFIED', 'p1', 'ContainerCreating')
+    _publish(publisher, 'MODIFIED', 'p2', 'Running')
+    _publish(publisher, 'MODIFIED', 'p1', 'Running')
+    _publish(publisher, 'MODIFIED', 'p2', 'Terminating')
+    assert _pending(publisher) == [
+        ('ch', 'ADDED', 'p1', 'Running'),
+        ('ch', 'MODIFIED', 'p2', 'Terminating'),
+    ]
+    assert _pending(publisher) == []
+
+
+def test_keep_added_deleted_order():
+    publisher = CoalescingPublisher(None, window=10)
+    _publish(publisher, 'MODIFIED', 'p1', 'Running')
+    _publish(publisher, 'DELETED', 'p1', 'Terminating')
+    _publish(publisher, 'MODIFIED', 'p1', 'Terminating')
+    _publish(publisher, 'ADDED', 'p1', 'Pending')
+    _publish(publisher, 'MODIFIED', 'p1', 'Running')
+    _publish(publisher, 'MODIFIED', 'p1', 'Running', channel='other')
+    assert _pending(publisher) == [
+        ('ch', 'MODIFIED', 'p1', 'Running'),
+        ('ch', 'DELETED', 'p1', 'Terminating'),
+        ('ch', 'MODIFIED', 'p1', 'Terminating'),
+        ('ch', 'ADDED', 'p1', 'Running'),
+        ('other', 'MODIFIED', 'p1', 'Running'),
+    ]
+
+
+def test_json_diff():
+    old = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e/f': [1], 'g': 1}
+    new = {'a': 1, 'b': {'c': 4}, 'e/f': [1, 2], 'h': None}
+    assert json_diff(old, new) == [
+        {'op': 'remove', 'path': '/g'},
+        {'op': 'remove', 'path': '/b/d'},
+        {'op': 'replace', 'path': '/b/c', 'value': 4},
+        {'op': 'replace', 'path': '/e~1f', 'value': [1, 2]},
+        {'op': 'add', 'path': '/h', 'value': None},
+    ]
+    assert json_diff(new, new) == []
+
+
+def test_compact_pod_encoder(monkeypatch):
+    def fake_project(pod):
+        return {'metadata': {'name': pod.name, 'resource_version': pod.phase}, 'status': {'phase': pod.phase}}
+
+    monkeypatch.setattr('console.libs.publisher.project_pod', fake_project)
+    encoder = CompactPodEncoder()
+    added = json.loads(encoder.encode('ch', 'p1', 'ADDED', FakePod('p1', 'Pending')))
+    assert added['object']['status']['phase'] == 'Pending'
+
+    modified = json.loads(encoder.encode('ch', 'p1', 'MODIFIED', FakePod('p1', 'Running')))
+    assert modified['base_version'] == 'Pending'
+    assert modified['resource_version'] == 'Running'
+    assert modified['patch'] == [
+        {'op': 'replace', 'path': '/metadata/resource_version', 'value': 'Running'},
+        {'op': 'replace', 'path': '/status/phase', 'value': 'Running'},
+    ]
+
+    encoder.encode('ch', 'p1', 'DELETED', FakePod('p1', 'Running'))
+    modified = json.loads(encoder.encode('ch', 'p1', 'MODIFIED', FakePod('p1', 'Pending')))
+    assert 'patch' not in modified
+
+
+def test_full_pod_encoder_converts_raw_pod():
+    raw = {
+        'metadata': {
+            'name': 'p1',
+            'resourceVersion': '1',
+            'creationTimestamp': '2019-01-02T03:04:05Z',
+            'labels': {'kae-app-name': 'app', 'appVersion': 'v1'},
+        },
+        'spec': {'nodeName': 'node1', 'containers': [{'name': 'c', 'imagePullPolicy': 'Always'}]},
+        'status': {'hostIP': '10.0.0.1', 'containerStatuses': [{'restartCount': 0}]},
+    }
+    data = json.loads(FullPodEncoder().encode('ch', 'p1', 'ADDED', raw))
+    obj = data['object']
+    assert obj['metadata'] == {
+        'name': 'p1',
+        'resource_version': '1',
+        'creation_timestamp': '2019-01-02 03:04:05',
+        'labels': {'kae-app-name': 'app', 'appVersion': 'v1'},
+    }
+    assert obj['spec'] == {'node_name': 'node1', 'containers': [{'name': 'c', 'image_pull_policy': 'Always'}]}
+    assert obj['status'] == {'host_ip': '10.0.0.1', 'container_statuses': [{'restart_count': 0}]}
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from console.libs.pubsub import PubSubHub, SubscriptionOverflow
+
+
+class FakePubSub(object):
+    def __init__(self):
+        self.commands = []
+
+    def subscribe(self, *channels):
+        self.commands.append(('subscribe',) + channels)
+
+    def unsubscribe(self, *channels):
+        self.commands.append(('unsubscribe',) + channels)
+
+    def psubscribe(self, *patterns):
+        self.commands.append(('psubscribe',) + patterns)
+
+    def punsubscribe(self, *patterns):
+        self.commands.append(('punsubscribe',) + patterns)
+
+
+class FakeRedis(object):
+    def pubsub(self):
+        return FakePubSub()
+
+
+def test_reference_counted_subscriptions():
+    hub = PubSubHub(FakeRedis())
+    pubsub = hub._pubsub
+
+    sub1 = hub.subscribe(['a', 'b'])
+    sub2 = hub.subscribe(['b'], patterns=['c*'])
+    assert pubsub.commands == [('subscribe', 'a', 'b'), ('psubscribe', 'c*')]
+
+    hub._dispatch({'type': 'message', 'pattern': None, 'channel': b'b', 'data': b'1'})
+    hub._dispatch({'type': 'pmessage', 'pattern': b'c*', 'channel': b'c1', 'data': b'2'})
+    assert sub1.get(timeout=0) == ('b', b'1')
+    assert sub1.get(timeout=0) is None
+    assert sub2.get(timeout=0) == ('b', b'1')
+    assert sub2.get(timeout=0) == ('c1', b'2')
+
+    sub1.unsubscribe('b')
+    assert pubsub.commands[-1] == ('psubscribe', 'c*')
+    sub1.close()
+    assert pubsub.commands[-1] == ('unsubscribe', 'a')
+    sub2.close()
+    assert pubsub.commands[-2:] == [('unsubscribe', 'b'), ('punsubscribe', 'c*')]
+
+
+def test_overflow():
+    hub = PubSubHub(FakeRedis(), maxsize=1)
+    sub = hub.subscribe(['a'])
+    hub._dispatch({'type': 'message', 'pattern': None, 'channel': 'a', 'data': '1'})
+    hub._dispatch({'type': 'message', 'pattern': None, 'channel': 'a', 'data': '2'})
+    assert hub._pubsub.commands[-1] == ('unsubscribe', 'a')
+    with pytest.raises(SubscriptionOverflow):
+        sub.get(timeout=0)
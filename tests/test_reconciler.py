@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from console.libs.reconciler import job_pod_status
+
+
+def _pod(status):
+    return {'metadata': {'name': 'job1-abcde'}, 'status': status}
+
+
+def test_job_pod_status():
+    assert job_pod_status(_pod({'phase': 'Pending'})) == ('Pending', False)
+    assert job_pod_status(_pod({'phase': 'Failed', 'reason': 'Evicted'})) == ('Failed: Evicted', False)
+
+    running = {'phase': 'Running', 'containerStatuses': [{'state': {'running': {'startedAt': '2019-01-02T03:04:05Z'}}}]}
+    assert job_pod_status(_pod(running)) == ('Running', False)
+
+    waiting = {'phase': 'Pending', 'containerStatuses': [{'state': {'waiting': {'reason': 'ImagePullBackOff'}}}]}
+    assert job_pod_status(_pod(waiting)) == ('waiting: ImagePullBackOff', False)
+
+    completed = {'phase': 'Succeeded', 'containerStatuses': [{'state': {'terminated': {'reason': 'Completed'}}}]}
+    assert job_pod_status(_pod(completed)) == ('Completed', True)
+
+    failed = {'phase': 'Failed', 'containerStatuses': [{'state': {'terminated': {'reason': 'Error'}}}]}
+    assert job_pod_status(_pod(failed)) == ('terminated: Error', True)
+
+
+def test_reconciler_drops_noop_transitions():
+    from console.libs.reconciler import JobStatusReconciler
+
+    reconciler = JobStatusReconciler(None, None)
+    completed = _pod({'phase': 'Succeeded', 'containerStatuses': [{'state': {'terminated': {'reason': 'Completed'}}}]})
+    reconciler.submit('job1', completed)
+    assert reconciler._pending == {'job1': ('job1-abcde', 'Completed')}
+    assert reconciler._terminated == {'job1': 'job1-abcde'}
+
+    # pretend the batch is written
+    reconciler._applied.update(reconciler._pending)
+    reconciler._pending, reconciler._terminated = {}, {}
+    # the MODIFIED events before the pod is deleted
+    reconciler.submit('job1', completed)
+    assert reconciler._pending == {} and reconciler._terminated == {}
+
+    # the pod of the restarted job ends with the same status
+    restarted = _pod({'phase': 'Succeeded', 'containerStatuses': [{'state': {'terminated': {'reason': 'Completed'}}}]})
+    restarted['metadata']['name'] = 'job1-fghij'
+    reconciler.submit('job1', restarted)
+    assert reconciler._pending == {'job1': ('job1-fghij', 'Completed')}
+    assert reconciler._terminated == {'job1': 'job1-fghij'}
+
+    reconciler.forget('job1')
+    assert reconciler._applied == {}
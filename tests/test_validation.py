@@ -27,3 +27,33 @@ def test_validate_git():
     ]
     for git_url in good_git_urls:
         validate_git(git_url)
+
+
+class FakeKubeApi(object):
+    def cluster_exist(self, cluster):
+        return cluster == 'cluster1'
+
+
+def test_batch_deploy_schema(monkeypatch):
+    from console.libs.k8s import KubeApi
+    from console.libs.validation import BatchDeploySchema
+
+    monkeypatch.setattr(KubeApi, 'instance', classmethod(lambda cls: FakeKubeApi()))
+    schema = BatchDeploySchema()
+    data = schema.load({'items': [
+        {'appname': 'app1', 'cluster': 'cluster1', 'tag': 'v1'},
+        {'appname': 'app2', 'cluster': 'cluster1', 'tag': 'v2', 'replicas': 2},
+    ]}).data
+    assert [item['appname'] for item in data['items']] == ['app1', 'app2']
+    assert data['items'][0]['app_yaml_name'] == 'default'
+
+    invalid_payloads = [
+        {'items': [{'appname': 'app1', 'cluster': 'cluster1'}]},
+        {'items': [{'appname': 'app1', 'cluster': 'cluster1', 'tag': 'v1', 'unknown': 1}]},
+        {'items': [{'appname': 'app1', 'cluster': 'cluster1', 'tag': 'v1'}] * 2},
+        {'items': [{'appname': 'app1', 'cluster': 'cluster2', 'tag': 'v1'}]},
+        {'items': []},
+    ]
+    for payload in invalid_payloads:
+        with pytest.raises(ValidationError):
+            schema.load(payload)